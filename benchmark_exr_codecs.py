@@ -0,0 +1,73 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pyexr
+
+from normal_maps import EXR_COMPRESSIONS, EXR_PRECISIONS, exr_compression, exr_precision, read_exr, set_exr_threads
+
+
+def synthetic_normal_map(height, width):
+    """
+    Normals of a sphere filling the image, zero outside, like an SDM-UniPS result with its background.
+    """
+    y, x = np.mgrid[-1:1:height * 1j, -1:1:width * 1j]
+    z2 = 1 - x ** 2 - y ** 2
+    normals = np.stack([x, -y, np.sqrt(np.clip(z2, 0, None))], axis=-1).astype(np.float32)
+    normals[z2 < 0] = 0
+    return normals
+
+
+def benchmark(normals, precision, compression, repeats, tmp_dir):
+    """
+    Write and read normals repeatedly with one codec.
+    Returns (file_size, write MB/s, read MB/s, max abs error), MB/s relative to the float32 size of the image.
+    """
+    path = os.path.join(tmp_dir, f"bench_{precision}_{compression}.exr")
+    raw_mb = normals.nbytes / 2 ** 20
+
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        pyexr.write(path, normals, precision=exr_precision(precision), compression=exr_compression(compression))
+    write_seconds = (time.perf_counter() - start_time) / repeats
+
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        decoded, _, _ = read_exr(path)
+    read_seconds = (time.perf_counter() - start_time) / repeats
+
+    file_size = os.path.getsize(path)
+    os.remove(path)
+    return file_size, raw_mb / write_seconds, raw_mb / read_seconds, float(np.abs(decoded - normals).max())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare EXR pixel types and compressions for normal maps.")
+    parser.add_argument("--input", type=str, help="Normal map to benchmark with (default: synthetic sphere normals)")
+    parser.add_argument("--size", type=int, nargs=2, default=[2048, 2048], metavar=("HEIGHT", "WIDTH"),
+                        help="Size of the synthetic normal map (default: 2048 2048)")
+    parser.add_argument("--repeats", type=int, default=3, help="Writes and reads per codec (default: 3)")
+    parser.add_argument("--exr_threads", type=int, default=os.cpu_count(),
+                        help="OpenEXR threads compressing/decompressing the file (default: all cores)")
+    parser.add_argument("--tmp_dir", type=str, help="Folder for the test files (default: system temp folder)")
+    args = parser.parse_args(argv)
+
+    set_exr_threads(args.exr_threads)
+    normals = read_exr(args.input)[0] if args.input else synthetic_normal_map(*args.size)
+    print(f"Normal map {normals.shape[1]}x{normals.shape[0]}, {normals.nbytes / 2 ** 20:.1f} MB as float32, "
+          f"{args.exr_threads} OpenEXR threads")
+    print(f"{'precision':<10}{'compression':<13}{'size MB':>9}{'ratio':>8}{'write MB/s':>12}{'read MB/s':>11}{'max error':>11}")
+
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        for precision in EXR_PRECISIONS:
+            for compression in EXR_COMPRESSIONS:
+                file_size, write_speed, read_speed, error = benchmark(normals, precision, compression,
+                                                                      args.repeats, tmp_dir)
+                print(f"{precision:<10}{compression:<13}{file_size / 2 ** 20:>9.2f}{normals.nbytes / file_size:>8.2f}"
+                      f"{write_speed:>12.1f}{read_speed:>11.1f}{error:>11.2e}")
+
+
+if __name__ == "__main__":
+    main()
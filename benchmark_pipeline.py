@@ -0,0 +1,223 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from synthetic_dataset import generate_dataset, load_dataset_info
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Stages in pipeline order. Every command runs in the run folder, a fresh copy of the dataset;
+# "images" is the number of images the stage processes, from the dataset settings.
+STAGES = [
+    {"name": "grouping", "images": "captured",
+     "command": ["group_images.py", "raw", "views", "{lights}"]},
+    {"name": "renaming", "images": "captured",
+     "command": ["rename_images_in_folders.py", "views", "--quiet"]},
+    {"name": "resizing", "images": "captured",
+     "command": ["resize_all_images_new.py", "views", "--resize", "{width}x{height}!", "--engine", "native"]},
+    {"name": "copy_masks", "images": "views",
+     "command": ["copy_masks_to_subfolders.py", "masks", "views"]},
+    {"name": "stacking", "images": "captured",
+     "command": ["create_stacked.py", "views", "stacked", "--engine", "native"]},
+    {"name": "undistortion", "images": "captured",
+     "command": ["undistort_all_mvps_images.py", "--cameras_txt_path", "model/cameras{model_ext}",
+                 "--all_mvps_images_path", "views", "--undistorted_mvps_images_path", "undistorted",
+                 "--engine", "native"]},
+    {"name": "flattening", "images": "captured",
+     "command": ["flatten_colmap_model.py", "undistorted", "rig_model/images{model_ext}", "flat"]},
+    {"name": "colmap2neus", "images": "views",
+     "command": ["colmap2neus.py", "--colmap_path", "model"]},
+    {"name": "normal_gathering", "images": "views",
+     "command": ["gather_and_convert_normal_map_colmap.py", "--colmap_path", "model",
+                 "--sdm_unips_result_dir", "sdm_unips_results", "--data_dir", "neus_data"]},
+]
+STAGE_NAMES = [stage["name"] for stage in STAGES]
+
+# Folders of the dataset copied into every run folder (the stages move, rename and add files in them)
+DATASET_FOLDERS = ("raw", "masks", "model", "rig_model", "sdm_unips_results")
+
+
+def prepare_run_folder(dataset_dir, run_dir):
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    os.makedirs(run_dir)
+    for folder in DATASET_FOLDERS:
+        shutil.copytree(os.path.join(dataset_dir, folder), os.path.join(run_dir, folder))
+
+
+def _proc_io(pid):
+    """
+    Bytes read and written by the (exited, not yet reaped) process pid and its reaped children, from /proc/<pid>/io.
+    """
+    try:
+        with open(f"/proc/{pid}/io", "r") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def run_measured(command, cwd, log_file):
+    """
+    Run command and return (returncode, wall seconds, peak RSS bytes, bytes read, bytes written).
+    Peak RSS and I/O include the worker processes of the command. Bytes are the read/write system call totals
+    (page cache hits included) on Linux and the block I/O of the rusage elsewhere; None when the platform has neither.
+    """
+    start_time = time.perf_counter()
+    process = subprocess.Popen(command, cwd=cwd, stdout=log_file, stderr=subprocess.STDOUT)
+    if not hasattr(os, "wait4"):
+        returncode = process.wait()
+        return returncode, time.perf_counter() - start_time, None, None, None
+
+    io = None
+    if hasattr(os, "waitid") and os.path.exists(f"/proc/{process.pid}/io"):
+        # Wait for the exit without reaping, the I/O counters disappear with the process
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        io = _proc_io(process.pid)
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall_seconds = time.perf_counter() - start_time
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    if io is None:
+        io = (rusage.ru_inblock * 512, rusage.ru_oublock * 512)
+    return process.returncode, wall_seconds, peak_rss, io[0], io[1]
+
+
+def run_benchmark(dataset_dir, run_dir, stages=None, log_path=None):
+    """
+    Run the selected stages (all by default) in order on a fresh copy of the dataset in run_dir.
+    Returns a dict of stage name -> measurements. A failing stage stops the run.
+    """
+    info = load_dataset_info(dataset_dir)
+    variables = {"lights": info["lights"], "height": info["size"][0], "width": info["size"][1],
+                 "model_ext": ".bin" if info["model_format"] == "bin" else ".txt"}
+    image_counts = {"captured": info["views"] * info["lights"], "views": info["views"]}
+
+    prepare_run_folder(dataset_dir, run_dir)
+    log_file = open(log_path or os.devnull, "w")
+    results = {}
+    with log_file:
+        for stage in STAGES:
+            if stages and stage["name"] not in stages:
+                continue
+            script, *arguments = stage["command"]
+            command = [sys.executable, os.path.join(SCRIPTS_DIR, script)] + [a.format(**variables) for a in arguments]
+            log_file.write(f"\n===== {stage['name']}: {' '.join(command)}\n")
+            log_file.flush()
+            returncode, wall_seconds, peak_rss, read_bytes, written_bytes = run_measured(command, run_dir, log_file)
+
+            images = image_counts[stage["images"]]
+            results[stage["name"]] = {
+                "wall_seconds": round(wall_seconds, 4),
+                "images": images,
+                "images_per_second": round(images / max(wall_seconds, 1e-9), 2),
+                "peak_rss_bytes": peak_rss,
+                "read_bytes": read_bytes,
+                "written_bytes": written_bytes,
+                "returncode": returncode,
+            }
+            print(f"{stage['name']:<18}{wall_seconds:>9.2f} s{images / max(wall_seconds, 1e-9):>10.1f} img/s"
+                  f"{(peak_rss or 0) / 2 ** 20:>9.0f} MB RSS{(read_bytes or 0) / 2 ** 20:>9.0f} MB read"
+                  f"{(written_bytes or 0) / 2 ** 20:>9.0f} MB written")
+            if returncode != 0:
+                print(f"Stage {stage['name']} failed with exit code {returncode}, see {log_path or 'the --log file'}")
+                break
+    return results
+
+
+def compare_to_baseline(report, baseline, tolerance):
+    """
+    Print the wall time of every stage against the baseline report.
+    Returns the names of the stages that are slower than the baseline by more than tolerance (a fraction).
+    """
+    regressions = []
+    print(f"\n{'stage':<18}{'baseline s':>11}{'current s':>11}{'change':>9}")
+    for name, result in report["stages"].items():
+        if name not in baseline.get("stages", {}):
+            continue
+        before = baseline["stages"][name]["wall_seconds"]
+        after = result["wall_seconds"]
+        change = (after - before) / max(before, 1e-9)
+        slower = change > tolerance
+        if slower:
+            regressions.append(name)
+        print(f"{name:<18}{before:>11.2f}{after:>11.2f}{change:>+9.1%}{'  REGRESSION' if slower else ''}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time every stage of the MVPS preprocessing on a synthetic dataset "
+                                                 "and report wall time, images/sec, peak RSS and I/O as JSON.")
+    parser.add_argument("--dataset", type=str,
+                        help="Dataset generated by synthetic_dataset.py (default: generate one with the options below)")
+    parser.add_argument("--views", type=int, default=8, help="Views of the generated dataset (default: 8)")
+    parser.add_argument("--lights", type=int, default=12, help="Lights of the generated dataset (default: 12)")
+    parser.add_argument("--raw_size", type=int, nargs=2, default=[1024, 1024], metavar=("HEIGHT", "WIDTH"),
+                        help="Captured image size of the generated dataset (default: 1024 1024)")
+    parser.add_argument("--size", type=int, nargs=2, metavar=("HEIGHT", "WIDTH"),
+                        help="Size after resizing of the generated dataset (default: half of raw_size)")
+    parser.add_argument("--coverage", type=float, default=0.5, help="Mask coverage of the generated dataset")
+    parser.add_argument("--model_format", choices=["txt", "bin"], default="txt",
+                        help="COLMAP model format of the generated dataset (default: txt)")
+    parser.add_argument("--stages", nargs="+", choices=STAGE_NAMES, help="Only run these stages (default: all)")
+    parser.add_argument("--work_dir", type=str,
+                        help="Folder for the dataset and run copies, kept after the run (default: a temporary folder)")
+    parser.add_argument("--output", type=str, help="Write the JSON report to this file (default: print it)")
+    parser.add_argument("--log", type=str, help="File receiving the output of the stages")
+    parser.add_argument("--baseline", type=str, help="JSON report of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Slowdown against the baseline reported as a regression (default: 0.1 = 10%%)")
+    args = parser.parse_args(argv)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="mvps_benchmark_")
+    try:
+        dataset_dir = args.dataset
+        if dataset_dir is None:
+            dataset_dir = os.path.join(work_dir, "dataset")
+            size = args.size or [args.raw_size[0] // 2, args.raw_size[1] // 2]
+            print(f"Generating {args.views} views x {args.lights} lights in {dataset_dir}")
+            generate_dataset(dataset_dir, args.views, args.lights, args.raw_size, size, args.coverage,
+                             args.model_format)
+
+        results = run_benchmark(dataset_dir, os.path.join(work_dir, "run"), args.stages, args.log)
+        report = {
+            "dataset": load_dataset_info(dataset_dir),
+            "machine": {"platform": platform.platform(), "processor": platform.processor(),
+                        "cpu_count": os.cpu_count(), "python": platform.python_version()},
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "stages": results,
+        }
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+        print(f"Report written to {args.output}")
+    else:
+        print(json.dumps(report, indent=1))
+
+    failed = any(result["returncode"] != 0 for result in results.values())
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        if baseline.get("dataset") != report["dataset"]:
+            print("Warning: the baseline was measured on a different dataset")
+        regressions = compare_to_baseline(report, baseline, args.tolerance)
+        if regressions:
+            print(f"Slower than the baseline: {', '.join(regressions)}")
+    sys.exit(1 if failed or regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+import os
+import re
+from collections.abc import Mapping
+from pathlib import Path
+
+import numpy as np
+
+from colmap_io import camera_matrix
+
+# Folder written next to cameras_sphere.npz, one uncompressed .npy file per array
+PACK_DIR_NAME = "cameras_sphere_mmap"
+PACK_FILES = ("view_ids", "world_mats", "camera_ids", "scale_mat", "intrinsics", "cameras")
+
+_KEY_PATTERN = re.compile(r"(world_mat|world_mat_inv|scale_mat|scale_mat_inv)_(-?\d+)$")
+
+
+def _save_array(path, array):
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def intrinsics_by_camera_id(cameras):
+    """
+    (max CAMERA_ID + 1, 3, 3) array of intrinsic matrices, row i holds camera i (zeros for unused ids).
+    """
+    intrinsics = np.zeros((int(cameras["camera_id"].max(initial=0)) + 1, 3, 3))
+    for camera in cameras:
+        intrinsics[camera["camera_id"]] = camera_matrix(camera)
+    return intrinsics
+
+
+def write_camera_pack(folder, view_ids, world_mats, scale_mat, camera_ids, cameras):
+    """
+    Write the cameras as memory-mappable arrays into folder:
+    view_ids (N,), world_mats (N, 4, 4), camera_ids (N,), a single scale_mat (4, 4),
+    intrinsics (max CAMERA_ID + 1, 3, 3) indexed by CAMERA_ID and the raw camera records (colmap_io.CAMERA_DTYPE).
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    arrays = {
+        "view_ids": np.asarray(view_ids, dtype=np.int64),
+        "world_mats": np.ascontiguousarray(world_mats, dtype=np.float64),
+        "camera_ids": np.asarray(camera_ids, dtype=np.int64),
+        "scale_mat": np.asarray(scale_mat, dtype=np.float64),
+        "intrinsics": intrinsics_by_camera_id(cameras),
+        "cameras": cameras,
+    }
+    for name in PACK_FILES:
+        _save_array(folder / f"{name}.npy", arrays[name])
+
+
+class CameraPack(Mapping):
+    """
+    Cameras of a pack folder, memory-mapped.
+    The arrays are available as attributes (world_mats, view_ids, ...), and the object also behaves like the
+    dict loaded from cameras_sphere.npz: pack["world_mat_12"], pack["scale_mat_0"], keys(), len().
+    Only the requested matrices are read from disk.
+    """
+
+    def __init__(self, folder, mmap_mode="r"):
+        self.folder = Path(folder)
+        for name in PACK_FILES:
+            setattr(self, name, np.load(self.folder / f"{name}.npy", mmap_mode=mmap_mode))
+        self._index = {int(view_id): i for i, view_id in enumerate(self.view_ids)}
+
+    def intrinsics_of_view(self, view_id):
+        return self.intrinsics[self.camera_ids[self._index[view_id]]]
+
+    def __getitem__(self, key):
+        match = _KEY_PATTERN.match(key)
+        if match is None:
+            raise KeyError(key)
+        name, number = match.group(1), int(match.group(2))
+        if name.startswith("world_mat"):
+            if number not in self._index:
+                raise KeyError(key)
+            matrix = np.array(self.world_mats[self._index[number]])
+        else:
+            if not 0 <= number < len(self.view_ids):
+                raise KeyError(key)
+            matrix = np.array(self.scale_mat)
+        return np.linalg.inv(matrix) if name.endswith("_inv") else matrix
+
+    def __iter__(self):
+        for view_id in self.view_ids:
+            yield f"world_mat_{int(view_id)}"
+        for i in range(len(self.view_ids)):
+            yield f"scale_mat_{i}"
+
+    def __len__(self):
+        return 2 * len(self.view_ids)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+
+def load_cameras_sphere(path, mmap_mode="r"):
+    """
+    Load the cameras of a model folder (or of a cameras_sphere.npz path): the memory-mapped pack if it exists,
+    otherwise the npz. Both are indexed with the npz keys (world_mat_<view_id>, scale_mat_<index>).
+    """
+    path = Path(path)
+    folder = path.parent if path.suffix == ".npz" else path
+    if (folder / PACK_DIR_NAME / "world_mats.npy").exists():
+        return CameraPack(folder / PACK_DIR_NAME, mmap_mode)
+    return dict(np.load(path if path.suffix == ".npz" else folder / "cameras_sphere.npz"))
@@ -1,6 +1,10 @@
+import argparse
 import os.path
 import numpy as np
 import os
+from camera_pack import PACK_DIR_NAME, write_camera_pack
+from colmap_io import camera_matrix, make4x4, quaternions_to_rotation_matrices, read_cameras, read_images
+from metrics import add_metrics_arguments, collect_metrics
 
 
 # details of camera normalization can be found in Sec. C.3 in https://openaccess.thecvf.com/content/CVPR2023/supplemental/Cao_Multi-View_Azimuth_Stereo_CVPR_2023_supplemental.pdf
@@ -23,75 +27,55 @@ def normalize_camera(R_list, t_list, camera2object_ratio=3):
     scale = np.max(camera_center_dist_list) / camera2object_ratio
     return offset, scale
 
-def make4x4(P):
-    assert P.shape[-1] == 4 or P.shape[-1] == 3
-    assert len(P.shape) == 2
-    assert P.shape[0] == 3 or P.shape[0] == 4
-    ret = np.eye(4)
-    ret[:P.shape[0], :P.shape[1]] = P
-    return ret
-
+def normalize_camera_batch(R, t, camera2object_ratio=3):
+    """
+    Vectorized normalize_camera for stacked rotations R (N, 3, 3) and translations t (N, 3).
+    """
+    R = np.asarray(R, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64).reshape(-1, 3)
+    camera_centers = -np.einsum("nji,nj->ni", R, t)  # -R.T @ t, in world coordinate
+    v = R[:, 2, :]  # the cameras' principal axes in the world coordinates
+    # sum_i (I - v_i v_i^T) and sum_i c_i^T (I - v_i v_i^T)
+    A_camera_normalize = len(R) * np.eye(3) - np.einsum("ni,nj->ij", v, v)
+    b_camera_normalize = camera_centers.sum(axis=0) - np.einsum("ni,ni,nj->j", camera_centers, v, v)
+    offset = np.linalg.lstsq(A_camera_normalize, b_camera_normalize, rcond=None)[0]
+    scale = np.linalg.norm(camera_centers - offset, axis=1).max() / camera2object_ratio
+    return offset, scale
 
-def quaternion_to_rotation_matrix(qw, qx, qy, qz):
-    R = np.array([
-       [1 - 2*qy**2 - 2*qz**2, 2*qx*qy - 2*qz*qw, 2*qx*qz + 2*qy*qw],
-       [2*qx*qy + 2*qz*qw, 1 - 2*qx**2 - 2*qz**2, 2*qy*qz - 2*qx*qw],
-       [2*qx*qz - 2*qy*qw, 2*qy*qz + 2*qx*qw, 1 - 2*qx**2 - 2*qy**2]
-    ])
-    return R
+def world_matrices(K, R, t):
+    """
+    Build all K @ [R | t] world matrices at once as an (N, 4, 4) array.
+    """
+    W2C = np.zeros((len(R), 4, 4))
+    W2C[:, :3, :3] = R
+    W2C[:, :3, 3] = np.asarray(t).reshape(-1, 3)
+    W2C[:, 3, 3] = 1
+    return make4x4(K) @ W2C
 
 class ColmapPoseLoader:
     def __init__(self, model_path, camera2object_ratio):
-        # Create file paths
-        cameras_txt_path = os.path.join(model_path, "cameras.txt")
-        images_txt_path = os.path.join(model_path, "images.txt")
-
-        # Load camera intrinsics from cameras.txt
-        with open(cameras_txt_path, 'r') as f:
-            camera_lines = [line.strip() for line in f if not line.startswith('#') and line.strip()]
-        camera_data = camera_lines[0].split()
-
-        # Focal distance and principal point
-        fx, fy, cx, cy = map(float, camera_data[4:8])
-        
-        # Camera matrix
-        K = np.array([[fx, 0, cx], 
-                      [0, fy, cy], 
-                      [0, 0, 1]])
-        
-        # Load camera extrinsics from images.txt
-        with open(images_txt_path, 'r') as f:
-            image_lines = [line.strip() for line in f if not line.startswith('#') and line.strip()]
-
-        # Remove every second line from image_lines (skip the 2D points for each image)
-        image_lines = image_lines[::2]
-
-
-        R_list = []
-        t_list = []
+        # Load camera intrinsics from cameras.bin or cameras.txt
+        cameras = read_cameras(model_path)
+
+        # Camera matrix (focal distance and principal point) of the first camera
+        K = camera_matrix(cameras[0])
+
+        # Load camera extrinsics from images.bin or images.txt (the 2D points of each image are skipped)
+        images = read_images(model_path)
+
+        # All poses are converted at once
+        R = quaternions_to_rotation_matrices(images["qvec"])
+        t = images["tvec"]
+        view_ids = [int(os.path.splitext(filename)[0]) for filename in images["name"]]
+        world_mats = world_matrices(K, R, t)
+
         camera_sphere = {}
-        for line in image_lines:
-            image_data = line.split() # IMAGE_ID, QW, QX, QY, QZ, TX, TY, TZ, CAMERA_ID, NAME
-            qw, qx, qy, qz = map(float, image_data[1:5])
-            tx, ty, tz = map(float, image_data[5:8])
-            filename = image_data[-1]
-            view_id = int(os.path.splitext(filename)[0])
-            R = quaternion_to_rotation_matrix(qw, qx, qy, qz)
-            t = np.array([tx, ty, tz]).reshape([3, 1])
-
-            W2C = np.zeros((4, 4))
-            W2C[3, 3] = 1
-            W2C[:3, :3] = R
-            W2C[:3, [3]] = t
-
-            R_list.append(R)
-            t_list.append(t)
-
-            camera_sphere[f"world_mat_{view_id}"] = make4x4(K) @ W2C
-
-        offset, scale = normalize_camera(R_list, t_list, camera2object_ratio=camera2object_ratio)
+        for view_id, world_mat in zip(view_ids, world_mats):
+            camera_sphere[f"world_mat_{view_id}"] = world_mat
+
+        offset, scale = normalize_camera_batch(R, t, camera2object_ratio=camera2object_ratio)
         print("offset", offset, "scale", scale)
-        num_views = len(R_list)
+        num_views = len(R)
 
         scale_mat = np.eye(4)
         scale_mat[:3, :3] *= scale
@@ -100,12 +84,22 @@ class ColmapPoseLoader:
             camera_sphere[f"scale_mat_{im_idx}"] = scale_mat
         np.savez(os.path.join(model_path, "cameras_sphere.npz"), **camera_sphere)
 
+        # The same cameras as memory-mappable arrays: (N, 4, 4) world matrices, one scale matrix and the
+        # intrinsics of every camera indexed by CAMERA_ID (see camera_pack.load_cameras_sphere)
+        write_camera_pack(os.path.join(model_path, PACK_DIR_NAME), view_ids, world_mats, scale_mat,
+                          images["camera_id"], cameras)
+
 
-if __name__=="__main__":
-    import argparse
+def main(argv=None):
     parser = argparse.ArgumentParser()
-    parser.add_argument("--colmap_path", type=str, required=True, help="Path to the COLMAP model in TXT format (cameras.txt, images.txt, points3D.txt)")
+    parser.add_argument("--colmap_path", type=str, required=True, help="Path to the COLMAP model in TXT or BIN format (cameras.txt/.bin, images.txt/.bin)")
     parser.add_argument("--ratio", type=float, default=10)
-    args = parser.parse_args()
+    add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+
+    with collect_metrics(args, "colmap2neus"):
+        ColmapPoseLoader(args.colmap_path, camera2object_ratio=args.ratio)
+
 
-    ColmapPoseLoader(args.colmap_path, camera2object_ratio=args.ratio)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
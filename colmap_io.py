@@ -0,0 +1,407 @@
+import mmap
+import os
+import struct
+
+import numpy as np
+
+# COLMAP camera models: model_id -> (model_name, num_params)
+CAMERA_MODELS = {
+    0: ("SIMPLE_PINHOLE", 3),
+    1: ("PINHOLE", 4),
+    2: ("SIMPLE_RADIAL", 4),
+    3: ("RADIAL", 5),
+    4: ("OPENCV", 8),
+    5: ("OPENCV_FISHEYE", 8),
+    6: ("FULL_OPENCV", 12),
+    7: ("FOV", 5),
+    8: ("SIMPLE_RADIAL_FISHEYE", 4),
+    9: ("RADIAL_FISHEYE", 5),
+    10: ("THIN_PRISM_FISHEYE", 12),
+    11: ("RAD_TAN_THIN_PRISM_FISHEYE", 16),
+}
+MAX_CAMERA_PARAMS = 16
+
+CAMERA_DTYPE = np.dtype([
+    ("camera_id", "<i8"),
+    ("model", "U32"),
+    ("width", "<i8"),
+    ("height", "<i8"),
+    ("num_params", "<i4"),
+    ("params", "<f8", (MAX_CAMERA_PARAMS,)),
+])
+
+POINT3D_DTYPE = np.dtype([
+    ("point3D_id", "<i8"),
+    ("xyz", "<f8", (3,)),
+    ("rgb", "u1", (3,)),
+    ("error", "<f8"),
+    ("track_length", "<i8"),
+])
+
+# Fixed-size part of an image record in images.bin: IMAGE_ID, QW, QX, QY, QZ, TX, TY, TZ, CAMERA_ID
+_IMAGE_HEADER = struct.Struct("<i7di")
+# Every 2D point in images.bin is X, Y (double) and POINT3D_ID (int64)
+_POINT2D_SIZE = 24
+_CAMERA_HEADER = struct.Struct("<iiQQ")
+# POINT3D_ID, X, Y, Z, R, G, B, ERROR
+_POINT3D_HEADER = struct.Struct("<Q3d3Bd")
+# Every track element in points3D.bin is IMAGE_ID, POINT2D_IDX (int32)
+_TRACK_ELEMENT_SIZE = 8
+
+
+def image_dtype(name_length=1):
+    """
+    Structured dtype of the image records, with the NAME field sized to the longest name.
+    """
+    return np.dtype([
+        ("image_id", "<i8"),
+        ("qvec", "<f8", (4,)),
+        ("tvec", "<f8", (3,)),
+        ("camera_id", "<i8"),
+        ("name", f"U{max(1, name_length)}"),
+    ])
+
+
+def _open_mmap(path):
+    f = open(path, "rb")
+    if os.fstat(f.fileno()).st_size == 0:
+        f.close()
+        raise ValueError(f"Empty COLMAP model file {path}")
+    try:
+        return f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except Exception:
+        f.close()
+        raise
+
+
+def _images_array(records):
+    name_length = max((len(record[-1]) for record in records), default=1)
+    return np.array(records, dtype=image_dtype(name_length))
+
+
+def _cameras_array(records):
+    cameras = np.zeros(len(records), dtype=CAMERA_DTYPE)
+    for i, (camera_id, model, width, height, params) in enumerate(records):
+        cameras[i]["camera_id"] = camera_id
+        cameras[i]["model"] = model
+        cameras[i]["width"] = width
+        cameras[i]["height"] = height
+        cameras[i]["num_params"] = len(params)
+        cameras[i]["params"][:len(params)] = params
+    return cameras
+
+
+def read_cameras_binary(path):
+    f, mm = _open_mmap(path)
+    with f, mm:
+        num_cameras = struct.unpack_from("<Q", mm, 0)[0]
+        offset = 8
+        records = []
+        for _ in range(num_cameras):
+            camera_id, model_id, width, height = _CAMERA_HEADER.unpack_from(mm, offset)
+            offset += _CAMERA_HEADER.size
+            model, num_params = CAMERA_MODELS[model_id]
+            params = struct.unpack_from(f"<{num_params}d", mm, offset)
+            offset += 8 * num_params
+            records.append((camera_id, model, width, height, params))
+    return _cameras_array(records)
+
+
+def read_cameras_text(path):
+    records = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            parts = line.split()
+            records.append((int(parts[0]), parts[1], int(parts[2]), int(parts[3]), [float(p) for p in parts[4:]]))
+    return _cameras_array(records)
+
+
+def iter_images_binary(path):
+    """
+    Yield (image_id, qvec, tvec, camera_id, name) for every image of an images.bin file.
+    The 2D keypoints are skipped by jumping over them in the memory map, they are never decoded.
+    """
+    f, mm = _open_mmap(path)
+    with f, mm:
+        num_images = struct.unpack_from("<Q", mm, 0)[0]
+        offset = 8
+        for _ in range(num_images):
+            image_id, qw, qx, qy, qz, tx, ty, tz, camera_id = _IMAGE_HEADER.unpack_from(mm, offset)
+            offset += _IMAGE_HEADER.size
+            name_end = mm.find(b"\0", offset)
+            name = mm[offset:name_end].decode("utf-8")
+            num_points2D = struct.unpack_from("<Q", mm, name_end + 1)[0]
+            offset = name_end + 9 + num_points2D * _POINT2D_SIZE
+            yield image_id, (qw, qx, qy, qz), (tx, ty, tz), camera_id, name
+
+
+def iter_images_text(path):
+    """
+    Yield (image_id, qvec, tvec, camera_id, name) for every image of an images.txt file.
+    Only the image lines are split, the POINTS2D line following each of them is skipped unparsed.
+    """
+    with open(path, "rb") as f:
+        for line in f:
+            if line.startswith(b"#") or not line.strip():
+                continue
+            image_data = line.decode("utf-8").split()  # IMAGE_ID, QW, QX, QY, QZ, TX, TY, TZ, CAMERA_ID, NAME
+            f.readline()  # POINTS2D, may be an empty line
+            yield (int(image_data[0]), tuple(map(float, image_data[1:5])), tuple(map(float, image_data[5:8])),
+                   int(image_data[8]), " ".join(image_data[9:]))
+
+
+def read_images_binary(path):
+    return _images_array(list(iter_images_binary(path)))
+
+
+def read_images_text(path):
+    return _images_array(list(iter_images_text(path)))
+
+
+def read_points3D_binary(path):
+    """
+    Read points3D.bin without the tracks, which are skipped by jumping over them.
+    """
+    f, mm = _open_mmap(path)
+    with f, mm:
+        num_points = struct.unpack_from("<Q", mm, 0)[0]
+        points = np.zeros(num_points, dtype=POINT3D_DTYPE)
+        offset = 8
+        for i in range(num_points):
+            point3D_id, x, y, z, r, g, b, error = _POINT3D_HEADER.unpack_from(mm, offset)
+            offset += _POINT3D_HEADER.size
+            track_length = struct.unpack_from("<Q", mm, offset)[0]
+            offset += 8 + track_length * _TRACK_ELEMENT_SIZE
+            points[i] = (point3D_id, (x, y, z), (r, g, b), error, track_length)
+    return points
+
+
+def read_points3D_text(path):
+    records = []
+    with open(path, "r") as f:
+        for line in f:
+            if line.startswith("#") or not line.strip():
+                continue
+            # POINT3D_ID, X, Y, Z, R, G, B, ERROR, TRACK[] as (IMAGE_ID, POINT2D_IDX)
+            parts = line.split(maxsplit=8)
+            track_length = len(parts[8].split()) // 2 if len(parts) > 8 else 0
+            records.append((int(parts[0]), tuple(map(float, parts[1:4])), tuple(map(int, parts[4:7])),
+                            float(parts[7]), track_length))
+    return np.array(records, dtype=POINT3D_DTYPE)
+
+
+def _model_file(model_path, name):
+    """
+    Resolve a model file: a path to the file itself, or a model folder containing <name>.txt or <name>.bin
+    (the TXT file wins if both exist, as that is what the scripts always read).
+    """
+    model_path = os.fspath(model_path)
+    if os.path.isfile(model_path):
+        return model_path
+    for ext in (".txt", ".bin"):
+        path = os.path.join(model_path, name + ext)
+        if os.path.isfile(path):
+            return path
+    raise FileNotFoundError(f"Neither {name}.txt nor {name}.bin found in {model_path}")
+
+
+def read_cameras(model_path):
+    """
+    Read cameras.bin or cameras.txt into a structured array (see CAMERA_DTYPE).
+    model_path is a model folder or the path of the file itself.
+    """
+    path = _model_file(model_path, "cameras")
+    return read_cameras_binary(path) if path.endswith(".bin") else read_cameras_text(path)
+
+
+def iter_images(model_path):
+    path = _model_file(model_path, "images")
+    return iter_images_binary(path) if path.endswith(".bin") else iter_images_text(path)
+
+
+def read_images(model_path):
+    """
+    Read images.bin or images.txt into a structured array with the fields image_id, qvec, tvec, camera_id and name.
+    model_path is a model folder or the path of the file itself.
+    """
+    return _images_array(list(iter_images(model_path)))
+
+
+def read_points3D(model_path):
+    path = _model_file(model_path, "points3D")
+    return read_points3D_binary(path) if path.endswith(".bin") else read_points3D_text(path)
+
+
+def camera_params(camera):
+    """
+    The parameters of a camera record, without the padding.
+    """
+    return camera["params"][:camera["num_params"]]
+
+
+def camera_params_string(camera):
+    """
+    Format a camera record like a cameras.txt line without the CAMERA_ID: "MODEL WIDTH HEIGHT PARAMS..."
+    """
+    return " ".join([str(camera["model"]), str(camera["width"]), str(camera["height"])]
+                    + [repr(float(p)) for p in camera_params(camera)])
+
+
+def camera_matrix(camera):
+    """
+    The 3x3 intrinsic matrix of a camera record.
+    """
+    params = camera_params(camera)
+    if str(camera["model"]) in ("SIMPLE_PINHOLE", "SIMPLE_RADIAL", "RADIAL", "SIMPLE_RADIAL_FISHEYE",
+                                "RADIAL_FISHEYE"):
+        fx = fy = params[0]
+        cx, cy = params[1:3]
+    else:
+        fx, fy, cx, cy = params[:4]
+    return np.array([[fx, 0, cx],
+                     [0, fy, cy],
+                     [0, 0, 1]])
+
+
+def make4x4(P):
+    assert P.shape[-1] == 4 or P.shape[-1] == 3
+    assert len(P.shape) == 2
+    assert P.shape[0] == 3 or P.shape[0] == 4
+    ret = np.eye(4)
+    ret[:P.shape[0], :P.shape[1]] = P
+    return ret
+
+
+def quaternion_to_rotation_matrix(qw, qx, qy, qz):
+    R = np.array([
+       [1 - 2*qy**2 - 2*qz**2, 2*qx*qy - 2*qz*qw, 2*qx*qz + 2*qy*qw],
+       [2*qx*qy + 2*qz*qw, 1 - 2*qx**2 - 2*qz**2, 2*qy*qz - 2*qx*qw],
+       [2*qx*qz - 2*qy*qw, 2*qy*qz + 2*qx*qw, 1 - 2*qx**2 - 2*qy**2]
+    ])
+    return R
+
+
+def quaternions_to_rotation_matrices(q):
+    """
+    Vectorized quaternion_to_rotation_matrix for an (N, 4) array of (qw, qx, qy, qz), returns (N, 3, 3).
+    """
+    qw, qx, qy, qz = np.asarray(q, dtype=np.float64).reshape(-1, 4).T
+    R = np.empty((len(qw), 3, 3))
+    R[:, 0, 0] = 1 - 2*qy**2 - 2*qz**2
+    R[:, 0, 1] = 2*qx*qy - 2*qz*qw
+    R[:, 0, 2] = 2*qx*qz + 2*qy*qw
+    R[:, 1, 0] = 2*qx*qy + 2*qz*qw
+    R[:, 1, 1] = 1 - 2*qx**2 - 2*qz**2
+    R[:, 1, 2] = 2*qy*qz - 2*qx*qw
+    R[:, 2, 0] = 2*qx*qz - 2*qy*qw
+    R[:, 2, 1] = 2*qy*qz + 2*qx*qw
+    R[:, 2, 2] = 1 - 2*qx**2 - 2*qy**2
+    return R
+
+
+def rewrite_images_binary(src_path, dst_path, rename):
+    """
+    Copy images.bin to dst_path, replacing every NAME with rename(name).
+    Everything else, including the 2D keypoints, is copied through byte by byte.
+    """
+    f, mm = _open_mmap(src_path)
+    with f, mm, open(dst_path, "wb", buffering=1 << 20) as out:
+        num_images = struct.unpack_from("<Q", mm, 0)[0]
+        out.write(mm[:8])
+        offset = 8
+        for _ in range(num_images):
+            name_start = offset + _IMAGE_HEADER.size
+            name_end = mm.find(b"\0", name_start)
+            num_points2D = struct.unpack_from("<Q", mm, name_end + 1)[0]
+            record_end = name_end + 9 + num_points2D * _POINT2D_SIZE
+
+            out.write(mm[offset:name_start])
+            out.write(rename(mm[name_start:name_end].decode("utf-8")).encode("utf-8"))
+            out.write(mm[name_end:record_end])
+            offset = record_end
+
+
+def _copy_line(src, out, chunk_size=1 << 20):
+    """
+    Copy one line from src to out in chunks, so even a multi-megabyte POINTS2D line is never held in memory at once.
+    """
+    while True:
+        chunk = src.readline(chunk_size)
+        out.write(chunk)
+        if not chunk or chunk.endswith(b"\n"):
+            return
+
+
+def rewrite_images_text(src_path, dst_path, rename):
+    """
+    Stream images.txt to dst_path, replacing the NAME of every image line with rename(name).
+    The POINTS2D line following each image line is copied through untouched, so memory use
+    does not depend on the size of the model.
+    """
+    line_limit = 1 << 20
+    with open(src_path, "rb", buffering=1 << 20) as src, open(dst_path, "wb", buffering=1 << 20) as out:
+        for line in iter(lambda: src.readline(line_limit), b""):
+            if len(line) == line_limit and not line.endswith(b"\n"):
+                # Image lines are short, copy the rest of this one through
+                out.write(line)
+                _copy_line(src, out)
+                continue
+
+            stripped = line.strip()
+            if not stripped or stripped.startswith(b"#"):
+                out.write(line)
+                continue
+
+            parts = stripped.split()
+            if len(parts) >= 10:
+                # IMAGE_ID, QW, QX, QY, QZ, TX, TY, TZ, CAMERA_ID, NAME
+                parts[-1] = rename(parts[-1].decode("utf-8")).encode("utf-8")
+                out.write(b" ".join(parts) + b"\n")
+                _copy_line(src, out)  # second line: 2D keypoints
+            else:
+                out.write(line)
+
+
+def write_model(model_path, cameras, images, ext=".txt"):
+    """
+    Write cameras (CAMERA_DTYPE records) and images (records of image_dtype) as a COLMAP model in TXT or BIN format,
+    with no 2D keypoints and an empty points3D file.
+    """
+    os.makedirs(model_path, exist_ok=True)
+    if ext == ".bin":
+        model_ids = {name: model_id for model_id, (name, _) in CAMERA_MODELS.items()}
+        with open(os.path.join(model_path, "cameras.bin"), "wb") as f:
+            f.write(struct.pack("<Q", len(cameras)))
+            for camera in cameras:
+                f.write(_CAMERA_HEADER.pack(camera["camera_id"], model_ids[str(camera["model"])], camera["width"],
+                                            camera["height"]))
+                f.write(struct.pack(f"<{camera['num_params']}d", *camera_params(camera)))
+        with open(os.path.join(model_path, "images.bin"), "wb") as f:
+            f.write(struct.pack("<Q", len(images)))
+            for image in images:
+                f.write(_IMAGE_HEADER.pack(image["image_id"], *image["qvec"], *image["tvec"], image["camera_id"]))
+                f.write(str(image["name"]).encode("utf-8") + b"\0")
+                f.write(struct.pack("<Q", 0))
+        with open(os.path.join(model_path, "points3D.bin"), "wb") as f:
+            f.write(struct.pack("<Q", 0))
+        return
+
+    with open(os.path.join(model_path, "cameras.txt"), "w") as f:
+        f.write("# Camera list with one line of data per camera:\n")
+        f.write("#   CAMERA_ID, MODEL, WIDTH, HEIGHT, PARAMS[]\n")
+        f.write(f"# Number of cameras: {len(cameras)}\n")
+        for camera in cameras:
+            f.write(f"{camera['camera_id']} {camera_params_string(camera)}\n")
+    with open(os.path.join(model_path, "images.txt"), "w") as f:
+        f.write("# Image list with two lines of data per image:\n")
+        f.write("#   IMAGE_ID, QW, QX, QY, QZ, TX, TY, TZ, CAMERA_ID, NAME\n")
+        f.write("#   POINTS2D[] as (X, Y, POINT3D_ID)\n")
+        for image in images:
+            pose = " ".join(repr(float(v)) for v in (*image["qvec"], *image["tvec"]))
+            f.write(f"{image['image_id']} {pose} {image['camera_id']} {image['name']}\n\n")
+    with open(os.path.join(model_path, "points3D.txt"), "w") as f:
+        f.write("# 3D point list with one line of data per point:\n")
+        f.write("#   POINT3D_ID, X, Y, Z, R, G, B, ERROR, TRACK[] as (IMAGE_ID, POINT2D_IDX)\n")
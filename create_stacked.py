@@ -1,24 +1,41 @@
 import argparse
-import subprocess
+import os
 import shutil
+import sys
 from pathlib import Path
+from dataset_index import DatasetIndex
+from image_cache import add_cache_arguments, open_cache
+from metrics import Progress, add_metrics_arguments, collect_metrics, count, run_subprocess, stage
 
 
-def process_subfolders(parent_folder: Path, target_folder: Path, mode: str):
+def list_view_jpgs(parent_folder: Path, views=None):
+    """
+    Map every subfolder of parent_folder (or only the ones named in views) to its .jpg files
+    (what the "*.jpg" glob matches), from the cached dataset index.
+    """
+    with DatasetIndex(parent_folder) as index:
+        return {parent_folder / name: [parent_folder / name / f.name for f in index.files(name)
+                                       if f.name.endswith(".jpg") and not f.name.startswith(".")]
+                for name in index.subdirs() if views is None or name in views}
+
+
+def process_subfolders(parent_folder: Path, target_folder: Path, mode: str, views=None):
     # Create target folder if it doesn't exist
     target_folder.mkdir(parents=True, exist_ok=True)
 
+    with stage("list"):
+        image_lists = list_view_jpgs(parent_folder, views)
+
     # Loop through subfolders
-    for subfolder in parent_folder.iterdir():
-        if subfolder.is_dir():
+    progress = Progress(len(image_lists), "Stacked", "folders")
+    with stage("stack"):
+        for subfolder, jpg_files in image_lists.items():
+            progress.update()
             try:
-                jpg_files = list(subfolder.glob("*.jpg"))
                 if not jpg_files:
-                    print(f"Skipping {subfolder} (no .jpg files found)\n")
+                    progress.print(f"Skipping {subfolder} (no .jpg files found)")
                     continue
 
-                print(f"Processing folder: {subfolder}\n")
-
                 # Construct ImageMagick command
                 command = [
                     "magick",
@@ -28,7 +45,8 @@ def process_subfolders(parent_folder: Path, target_folder: Path, mode: str):
                 ]
 
                 # Run in the subfolder's directory
-                subprocess.run(command, shell=True, cwd=subfolder, check=True)
+                run_subprocess(command, shell=True, cwd=subfolder, check=True)
+                count(files_read=len(jpg_files), files_written=1)
 
                 # Rename stacked.jpg → {subfolder_name}.jpg
                 old_path = subfolder / "stacked.jpg"
@@ -38,19 +56,98 @@ def process_subfolders(parent_folder: Path, target_folder: Path, mode: str):
 
                 # Move to target folder
                 shutil.move(str(new_path), target_folder / new_filename)
-                print(f"Moved {new_filename} to {target_folder}\n")
 
             except Exception as e:
-                print(f"An error occurred in folder {subfolder}: {e}")
+                progress.print(f"An error occurred in folder {subfolder}: {e}")
+    progress.close()
 
 
-if __name__ == "__main__":
+def process_subfolders_native(parent_folder: Path, target_folder: Path, mode: str, jobs: int, quality: int,
+                              percentile: float = None, memory_budget: int = None, max_memory: int = None,
+                              tmp_dir: Path = None, views=None, cache=None):
+    # Imported here so the ImageMagick path keeps working without OpenCV installed
+    from stacking import DEFAULT_MEMORY_BUDGET, PERCENTILE_MODES, STACK_MODES, stack_subfolders
+
+    if mode not in STACK_MODES + PERCENTILE_MODES:
+        print(f"Error: mode '{mode}' is not supported by the native engine ({', '.join(STACK_MODES + PERCENTILE_MODES)}).")
+        sys.exit(1)
+    if mode == "percentile" and (percentile is None or not 0 <= percentile <= 100):
+        print("Error: --mode percentile requires --percentile between 0 and 100.")
+        sys.exit(1)
+
+    target_folder.mkdir(parents=True, exist_ok=True)
+    with stage("list"):
+        image_lists = list_view_jpgs(parent_folder, views)
+
+    stacked_folders = stack_subfolders(list(image_lists), target_folder, mode, jobs, quality, percentile,
+                                       memory_budget or DEFAULT_MEMORY_BUDGET, max_memory, tmp_dir, image_lists,
+                                       cache)
+    num_errors = 0
+    progress = Progress(len(image_lists), f"Stacked into {target_folder}", "folders")
+    with stage("stack"):
+        for subfolder, num_images, error in stacked_folders:
+            if error is not None:
+                num_errors += 1
+                progress.print(f"An error occurred in folder {subfolder}: {error}")
+            elif num_images == 0:
+                progress.print(f"Skipping {subfolder} (no .jpg files found)")
+            progress.update()
+    progress.close()
+    if num_errors:
+        # A partial run must not count as done (e.g. by pipeline.py, which would skip the stage next time)
+        print(f"{num_errors} folders failed.")
+        sys.exit(1)
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Stack JPGs in each subfolder using ImageMagick.")
     parser.add_argument("parent_folder", type=Path, help="Path to the parent folder containing subfolders.")
     parser.add_argument("target_folder", type=Path, help="Path to the folder where results will be stored.")
     parser.add_argument("--mode", type=str, default="max",
                         help="ImageMagick evaluate-sequence mode (e.g., max, mean, min). Default: max")
+    parser.add_argument("--engine", choices=["magick", "native"], default="magick",
+                        help="Stack with one ImageMagick process per folder or in-process with a worker pool "
+                             "(native supports max, min, mean, add, median and percentile). Default: magick")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                        help="Number of view folders stacked in parallel by the native engine. Default: all cores")
+    parser.add_argument("--quality", type=int, default=100,
+                        help="JPEG quality of the stacked images written by the native engine. Default: 100")
+    parser.add_argument("--percentile", type=float,
+                        help="Percentile (0-100) computed per pixel by the native 'percentile' mode, e.g. 90.")
+    parser.add_argument("--memory_budget", type=str, default="1G",
+                        help="Memory per view for the native median/percentile modes. Views whose lights don't fit "
+                             "are spilled to disk and reduced in horizontal strips. Default: 1G")
+    parser.add_argument("--max_memory", type=str,
+                        help="Global memory cap for the native median/percentile modes, limits how many views "
+                             "are stacked concurrently, e.g. 16G.")
+    parser.add_argument("--tmp_dir", type=Path,
+                        help="Folder for the spill files of the median/percentile modes. Default: system temp folder")
+    parser.add_argument("--views", nargs="+",
+                        help="Only stack these subfolders (names), e.g. the views that changed. Default: all")
+
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args(argv)
+    if args.cache and args.engine != "native":
+        parser.error("--cache requires --engine native.")
 
-    args = parser.parse_args()
+    with collect_metrics(args, "create_stacked"):
+        if args.engine == "native":
+            from stacking import parse_size
 
-    process_subfolders(args.parent_folder, args.target_folder, args.mode)
+            cache = open_cache(args)
+            try:
+                process_subfolders_native(args.parent_folder, args.target_folder, args.mode.lower(), args.jobs,
+                                          args.quality, args.percentile, parse_size(args.memory_budget),
+                                          parse_size(args.max_memory) if args.max_memory else None, args.tmp_dir,
+                                          args.views, cache)
+            finally:
+                if cache is not None:
+                    cache.close()
+        else:
+            process_subfolders(args.parent_folder, args.target_folder, args.mode, args.views)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 import argparse
 from pathlib import Path
+from metrics import add_metrics_arguments, collect_metrics
 
 
 def create_folders(parent_dir: Path, n: int, start: int):
@@ -7,23 +8,31 @@ def create_folders(parent_dir: Path, n: int, start: int):
         print(f"The specified directory {parent_dir} does not exist.")
         return
 
+    created = 0
     for i in range(start, start + n):
         folder_name = f"view_{i:02d}.data"
         folder_path = parent_dir / folder_name
 
         if not folder_path.exists():
             folder_path.mkdir(parents=True)
-            print(f"Created folder: {folder_path}")
-        else:
-            print(f"Folder already exists: {folder_path}")
+            created += 1
 
+    print(f"Created {created} folders in {parent_dir} ({n - created} already existed)")
 
-if __name__ == "__main__":
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Create sequentially numbered folders.")
     parser.add_argument("parent_directory", type=Path, help="Path to the parent directory.")
     parser.add_argument("num_folders", type=int, help="Number of folders to create.")
     parser.add_argument("--start", type=int, default=0, help="Starting index for folder numbering (default: 0)")
 
-    args = parser.parse_args()
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args(argv)
 
-    create_folders(args.parent_directory, args.num_folders, args.start)
+    with collect_metrics(args, "create_view_folders"):
+        create_folders(args.parent_directory, args.num_folders, args.start)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+import re
+import time
+from collections import namedtuple
+from pathlib import Path
+
+# Extension sets shared by all scripts (compared case-insensitively)
+IMAGE_EXTENSIONS = {
+    ".jpg", ".jpeg", ".jfif", ".png", ".gif", ".tiff", ".tif", ".bmp",
+    ".webp", ".heic", ".heif", ".avif", ".jp2", ".j2k", ".jpf",
+    ".jpx", ".jpm", ".svg", ".jxl"
+}
+# Formats COLMAP can read, for the scripts that feed images to it
+COLMAP_IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp", ".gif", ".webp", ".avif", ".jxl"}
+JPEG_EXTENSIONS = {".jpg", ".jpeg", ".jfif"}
+MASK_EXTENSIONS = {".png"}
+MASK_NAME = "mask.png"
+
+# Directories modified this recently are rescanned next time, their mtime may not have ticked yet
+_RACY_SECONDS = 2.0
+
+FileEntry = namedtuple("FileEntry", ["name", "size", "mtime_ns"])
+View = namedtuple("View", ["name", "path", "images", "mask"])
+
+
+def natural_key(name):
+    """
+    Sort key ordering embedded numbers by value ("view_2" < "view_10"), like natsort's default.
+    """
+    parts = re.split(r"(\d+)", name)
+    return [int(part) if i % 2 else part for i, part in enumerate(parts)]
+
+
+def has_extension(name, extensions):
+    return os.path.splitext(name)[1].lower() in extensions
+
+
+def _cache_dir():
+    if os.environ.get("MVPS_INDEX_CACHE_DIR"):
+        return Path(os.environ["MVPS_INDEX_CACHE_DIR"])
+    base = os.environ.get("XDG_CACHE_HOME") or os.environ.get("LOCALAPPDATA") or os.path.expanduser("~/.cache")
+    return Path(base) / "mvps_scripts" / "index"
+
+
+class DatasetIndex:
+    """
+    Cached listing of a dataset tree built with os.scandir.
+    Every directory is stored with its mtime, its naturally sorted subdirectories and its files
+    (name, size, mtime). A cached directory is reused as long as its own mtime is unchanged, so
+    re-listing a tree costs one stat per directory instead of one per file. Files rewritten in place
+    (without being added, removed or renamed) don't change the directory mtime, so their size and
+    mtime can be stale; names and order are always current.
+    The cache lives outside the dataset (MVPS_INDEX_CACHE_DIR, default ~/.cache/mvps_scripts/index),
+    so writing it doesn't invalidate the root directory.
+    """
+
+    def __init__(self, root, use_cache=True):
+        self.root = Path(root).resolve()
+        self.use_cache = use_cache
+        self.cache_path = _cache_dir() / (hashlib.sha1(str(self.root).encode("utf-8")).hexdigest() + ".json")
+        self._dirs = {}
+        self._dirty = False
+        if use_cache and self.cache_path.exists():
+            try:
+                with open(self.cache_path, "r") as f:
+                    self._dirs = json.load(f)
+            except (OSError, ValueError):
+                self._dirs = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.save()
+
+    def save(self):
+        if not (self.use_cache and self._dirty):
+            return
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.cache_path.with_name(f"{self.cache_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self._dirs, f)
+        os.replace(tmp_path, self.cache_path)
+        self._dirty = False
+
+    def _listing(self, rel):
+        rel = Path(rel).as_posix() if rel else "."
+        path = self.root / rel
+        mtime_ns = os.stat(path).st_mtime_ns
+        cached = self._dirs.get(rel)
+        if cached is not None and cached["mtime_ns"] == mtime_ns:
+            return cached
+
+        files, dirs = [], []
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir():
+                    dirs.append(entry.name)
+                elif entry.is_file():
+                    st = entry.stat()
+                    files.append((entry.name, st.st_size, st.st_mtime_ns))
+        files.sort(key=lambda f: natural_key(f[0]))
+        dirs.sort(key=natural_key)
+
+        racy = time.time_ns() - mtime_ns < _RACY_SECONDS * 1e9
+        listing = {"mtime_ns": None if racy else mtime_ns, "files": files, "dirs": dirs}
+        self._dirs[rel] = listing
+        self._dirty = True
+        return listing
+
+    def files(self, rel="", extensions=None):
+        """
+        Naturally sorted FileEntry list of the files in root/rel, optionally filtered by extension.
+        """
+        return [FileEntry(*f) for f in self._listing(rel)["files"]
+                if extensions is None or has_extension(f[0], extensions)]
+
+    def file_paths(self, rel="", extensions=None):
+        folder = self.root / rel if rel else self.root
+        return [folder / f.name for f in self.files(rel, extensions)]
+
+    def subdirs(self, rel=""):
+        """
+        Naturally sorted names of the subdirectories of root/rel.
+        """
+        return list(self._listing(rel)["dirs"])
+
+    def walk(self, rel=""):
+        """
+        Yield (rel, subdirs, files) for root/rel and all directories below it, top-down.
+        """
+        listing = self._listing(rel)
+        yield rel, list(listing["dirs"]), [FileEntry(*f) for f in listing["files"]]
+        for name in listing["dirs"]:
+            yield from self.walk(f"{rel}/{name}" if rel else name)
+
+    def views(self, extensions=IMAGE_EXTENSIONS):
+        """
+        The view folders of the dataset: every subdirectory of root with its light images
+        (naturally sorted) and its mask.png, if any.
+        """
+        views = []
+        for name in self.subdirs():
+            files = self.files(name)
+            images = [f for f in files if f.name != MASK_NAME and has_extension(f.name, extensions)]
+            mask = next((f for f in files if f.name == MASK_NAME), None)
+            views.append(View(name, self.root / name, images, mask))
+        return views
+
+
+def list_files(folder, extensions=None):
+    """
+    Naturally sorted paths of the files in folder (optionally filtered by extension), through the cached index.
+    """
+    with DatasetIndex(folder) as index:
+        return index.file_paths("", extensions)
+
+
+def list_subdirs(folder):
+    """
+    Naturally sorted paths of the subdirectories of folder, through the cached index.
+    """
+    with DatasetIndex(folder) as index:
+        return [index.root / name for name in index.subdirs()]
+
+
+def list_views(root, extensions=IMAGE_EXTENSIONS):
+    with DatasetIndex(root) as index:
+        return index.views(extensions)
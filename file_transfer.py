@@ -0,0 +1,96 @@
+import errno
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+LINK_MODES = ("copy", "hardlink", "reflink", "symlink")
+
+# Linux FICLONE ioctl, shares the data blocks of two files on btrfs, XFS, bcachefs, ...
+_FICLONE = 0x40049409
+
+
+def _copy(src, dst):
+    """
+    Copy data and metadata like shutil.copy2, using the kernel-side copy_file_range where available
+    (it turns into a server-side copy on NFS 4.2 and a reflink on some filesystems).
+    """
+    if hasattr(os, "copy_file_range"):
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            if remaining == 0:
+                shutil.copystat(src, dst)
+                return "copy"
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+                raise
+    # shutil uses sendfile on Linux and fcopyfile on macOS
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+def _reflink(src, dst):
+    if sys.platform.startswith("linux"):
+        import fcntl
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        shutil.copystat(src, dst)
+        return "reflink"
+    if sys.platform == "darwin":
+        # APFS clones
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), dst)
+        return "reflink"
+    raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported on this platform", dst)
+
+
+def transfer_file(src, dst, link_mode="copy"):
+    """
+    Place src at dst with the requested link mode, replacing an existing dst.
+    Falls back to a copy when the filesystem does not support the mode (e.g. hardlinks across devices,
+    reflinks on ext4 or symlinks on Windows without the privilege).
+    Returns the mode that was actually used.
+    """
+    src, dst = os.fspath(src), os.fspath(dst)
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    try:
+        if link_mode == "hardlink":
+            os.link(src, dst)
+            return "hardlink"
+        if link_mode == "symlink":
+            os.symlink(os.path.abspath(src), dst)
+            return "symlink"
+        if link_mode == "reflink":
+            return _reflink(src, dst)
+    except (OSError, NotImplementedError):
+        if os.path.lexists(dst):
+            os.remove(dst)
+    return _copy(src, dst)
+
+
+def transfer_files(pairs, link_mode="copy", jobs=None):
+    """
+    Transfer many (src, dst) pairs concurrently with a thread pool.
+    The work happens in the kernel, so threads overlap the I/O without being limited by the GIL.
+    Returns a dict counting how many files were placed with each mode.
+    """
+    if link_mode not in LINK_MODES:
+        raise ValueError(f"Unknown link mode '{link_mode}', expected one of {', '.join(LINK_MODES)}")
+
+    counts = {}
+    jobs = jobs or min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for mode in executor.map(lambda pair: transfer_file(pair[0], pair[1], link_mode), pairs):
+            counts[mode] = counts.get(mode, 0) + 1
+    return counts
@@ -0,0 +1,95 @@
+from dataset_index import COLMAP_IMAGE_EXTENSIONS, DatasetIndex
+from colmap_io import rewrite_images_binary, rewrite_images_text
+from file_transfer import transfer_files
+from flatten_manifest import sync_flat_outputs
+from metrics import count
+
+# Helpers shared by flatten_colmap_model.py, flatten_colmap_model_2.py and flatten_colmap_model_masks.py
+
+
+def confirm(prompt, default=False):
+    suffix = " [Y/n]: " if default else " [y/N] "
+    reply = input(prompt + suffix).strip().lower()
+    if not reply:
+        return default
+    return reply in ['y', 'yes']
+
+
+def collect_images(dataset_path):
+    all_images = []
+    with DatasetIndex(dataset_path) as index:
+        for folder_name in index.subdirs():
+            folder = dataset_path / folder_name
+            image_files = [folder / f.name for f in index.files(folder_name, COLMAP_IMAGE_EXTENSIONS)]
+            sorted_images = sorted(image_files)
+            for image_path in sorted_images:
+                rel_path = image_path.relative_to(dataset_path).as_posix().lower()
+                all_images.append((rel_path, image_path))
+
+    return all_images
+
+
+def generate_digit_format(n):
+    return max(2, len(str(n - 1)))
+
+
+def flatten_images(image_list, output_folder, link_mode="copy", jobs=None, incremental=False):
+    output_folder.mkdir(parents=True, exist_ok=True)
+    digit_count = generate_digit_format(len(image_list))
+    mapping = {}
+    transfers = []
+
+    for idx, (rel_path, full_path) in enumerate(image_list):
+        ext = full_path.suffix.lower()
+        new_name = f"{idx:0{digit_count}d}{ext}"
+        dest_path = output_folder / new_name
+        transfers.append((full_path, dest_path))
+        mapping[rel_path] = new_name
+
+    if incremental:
+        # Only new or changed files are placed, outputs without a source are removed
+        counts = sync_flat_outputs(transfers, output_folder, link_mode, jobs)
+        count(**{f"files_{state}": n for state, n in counts.items()})
+        print(f"[i] Synced {len(transfers)} files ({', '.join(f'{n} {state}' for state, n in counts.items())}).")
+        return mapping
+
+    counts = transfer_files(transfers, link_mode, jobs)
+    count(**{f"files_{state}": n for state, n in counts.items()})
+    print(f"[i] Placed {len(transfers)} files ({', '.join(f'{n} {mode}' for mode, n in counts.items())}).")
+    return mapping
+
+
+def mapped_name(mapping):
+    def rename(image_name):
+        if image_name.lower() in mapping:
+            return mapping[image_name.lower()]
+        print(f"Warning: '{image_name.lower()}' not found in mapping!")
+        return image_name
+    return rename
+
+
+def images_flat_path(images_txt_path):
+    if images_txt_path.suffix.lower() == ".bin":
+        return images_txt_path.parent / "images_flat.bin"
+    return images_txt_path.parent / "images_flat.txt"
+
+
+def update_images_txt(images_txt_path, mapping):
+    # mapping is either a dict of lower-case original names or a callable returning the new name
+    rename = mapping if callable(mapping) else mapped_name(mapping)
+
+    # Single streaming pass, the 2D keypoints are copied through and never held in memory
+    output_file = images_flat_path(images_txt_path)
+    if images_txt_path.suffix.lower() == ".bin":
+        rewrite_images_binary(images_txt_path, output_file, rename)
+    else:
+        rewrite_images_text(images_txt_path, output_file, rename)
+
+    print(f"[✓] Updated {images_txt_path.name} saved to: {output_file}")
+
+
+def write_log(log_path, mapping):
+    with open(log_path, 'w') as f:
+        for orig, new in mapping.items():
+            f.write(f"{orig} -> {new}\n")
+    print(f"[✓] Mapping log saved to: {log_path}")
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from file_transfer import transfer_file
+
+MANIFEST_NAME = ".flatten_manifest.json"
+
+# How many finished transfers are recorded before the manifest is written out again
+_SAVE_INTERVAL = 500
+
+
+def _signature(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+class FlattenManifest:
+    """
+    Record of the files placed in a flattened output folder.
+    entries maps the output path relative to the folder (e.g. "05.jpg", "masks/05.png") to the source
+    path, size, mtime and link mode (requested and actually used) it was created from. images_txt describes the last written images_flat file.
+    """
+
+    def __init__(self, output_folder):
+        self.output_folder = Path(output_folder)
+        self.path = self.output_folder / MANIFEST_NAME
+        self.entries = {}
+        self.images_txt = None
+        if self.path.exists():
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            self.entries = data.get("entries", {})
+            self.images_txt = data.get("images_txt")
+
+    def save(self):
+        self.output_folder.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"entries": self.entries, "images_txt": self.images_txt}, f)
+        os.replace(tmp_path, self.path)
+
+    def is_current(self, rel, src, signature, link_mode):
+        entry = self.entries.get(rel)
+        return (entry is not None and entry["src"] == src and (entry["size"], entry["mtime_ns"]) == signature
+                and entry["requested_mode"] == link_mode and os.path.lexists(self.output_folder / rel))
+
+    def record(self, rel, src, signature, link_mode, requested_mode):
+        self.entries[rel] = {"src": src, "size": signature[0], "mtime_ns": signature[1],
+                             "link_mode": link_mode, "requested_mode": requested_mode}
+
+
+def sync_flat_outputs(transfers, output_folder, link_mode="copy", jobs=None):
+    """
+    Bring output_folder in line with the planned (src, dst) transfers, touching only what changed:
+    - outputs whose source path, size, mtime and link mode match the manifest are kept,
+    - outputs that are still needed under a different flat name are renamed instead of copied again,
+    - outputs without a source anymore are deleted,
+    - everything else is transferred.
+    The manifest is saved after every phase and periodically while transferring, so an interrupted
+    run resumes where it stopped. Returns a dict with the number of kept, moved, deleted and transferred files.
+    """
+    output_folder = Path(output_folder)
+    manifest = FlattenManifest(output_folder)
+
+    plan = {}
+    for src, dst in transfers:
+        src = os.path.abspath(src)
+        plan[Path(dst).relative_to(output_folder).as_posix()] = (src, _signature(src))
+
+    keep = {rel for rel, (src, signature) in plan.items() if manifest.is_current(rel, src, signature, link_mode)}
+
+    # Existing outputs that can be reused under another name, by source identity
+    reusable = {}
+    for rel, entry in manifest.entries.items():
+        if rel not in keep and entry["requested_mode"] == link_mode and os.path.lexists(output_folder / rel):
+            reusable.setdefault((entry["src"], entry["size"], entry["mtime_ns"]), []).append(rel)
+
+    moves = []
+    pending = []
+    for rel, (src, signature) in plan.items():
+        if rel in keep:
+            continue
+        candidates = reusable.get((src,) + signature)
+        if candidates:
+            moves.append((candidates.pop(), rel))
+        else:
+            pending.append(rel)
+
+    # Phase 1: move reused outputs out of the way to temporary names, so renames can't collide
+    staged = []
+    for old_rel, new_rel in moves:
+        source_key = hashlib.sha1(manifest.entries[old_rel]["src"].encode("utf-8")).hexdigest()[:12]
+        tmp_rel = (Path(new_rel).parent / f".{Path(new_rel).name}.{source_key}.reuse").as_posix()
+        os.replace(output_folder / old_rel, output_folder / tmp_rel)
+        manifest.entries[tmp_rel] = manifest.entries.pop(old_rel)
+        staged.append((tmp_rel, new_rel))
+    manifest.save()
+
+    # Phase 2: delete outputs that no longer have a source, and forget the ones about to be overwritten
+    deleted = 0
+    staged_rels = {tmp_rel for tmp_rel, _ in staged}
+    for rel in list(manifest.entries):
+        if rel in keep or rel in staged_rels:
+            continue
+        if rel not in plan and os.path.lexists(output_folder / rel):
+            os.remove(output_folder / rel)
+            deleted += 1
+        del manifest.entries[rel]
+    manifest.save()
+
+    # Phase 3: move the reused outputs to their new names
+    for tmp_rel, new_rel in staged:
+        os.replace(output_folder / tmp_rel, output_folder / new_rel)
+        manifest.entries[new_rel] = manifest.entries.pop(tmp_rel)
+    manifest.save()
+
+    # Phase 4: transfer new and changed files
+    for folder in {(output_folder / rel).parent for rel in pending}:
+        folder.mkdir(parents=True, exist_ok=True)
+
+    def place(rel):
+        src, _ = plan[rel]
+        return rel, transfer_file(src, output_folder / rel, link_mode)
+
+    try:
+        workers = jobs or min(32, (os.cpu_count() or 1) * 4)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for i, (rel, used_mode) in enumerate(executor.map(place, pending), start=1):
+                src, signature = plan[rel]
+                manifest.record(rel, src, signature, used_mode, link_mode)
+                if i % _SAVE_INTERVAL == 0:
+                    manifest.save()
+    finally:
+        manifest.save()
+
+    return {"kept": len(keep), "moved": len(moves), "deleted": deleted, "transferred": len(pending)}
+
+
+def mapping_digest(mapping):
+    return hashlib.sha1(json.dumps(sorted(mapping.items())).encode("utf-8")).hexdigest()
+
+
+def images_txt_is_current(output_folder, images_txt_path, output_file, mapping):
+    """
+    Whether output_file was written by a previous run from the same images.txt and the same mapping.
+    """
+    state = FlattenManifest(output_folder).images_txt
+    if state is None or not os.path.exists(output_file) or not os.path.exists(images_txt_path):
+        return False
+    return state == _images_txt_state(images_txt_path, output_file, mapping)
+
+
+def record_images_txt(output_folder, images_txt_path, output_file, mapping):
+    manifest = FlattenManifest(output_folder)
+    manifest.images_txt = _images_txt_state(images_txt_path, output_file, mapping)
+    manifest.save()
+
+
+def _images_txt_state(images_txt_path, output_file, mapping):
+    source_size, source_mtime = _signature(images_txt_path)
+    output_size, output_mtime = _signature(output_file)
+    return {"source": os.path.abspath(images_txt_path), "source_size": source_size, "source_mtime_ns": source_mtime,
+            "output": os.path.abspath(output_file), "output_size": output_size, "output_mtime_ns": output_mtime,
+            "mapping": mapping_digest(mapping)}
@@ -1,101 +1,142 @@
 import os
-import pyexr
-import numpy as np
-import shutil
+import time
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from colmap_io import iter_images, quaternion_to_rotation_matrix
+from metrics import Progress, add_metrics_arguments, collect_metrics, count, stage
 
-def make4x4(P):
-    assert P.shape[-1] == 4 or P.shape[-1] == 3
-    assert len(P.shape) == 2
-    assert P.shape[0] == 3 or P.shape[0] == 4
-    ret = np.eye(4)
-    ret[:P.shape[0], :P.shape[1]] = P
-    return ret
-
-
-def quaternion_to_rotation_matrix(qw, qx, qy, qz):
-    R = np.array([
-       [1 - 2*qy**2 - 2*qz**2, 2*qx*qy - 2*qz*qw, 2*qx*qz + 2*qy*qw],
-       [2*qx*qy + 2*qz*qw, 1 - 2*qx**2 - 2*qz**2, 2*qy*qz - 2*qx*qw],
-       [2*qx*qz - 2*qy*qw, 2*qy*qz + 2*qx*qw, 1 - 2*qx**2 - 2*qy**2]
-    ])
-    return R
-
-
-parser = argparse.ArgumentParser()
-parser.add_argument("--colmap_path", type=str, required=True)
-parser.add_argument("--sdm_unips_result_dir", type=str, required=True)
-parser.add_argument("--data_dir", type=str, required=True)
-args = parser.parse_args()
-
-
-# Create file paths
-cameras_txt_path = os.path.join(args.colmap_path, "cameras.txt")
-images_txt_path = os.path.join(args.colmap_path, "images.txt")
-
-# Load camera intrinsics from cameras.txt
-with open(cameras_txt_path, 'r') as f:
-    camera_lines = [line.strip() for line in f if not line.startswith('#') and line.strip()]
-camera_data = camera_lines[0].split()
-
-# Focal distance and principal point
-fx, fy, cx, cy = map(float, camera_data[4:8])
-
-# Camera matrix
-K = np.array([[fx, 0, cx],
-              [0, fy, cy], 
-              [0, 0, 1]])
-
-
-# Load camera extrinsics from images.txt (World-to-Camera transforms)
-with open(images_txt_path, 'r') as f:
-    image_lines = [line.strip() for line in f if not line.startswith('#') and line.strip()]
-
-# Remove every second line from image_lines (skip the 2D points for each image)
-image_lines = image_lines[::2]
-
-# Create directories for gathered and converted normal maps in the data_dir
-normal_map_camera_dir = os.path.join(args.data_dir, "normal_camera_space_sdmunips")
-normal_map_world_dir = os.path.join(args.data_dir, "normal_world_space_sdmunips")
-os.makedirs(normal_map_camera_dir, exist_ok=True)
-os.makedirs(normal_map_world_dir, exist_ok=True)
-
-# Create a list of W2C transforms from colmap model
-W2C_list = []
-for line in image_lines:
-    image_data = line.split() # IMAGE_ID, QW, QX, QY, QZ, TX, TY, TZ, CAMERA_ID, NAME
-    qw, qx, qy, qz = map(float, image_data[1:5])
-    tx, ty, tz = map(float, image_data[5:8])
-    filename = image_data[-1]
-    view_id = os.path.splitext(filename)[0]
-    R = quaternion_to_rotation_matrix(qw, qx, qy, qz)
-    t = np.array([tx, ty, tz]).reshape([3, 1])
-    
-    W2C = np.zeros((4, 4))
-    W2C[3, 3] = 1
-    W2C[:3, :3] = R
-    W2C[:3, [3]] = t
-
-    # Get the Camera-to-World transform from World-to-Camera transform
-    C2W = np.linalg.inv(W2C)
-    # Get the rotation matrix from Camera-to-World transform
-    R = C2W[:3, :3]
+def load_view_rotations(colmap_path):
+    """
+    Load the Camera-to-World rotation of every view from a COLMAP model in TXT or BIN format.
+    Returns a list of (view_id, R) tuples.
+    """
+    views = []
+    # Load camera extrinsics from images.bin or images.txt (World-to-Camera transforms)
+    for _, qvec, _, _, filename in iter_images(colmap_path):
+        qw, qx, qy, qz = qvec
+        view_id = os.path.splitext(filename)[0]
+
+        # The rotation of the Camera-to-World transform is the transpose of the World-to-Camera rotation
+        R = quaternion_to_rotation_matrix(qw, qx, qy, qz).T
+        views.append((view_id, R))
+
+    return views
 
-    # Get the name of subfolder in the results folder for the current view
-    view_dir = os.path.join(args.sdm_unips_result_dir, f"view_{view_id}.data")
-    
-    # Copy the normal map from subfolder to normal_camera_space_sdmunips dir
-    normal_map_file = os.path.join(view_dir, "normal.exr")
-    new_normal_map_file = os.path.join(normal_map_camera_dir, f"{view_id}.exr")
-    shutil.copy(normal_map_file, new_normal_map_file)
 
-    # Convert the normal map to world space
-    normal_map_camera = pyexr.read(new_normal_map_file)
-    normal_map_camera[..., [1, 2]] *= -1 # revert y and z axis to match opencv conversion, X right, Y down, Z front
-    H, W = normal_map_camera.shape[:2]
-    normal_world = (R @ normal_map_camera.reshape(-1, 3).T).T.reshape([H, W, 3])
+def init_worker(exr_threads):
+    # Imported here so that only the workers that convert normal maps load pyexr
+    from normal_maps import set_exr_threads
+    set_exr_threads(exr_threads)
 
-    # Save the world space normal map
-    normal_map_world_file = os.path.join(normal_map_world_dir, f"{view_id}.exr")
-    pyexr.write(normal_map_world_file, normal_world) 
 
+def convert_view(view_id, R, sdm_unips_result_dir, normal_map_camera_dir, normal_map_world_dir,
+                 precision="float", compression="piz", pack_dir=None, pack_index=None, mask_mode="none",
+                 normal_map_sparse_dir=None):
+    # Imported here so that only the workers that convert normal maps load pyexr
+    from normal_maps import convert_normal_map
+
+    # Get the name of subfolder in the results folder for the current view
+    view_dir = os.path.join(sdm_unips_result_dir, f"view_{view_id}.data")
+
+    normal_map_file = os.path.join(view_dir, "normal.exr")
+    new_normal_map_file = os.path.join(normal_map_camera_dir, f"{view_id}.exr")
+    normal_map_world_file = os.path.join(normal_map_world_dir, f"{view_id}.exr") if normal_map_world_dir else None
+    normal_map_sparse_file = os.path.join(normal_map_sparse_dir, f"{view_id}.npz") if normal_map_sparse_dir else None
+    mask_file = os.path.join(view_dir, "mask.png")
+    return convert_normal_map(normal_map_file, new_normal_map_file, normal_map_world_file, R, precision, compression,
+                              mask_file, pack_dir, pack_index, mask_mode, normal_map_sparse_file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--colmap_path", type=str, required=True)
+    parser.add_argument("--sdm_unips_result_dir", type=str, required=True)
+    parser.add_argument("--data_dir", type=str, required=True)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Number of views converted in parallel")
+    parser.add_argument("--precision", choices=["half", "float"], default="float",
+                        help="Pixel type of the world-space normal maps (default: float)")
+    parser.add_argument("--compression", choices=["none", "zip", "piz", "dwaa"], default="piz",
+                        help="Compression of the world-space normal maps (default: piz)")
+    parser.add_argument("--exr_threads", type=int,
+                        help="OpenEXR threads per worker compressing/decompressing a file "
+                             "(default: the cores left over by --jobs, at least 1)")
+    parser.add_argument("--mask_mode", choices=["none", "zero", "nan"], default="none",
+                        help="Only rotate the foreground pixels of each view's mask.png and write 0 or NaN as the "
+                             "world-space normal of the background (default: none, every pixel is rotated)")
+    parser.add_argument("--world_format", choices=["exr", "sparse", "both"], default="exr",
+                        help="Write the world-space normals as EXR, as sparse .npz files with the flat indices and "
+                             "normals of the foreground pixels (normal_world_space_sdmunips_sparse), or both (default: exr)")
+    parser.add_argument("--pack", action="store_true",
+                        help="Also export a training pack to <data_dir>/training_pack: all world-space normals in one "
+                             "memory-mapped [V,H,W,3] array, the bit-packed masks and the cameras (needs the "
+                             "cameras_sphere written by colmap2neus in colmap_path)")
+    parser.add_argument("--pack_dtype", choices=["float16", "float32"], default="float32",
+                        help="Data type of the packed normals (default: float32)")
+    add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+
+    with collect_metrics(args, "gather_and_convert_normal_map_colmap"):
+        with stage("read_model"):
+            views = load_view_rotations(args.colmap_path)
+
+        # Create directories for gathered and converted normal maps in the data_dir
+        normal_map_camera_dir = os.path.join(args.data_dir, "normal_camera_space_sdmunips")
+        normal_map_world_dir = os.path.join(args.data_dir, "normal_world_space_sdmunips")
+        normal_map_sparse_dir = os.path.join(args.data_dir, "normal_world_space_sdmunips_sparse")
+        if args.world_format == "exr":
+            normal_map_sparse_dir = None
+        elif args.world_format == "sparse":
+            normal_map_world_dir = None
+        os.makedirs(normal_map_camera_dir, exist_ok=True)
+        for folder in (normal_map_world_dir, normal_map_sparse_dir):
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+
+        pack_dir = None
+        if args.pack:
+            # The pack is sized from the header of the first normal map
+            import pyexr
+            from training_pack import PACK_DIR_NAME, create_training_pack
+
+            first_normal_map = pyexr.open(os.path.join(args.sdm_unips_result_dir, f"view_{views[0][0]}.data", "normal.exr"))
+            pack_dir = os.path.join(args.data_dir, PACK_DIR_NAME)
+            create_training_pack(pack_dir, [view_id for view_id, _ in views], first_normal_map.height,
+                                 first_normal_map.width, args.pack_dtype)
+
+        # Each view is read once, the camera-space copy and the world-space normal map are written from the same buffer
+        start_time = time.perf_counter()
+        bytes_read = bytes_written = view_seconds = 0
+        exr_threads = args.exr_threads or max(1, (os.cpu_count() or 1) // max(1, args.jobs))
+        progress = Progress(len(views), "Converted", "normal maps")
+        with stage("convert"), ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker,
+                                                   initargs=(exr_threads,)) as executor:
+            futures = [executor.submit(convert_view, view_id, R, args.sdm_unips_result_dir, normal_map_camera_dir,
+                                       normal_map_world_dir, args.precision, args.compression, pack_dir, index,
+                                       args.mask_mode, normal_map_sparse_dir)
+                       for index, (view_id, R) in enumerate(views)]
+            for future in futures:
+                view_read, view_written, seconds = future.result()
+                bytes_read += view_read
+                bytes_written += view_written
+                view_seconds += seconds
+                progress.update()
+            count(files_read=len(views), bytes_read=bytes_read, bytes_written=bytes_written)
+        progress.close()
+
+        elapsed = time.perf_counter() - start_time
+        print(f"Converted {len(views)} normal maps in {elapsed:.1f} s ({len(views) / max(elapsed, 1e-9):.1f} views/sec, "
+              f"read {bytes_read / max(elapsed, 1e-9) / 2**20:.1f} MB/s, written {bytes_written / max(elapsed, 1e-9) / 2**20:.1f} MB/s, "
+              f"{view_seconds / max(elapsed, 1e-9):.1f}x speedup over sequential conversion).")
+
+        if pack_dir is not None:
+            from training_pack import finish_training_pack
+
+            has_mask = [os.path.isfile(os.path.join(args.sdm_unips_result_dir, f"view_{view_id}.data", "mask.png"))
+                        for view_id, _ in views]
+            with stage("pack"):
+                index = finish_training_pack(pack_dir, args.colmap_path, [view_id for view_id, _ in views], has_mask)
+            print(f"Training pack with {len(views)} views of {index['width']}x{index['height']} written to {pack_dir}")
+
+
+if __name__ == "__main__":
+    main()
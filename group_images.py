@@ -1,48 +1,110 @@
 import os
 import argparse
-from natsort import natsorted
+import csv
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from dataset_index import list_files
+from metrics import Progress, add_metrics_arguments, collect_metrics, count, stage
 
+MAPPING_NAME = "group_mapping.csv"
 
-def group_images(image_folder, parent_folder, group_size, start_id):
+
+def default_mapping_file(parent_folder):
+    # Next to parent_folder rather than inside it, where every later stage would list it with the view folders
+    parent_folder = os.path.normpath(os.path.abspath(parent_folder))
+    return os.path.join(os.path.dirname(parent_folder), f"{os.path.basename(parent_folder)}_{MAPPING_NAME}")
+
+
+def plan_groups(sorted_images, group_size, start_id):
+    """
+    Destination subfolder of every image: consecutive groups of group_size images go to view_{start_id:02}.data,
+    view_{start_id + 1:02}.data, ... The images of an incomplete last group are not moved.
+    Returns the list of (subfolder_name, image) in moving order.
+    """
+    num_subfolders = len(sorted_images) // group_size
+    moves = []
+    for i in range(num_subfolders):
+        subfolder_name = f"view_{i + start_id:02}.data"
+        for img in sorted_images[i * group_size:(i + 1) * group_size]:
+            moves.append((subfolder_name, img))
+    return moves
+
+
+def write_mapping(mapping_file, image_folder, parent_folder, moves):
+    # Written before moving anything, so it also tells where the images of an interrupted run went
+    tmp_file = mapping_file + ".tmp"
+    with open(tmp_file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["source", "destination"])
+        for subfolder_name, img in moves:
+            writer.writerow([os.path.join(image_folder, img), os.path.join(parent_folder, subfolder_name, img)])
+    os.replace(tmp_file, mapping_file)
+
+
+def group_images(image_folder, parent_folder, group_size, start_id, jobs=8, mapping_file=None):
     # Get the list of image files and sort them in natural order
-    images = [f for f in os.listdir(image_folder) if os.path.isfile(os.path.join(image_folder, f))]
-    sorted_images = natsorted(images)
+    with stage("list"):
+        sorted_images = [f.name for f in list_files(image_folder)]
 
-    # Calculate number of subfolders needed
-    num_subfolders = len(sorted_images)//group_size
-    # Create subfolders and move images
-    for i in range(start_id, num_subfolders+start_id):
-        # Define the subfolder name
-        subfolder_name = f"view_{i:02}.data"
-        subfolder_path = os.path.join(parent_folder, subfolder_name)
+    # Plan every destination, then create all subfolders in one pass
+    with stage("plan"):
+        moves = plan_groups(sorted_images, group_size, start_id)
+        subfolder_names = list(dict.fromkeys(subfolder_name for subfolder_name, _ in moves))
+        os.makedirs(parent_folder, exist_ok=True)
+        for subfolder_name in subfolder_names:
+            os.makedirs(os.path.join(parent_folder, subfolder_name), exist_ok=True)
 
-        # Create the subfolder if it doesn't exist
-        os.makedirs(subfolder_path, exist_ok=True)
+        if mapping_file is None:
+            mapping_file = default_mapping_file(parent_folder)
+        if mapping_file:
+            write_mapping(mapping_file, image_folder, parent_folder, moves)
 
-        # Get the images for this subfolder
-        start_idx = i * group_size
-        end_idx = start_idx + group_size
-        images_to_move = sorted_images[start_idx:end_idx]
+    progress = Progress(len(moves), "Moved", "images")
 
-        # Move each image to the subfolder
-        for img in images_to_move:
-            src_path = os.path.join(image_folder, img)
-            dst_path = os.path.join(subfolder_path, img)
-            shutil.move(src_path, dst_path)
-        print(f"Moved images to {subfolder_path}")
+    def move(subfolder_name, img, mover):
+        mover(os.path.join(image_folder, img), os.path.join(parent_folder, subfolder_name, img))
+        progress.update()
 
+    with stage("move"):
+        if os.stat(image_folder).st_dev == os.stat(parent_folder).st_dev:
+            # Same filesystem: a move is a single rename of the directory entry
+            for subfolder_name, img in moves:
+                move(subfolder_name, img, os.replace)
+        else:
+            # Across filesystems every move copies the file, so copy several at once
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                for future in [executor.submit(move, subfolder_name, img, shutil.move) for subfolder_name, img in moves]:
+                    future.result()
+        count(moved=len(moves))
+    progress.close()
 
-if __name__ == "__main__":
+    print(f"Moved {len(moves)} images to {len(subfolder_names)} subfolders of {parent_folder}")
+    if mapping_file:
+        print(f"Mapping written to {mapping_file}")
+
+
+def main(argv=None):
     # Set up the argument parser
     parser = argparse.ArgumentParser(description="Group images into subfolders.")
     parser.add_argument("image_folder", type=str, help="Directory where the image files are located")
     parser.add_argument("parent_folder", type=str, help="Parent directory where subfolders will be created")
     parser.add_argument("group_size", type=int, help="Number of images in each subfolder")
     parser.add_argument("--start_id", type=int, default=0, help="The start folder index")
+    parser.add_argument("--jobs", type=int, default=8,
+                        help="Concurrent moves when image_folder and parent_folder are on different filesystems")
+    parser.add_argument("--mapping_file", type=str, default=None,
+                        help=f"CSV file recording the source and destination of every image "
+                             f"(default: <parent_folder>_{MAPPING_NAME} next to parent_folder, '' to skip it)")
+    add_metrics_arguments(parser)
 
     # Parse the arguments
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     # Call the function to group images
-    group_images(args.image_folder, args.parent_folder, args.group_size, args.start_id)
\ No newline at end of file
+    with collect_metrics(args, "group_images"):
+        group_images(args.image_folder, args.parent_folder, args.group_size, args.start_id, args.jobs,
+                     args.mapping_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
 from pathlib import Path
 import shutil
 import argparse
-from natsort import natsorted
+from dataset_index import list_files, natural_key
+from metrics import Progress, add_metrics_arguments, collect_metrics, count, stage
 import re
 
 def group_inference_files(source_dir: Path, target_base_dir: Path):
@@ -16,27 +17,40 @@ def group_inference_files(source_dir: Path, target_base_dir: Path):
 
     # Group files by view ID
     grouped_files = {}
-    for file in source_dir.iterdir():
-        if file.is_file():
+    with stage("list"):
+        for file in list_files(source_dir):
             match = pattern.match(file.name)
             if match:
                 view_id, ext = match.groups()
                 grouped_files.setdefault(view_id, {})[ext] = file
 
     # Sort view IDs naturally
-    for view_id in natsorted(grouped_files.keys()):
-        subdir_path = target_base_dir / f"{view_id}.data"
-        subdir_path.mkdir(parents=True, exist_ok=True)
+    num_files = sum(len(files) for files in grouped_files.values())
+    with stage("copy"), Progress(num_files, "Copied", "files") as progress:
+        for view_id in sorted(grouped_files.keys(), key=natural_key):
+            subdir_path = target_base_dir / f"{view_id}.data"
+            subdir_path.mkdir(parents=True, exist_ok=True)
 
-        for ext, file_path in grouped_files[view_id].items():
-            target_filename = f"normal.{ext}"
-            shutil.copy2(file_path, subdir_path / target_filename)
-            print(f"Copied {file_path.name} to {subdir_path} as '{target_filename}'.")
+            for ext, file_path in grouped_files[view_id].items():
+                target_filename = f"normal.{ext}"
+                shutil.copy2(file_path, subdir_path / target_filename)
+                size = file_path.stat().st_size
+                count(files_read=1, bytes_read=size, files_written=1, bytes_written=size)
+                progress.update()
 
-if __name__ == "__main__":
+    print(f"Copied {num_files} files of {len(grouped_files)} views to {target_base_dir}")
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Group Uni-MS-PS inference outputs into SDM-UniPS-style folders.")
     parser.add_argument("unimsps_inference_folder", type=Path, help="Path to the folder with estimated normal maps.")
     parser.add_argument("export_folder", type=Path, help="Path to the output folder.")
-    args = parser.parse_args()
+    add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
 
-    group_inference_files(args.unimsps_inference_folder, args.export_folder)
+    with collect_metrics(args, "group_uni_ms_ps_results"):
+        group_inference_files(args.unimsps_inference_folder, args.export_folder)
+
+
+if __name__ == "__main__":
+    main()
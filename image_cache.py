@@ -0,0 +1,243 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from metrics import count
+
+# Part of every key: bump it whenever the output of an operation changes for the same parameters
+# (2: reduced decodes are only used when all crop edges lie on the reduced grid)
+CACHE_VERSION = 2
+DEFAULT_CACHE_SIZE = "20G"
+DIGESTS_NAME = "digests.json"
+# Entries of the digest memo kept when it is saved, the most recently used first
+MAX_DIGESTS = 1 << 20
+# Fraction of max_size the cache is pruned down to once it is over budget during a run
+_PRUNE_TO = 0.9
+# Temporary files older than this are left over from a killed run
+_STALE_TMP_SECONDS = 24 * 3600
+
+
+def default_cache_dir():
+    if os.environ.get("MVPS_IMAGE_CACHE_DIR"):
+        return Path(os.environ["MVPS_IMAGE_CACHE_DIR"])
+    base = os.environ.get("XDG_CACHE_HOME") or os.environ.get("LOCALAPPDATA") or os.path.expanduser("~/.cache")
+    return Path(base) / "mvps_scripts" / "images"
+
+
+def file_digest(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def operation_key(operation, digests, **params):
+    """
+    Cache key of an operation (e.g. "resize", "stack") applied to the source files with the given content digests,
+    in order, with the given parameters.
+    """
+    text = json.dumps([CACHE_VERSION, operation, list(digests), params], sort_keys=True)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _copy_atomic(src, dst):
+    # Copied next to the target and renamed over it, like write_image
+    dst = Path(dst)
+    tmp_path = dst.with_name(f".{dst.name}.{os.getpid()}.tmp")
+    try:
+        shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class ImageCache:
+    """
+    Content-addressed cache of processed images (crop/resize outputs, stacks), keyed by the content digests of the
+    source files plus the operation parameters (operation_key), so identical requests on the same sources are served
+    by copying the stored file instead of decoding anything. Entries are plain files under root/objects, a hit
+    refreshes the file mtime, and the least recently used entries are evicted whenever the cache outgrows max_size
+    (see added) and on close(). Workers can get and put concurrently, only the digest memo and the eviction belong
+    to the main process.
+    """
+
+    def __init__(self, root=None, max_size=None):
+        from stacking import parse_size
+
+        self.root = Path(root) if root else default_cache_dir()
+        self.max_size = parse_size(max_size or DEFAULT_CACHE_SIZE)
+        self._digests = None
+        self._size = None
+        self._evicted = self._evicted_bytes = 0
+
+    def __getstate__(self):
+        # The workers get and put entries, they don't need the digest memo
+        return {"root": self.root, "max_size": self.max_size}
+
+    def __setstate__(self, state):
+        self.__init__(state["root"], state["max_size"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _object_path(self, key, suffix):
+        return self.root / "objects" / key[:2] / f"{key}{suffix.lower()}"
+
+    def get(self, key, output_path):
+        """
+        Copy the entry key to output_path. Returns its size, or None if the cache doesn't hold it.
+        """
+        path = self._object_path(key, Path(output_path).suffix)
+        try:
+            os.utime(path)
+            _copy_atomic(path, output_path)
+        except FileNotFoundError:
+            # Not cached, or evicted by another run in the meantime
+            return None
+        return os.path.getsize(output_path)
+
+    def put(self, key, path):
+        """
+        Store the file path as the entry key. Returns the stored size, for added() in the main process.
+        """
+        object_path = self._object_path(key, Path(path).suffix)
+        object_path.parent.mkdir(parents=True, exist_ok=True)
+        _copy_atomic(path, object_path)
+        return os.path.getsize(object_path)
+
+    def _load_digests(self):
+        if self._digests is None:
+            try:
+                with open(self.root / DIGESTS_NAME, "r") as f:
+                    memo = json.load(f)
+                self._digests = memo["entries"] if memo.get("version") == CACHE_VERSION else {}
+            except (OSError, ValueError, KeyError):
+                self._digests = {}
+        return self._digests
+
+    def digests(self, paths, jobs=8):
+        """
+        Content digest of every file in paths, as {path: digest}. Digests are remembered by path, size, mtime and
+        inode, so only new or changed files are read; those are hashed by a thread pool.
+        """
+        memo = self._load_digests()
+        now = time.time()
+        result = {}
+        to_hash = []
+        for path in paths:
+            st = os.stat(path)
+            signature = [st.st_size, st.st_mtime_ns, st.st_ino]
+            entry = memo.get(os.path.abspath(path))
+            if entry is not None and entry[:3] == signature:
+                result[path] = entry[3]
+                entry[4] = now
+            else:
+                to_hash.append((path, signature))
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for (path, signature), digest in zip(to_hash, executor.map(file_digest, [p for p, _ in to_hash])):
+                result[path] = digest
+                memo[os.path.abspath(path)] = signature + [digest, now]
+        count(files_hashed=len(to_hash))
+        return result
+
+    def prune(self, target_size=None):
+        """
+        Remove the least recently used entries until the cache fits in target_size (default max_size).
+        Other runs may evict from the same cache at the same time, entries that vanish meanwhile are skipped.
+        Returns (number of removed entries, freed bytes).
+        """
+        target_size = self.max_size if target_size is None else target_size
+        entries = []
+        now = time.time()
+        objects_dir = self.root / "objects"
+        if objects_dir.is_dir():
+            for folder in os.scandir(objects_dir):
+                if not folder.is_dir():
+                    continue
+                for entry in os.scandir(folder.path):
+                    try:
+                        st = entry.stat()
+                        if entry.name.startswith("."):
+                            if now - st.st_mtime > _STALE_TMP_SECONDS:
+                                os.remove(entry.path)
+                            continue
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        num_removed = freed = 0
+        for _, size, path in entries:
+            if total - freed <= target_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            num_removed += 1
+            freed += size
+        self._size = total - freed
+        self._evicted += num_removed
+        self._evicted_bytes += freed
+        return num_removed, freed
+
+    def added(self, num_bytes):
+        """
+        Account for num_bytes stored by put (in this process or a worker), evicting as soon as the cache outgrows
+        max_size, so a long run never holds more than max_size plus the entries in flight.
+        Eviction goes down to 90% of max_size, so the cache is not rescanned for every new entry.
+        """
+        if self._size is None:
+            # The first scan already sees the new entry
+            self.prune()
+            return
+        self._size += num_bytes
+        if self._size > self.max_size:
+            self.prune(int(self.max_size * _PRUNE_TO))
+
+    def close(self):
+        """
+        Save the digest memo and evict entries beyond max_size.
+        """
+        if self._digests is not None:
+            self.root.mkdir(parents=True, exist_ok=True)
+            entries = self._digests
+            if len(entries) > MAX_DIGESTS:
+                entries = dict(sorted(entries.items(), key=lambda item: item[1][4], reverse=True)[:MAX_DIGESTS])
+            tmp_path = self.root / f".{DIGESTS_NAME}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"version": CACHE_VERSION, "entries": entries}, f)
+            os.replace(tmp_path, self.root / DIGESTS_NAME)
+        self.prune()
+        if self._evicted:
+            print(f"Evicted {self._evicted} cache entries ({self._evicted_bytes / (1 << 20):.1f} MB) from {self.root}")
+
+
+def add_cache_arguments(parser):
+    parser.add_argument("--cache", action="store_true",
+                        help="Keep the outputs in a content-addressed cache and copy them from there when the same "
+                             "sources are processed again with the same settings")
+    parser.add_argument("--cache_dir", type=Path,
+                        help="Folder of the --cache (default: $MVPS_IMAGE_CACHE_DIR or ~/.cache/mvps_scripts/images)")
+    parser.add_argument("--cache_size", type=str, default=DEFAULT_CACHE_SIZE,
+                        help=f"Disk budget of the --cache, the least recently used outputs are evicted beyond it. "
+                             f"Default: {DEFAULT_CACHE_SIZE}")
+
+
+def open_cache(args):
+    """
+    The ImageCache selected by the add_cache_arguments options, or None without --cache.
+    """
+    if not args.cache:
+        return None
+    return ImageCache(args.cache_dir, args.cache_size)
@@ -0,0 +1,109 @@
+import os
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+
+def read_image(path, flags=cv2.IMREAD_UNCHANGED):
+    """
+    Decode an image with OpenCV.
+    The file is read through NumPy so that non-ASCII paths also work on Windows,
+    where cv2.imread fails on them. Returns None if the file can't be decoded.
+    """
+    data = np.fromfile(str(path), dtype=np.uint8)
+    if data.size == 0:
+        return None
+    return cv2.imdecode(data, flags)
+
+
+# Start of frame markers (baseline, extended, progressive, lossless, arithmetic); they hold the image size
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Markers without a length field
+_JPEG_STANDALONE_MARKERS = {0x01, 0xD8} | set(range(0xD0, 0xD8))
+
+# Decode flags of the DCT-scaled reductions, by reduction and (grayscale, color)
+_REDUCED_FLAGS = {
+    2: (cv2.IMREAD_REDUCED_GRAYSCALE_2, cv2.IMREAD_REDUCED_COLOR_2),
+    4: (cv2.IMREAD_REDUCED_GRAYSCALE_4, cv2.IMREAD_REDUCED_COLOR_4),
+    8: (cv2.IMREAD_REDUCED_GRAYSCALE_8, cv2.IMREAD_REDUCED_COLOR_8),
+}
+
+
+def jpeg_header(data):
+    """
+    (width, height, components) from the start of frame marker of the JPEG file contents data (bytes or a uint8
+    array), or None if data isn't a JPEG. Only the markers before the frame header are read.
+    """
+    data = memoryview(data).cast("B")
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte before the marker
+            i += 1
+            continue
+        if marker in _JPEG_STANDALONE_MARKERS:
+            i += 2
+            continue
+        if marker == 0xDA:
+            # Start of scan without a frame header
+            return None
+        length = (data[i + 2] << 8) | data[i + 3]
+        if marker in _JPEG_SOF_MARKERS:
+            if i + 10 > len(data):
+                return None
+            height = (data[i + 5] << 8) | data[i + 6]
+            width = (data[i + 7] << 8) | data[i + 8]
+            return width, height, data[i + 9]
+        i += 2 + length
+    return None
+
+
+def read_image_reduced(path, choose_reduction):
+    """
+    Decode an image like read_image, letting the JPEG decoder scale a JPEG down by 2, 4 or 8 in its inverse DCT,
+    which is several times faster than a full decode and needs a fraction of the memory.
+    choose_reduction(width, height) gets the full size from the JPEG header and returns the reduction (1, 2, 4 or 8).
+    Other formats and CMYK JPEGs are decoded in full. Returns (image, reduction), image is None if the file
+    can't be decoded.
+    """
+    data = np.fromfile(str(path), dtype=np.uint8)
+    if data.size == 0:
+        return None, 1
+    header = jpeg_header(data)
+    if header is not None and header[2] in (1, 3):
+        reduction = choose_reduction(header[0], header[1])
+        if reduction in _REDUCED_FLAGS:
+            # IMREAD_UNCHANGED ignores the EXIF orientation as well, so both decodes give the same pixel grid
+            flags = _REDUCED_FLAGS[reduction][header[2] == 3] | cv2.IMREAD_IGNORE_ORIENTATION
+            return cv2.imdecode(data, flags), reduction
+    return cv2.imdecode(data, cv2.IMREAD_UNCHANGED), 1
+
+
+def write_image(path, image, quality=100):
+    """
+    Encode an image with OpenCV, choosing the codec from the file extension.
+    The file is first written next to the target and then renamed over it, so an
+    interrupted run never leaves a truncated image behind.
+    """
+    path = Path(path)
+    ext = path.suffix.lower()
+    params = []
+    if ext in (".jpg", ".jpeg", ".jfif"):
+        params = [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+    elif ext == ".webp":
+        params = [cv2.IMWRITE_WEBP_QUALITY, int(quality)]
+
+    ok, buffer = cv2.imencode(".jpg" if ext == ".jfif" else ext, image, params)
+    if not ok:
+        raise IOError(f"Could not encode image {path}")
+
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    buffer.tofile(str(tmp_path))
+    os.replace(tmp_path, path)
+    return buffer.size
@@ -0,0 +1,219 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+
+from image_io import read_image
+from metrics import count
+
+# Folder of the pack inside every view folder: lights.npy [L, H, W, 3], mask.npy [H, W] and index.json.
+# Hidden, so the image listings and the pipeline input signatures (exclude ".*") ignore it
+LIGHT_PACK_DIR_NAME = ".light_pack"
+INDEX_NAME = "index.json"
+PACK_VERSION = 1
+
+
+def _signature(path):
+    # A renamed file keeps its size and mtime but not the name of its inode, a rewritten one gets a new mtime
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "inode": st.st_ino}
+
+
+def _is_current(folder, entry):
+    try:
+        signature = _signature(Path(folder) / entry["name"])
+    except OSError:
+        return False
+    return all(signature[key] == entry[key] for key in ("size", "mtime_ns", "inode"))
+
+
+class LightPack:
+    """
+    Memory-mapped light pack of a view folder. lights[i] is the light image names[i] exactly as read_image decodes
+    it ([H, W, 3] uint8, BGR), mask is mask.png as decoded by read_image or None; nothing is decoded.
+    get(name) returns a copy of an image, and only while the file in the view folder is the one that was packed.
+    Handing out copies means only the pack holds the mapping, so close() unmaps the files.
+    """
+
+    def __init__(self, view_dir):
+        self.view_dir = Path(view_dir)
+        self.folder = self.view_dir / LIGHT_PACK_DIR_NAME
+        if not (self.folder / INDEX_NAME).exists():
+            raise FileNotFoundError(f"{self.folder / INDEX_NAME} not found, the pack is missing or incomplete")
+        with open(self.folder / INDEX_NAME, "r") as f:
+            self.index = json.load(f)
+        self.names = [entry["name"] for entry in self.index["lights"]]
+        self._position = {name: i for i, name in enumerate(self.names)}
+        self.lights = np.load(self.folder / "lights.npy", mmap_mode="r")
+        self.mask = np.load(self.folder / "mask.npy", mmap_mode="r") if self.index["mask"] else None
+
+    def __len__(self):
+        return len(self.names)
+
+    def get(self, name):
+        if self.index["mask"] and name == self.index["mask"]["name"]:
+            return np.array(self.mask) if _is_current(self.view_dir, self.index["mask"]) else None
+        position = self._position.get(name)
+        if position is None or not _is_current(self.view_dir, self.index["lights"][position]):
+            return None
+        return np.array(self.lights[position])
+
+    def close(self):
+        # Windows can't replace or delete a file while it is mapped
+        self.lights = self.mask = None
+
+    def is_current(self, image_names, mask_name=None):
+        """
+        Whether the pack holds exactly image_names (and mask_name) of the view folder, all unchanged.
+        """
+        entries = self.index["lights"] + ([self.index["mask"]] if self.index["mask"] else [])
+        if self.names != list(image_names) or (self.index["mask"] or {}).get("name") != mask_name:
+            return False
+        return all(_is_current(self.view_dir, entry) for entry in entries)
+
+
+def load_light_pack(view_dir):
+    """
+    The LightPack of view_dir, or None if the folder has no complete pack.
+    """
+    try:
+        return LightPack(view_dir)
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+
+
+# The pack read_packed_image opened last in this process, as (folder, mtime of its index, LightPack or None).
+# Only one is kept open, so a worker going through the views maps one pack at a time
+_open_pack = None
+
+
+def close_light_packs():
+    """
+    Close the pack kept open by read_packed_image, so that its files can be replaced.
+    """
+    global _open_pack
+    if _open_pack is not None and _open_pack[2] is not None:
+        _open_pack[2].close()
+    _open_pack = None
+
+
+def read_packed_image(image_path):
+    """
+    The decoded image_path from the light pack of its folder if the pack holds the current version of the file,
+    otherwise None. The pack is reopened when its index changes and closed when another folder is read.
+    """
+    global _open_pack
+    image_path = Path(image_path)
+    index_path = image_path.parent / LIGHT_PACK_DIR_NAME / INDEX_NAME
+    try:
+        index_mtime_ns = os.stat(index_path).st_mtime_ns
+    except OSError:
+        return None
+    key = str(image_path.parent)
+    if _open_pack is None or _open_pack[:2] != (key, index_mtime_ns):
+        close_light_packs()
+        _open_pack = (key, index_mtime_ns, load_light_pack(image_path.parent))
+    pack = _open_pack[2]
+    return pack.get(image_path.name) if pack is not None else None
+
+
+def read_light_image(image_path):
+    """
+    read_image that takes the pixels from the view's light pack when it is current, instead of decoding the file.
+    """
+    image = read_packed_image(image_path)
+    return image if image is not None else read_image(image_path)
+
+
+def write_light_pack(view_dir, image_names, mask_name=None):
+    """
+    Decode the light images image_names (and mask_name) of view_dir once into its light pack.
+    index.json is removed first and written last, so an interrupted pack is never used.
+    Returns (bytes_read, bytes_written).
+    """
+    view_dir = Path(view_dir)
+    folder = view_dir / LIGHT_PACK_DIR_NAME
+    folder.mkdir(parents=True, exist_ok=True)
+    # A pack this process still maps can't be overwritten on Windows
+    close_light_packs()
+    if (folder / INDEX_NAME).exists():
+        os.remove(folder / INDEX_NAME)
+
+    # The sources are recorded before they are decoded, so a file changed while packing counts as stale
+    light_entries = [{"name": name, **_signature(view_dir / name)} for name in image_names]
+    mask_entry = {"name": mask_name, **_signature(view_dir / mask_name)} if mask_name else None
+
+    bytes_read = 0
+    lights = None
+    for i, name in enumerate(image_names):
+        image = read_image(view_dir / name)
+        if image is None:
+            raise IOError(f"Could not decode image {view_dir / name}")
+        if lights is None:
+            lights = np.lib.format.open_memmap(folder / "lights.npy", mode="w+", dtype=image.dtype,
+                                               shape=(len(image_names),) + image.shape)
+        elif image.shape != lights.shape[1:]:
+            raise ValueError(f"Image shape {image.shape} of {name} does not match the pack shape {lights.shape[1:]}")
+        lights[i] = image
+        bytes_read += light_entries[i]["size"]
+    if lights is None:
+        raise ValueError(f"No light images to pack in {view_dir}")
+    lights.flush()
+    shape, dtype = lights.shape, lights.dtype
+    del lights
+
+    if mask_entry:
+        mask = read_image(view_dir / mask_name)
+        if mask is None:
+            raise IOError(f"Could not decode image {view_dir / mask_name}")
+        np.save(folder / "mask.npy", mask)
+        bytes_read += mask_entry["size"]
+    elif (folder / "mask.npy").exists():
+        os.remove(folder / "mask.npy")
+
+    index = {
+        "version": PACK_VERSION,
+        "lights": light_entries,
+        "mask": mask_entry,
+        "shape": list(shape),
+        "dtype": str(dtype),
+        "channel_order": "BGR",
+    }
+    tmp_path = folder / (INDEX_NAME + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_path, folder / INDEX_NAME)
+    bytes_written = sum(os.path.getsize(folder / name) for name in os.listdir(folder))
+    return bytes_read, bytes_written
+
+
+def _pack_view_task(view_dir, image_names, mask_name, force):
+    if not force:
+        pack = load_light_pack(view_dir)
+        if pack is not None and pack.is_current(image_names, mask_name):
+            return False, 0, 0
+    return (True,) + write_light_pack(view_dir, image_names, mask_name)
+
+
+def pack_views(views, jobs=None, force=False):
+    """
+    Write the light packs of views, a list of (view_dir, image_names, mask_name), with a process pool.
+    Views whose pack is current are skipped unless force is set.
+    Yields (view_dir, packed, error) as the views finish.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(_pack_view_task, view_dir, image_names, mask_name, force): (view_dir, image_names)
+                   for view_dir, image_names, mask_name in views}
+        for future in as_completed(futures):
+            view_dir, image_names = futures[future]
+            try:
+                packed, bytes_read, bytes_written = future.result()
+            except Exception as e:
+                yield view_dir, False, e
+                continue
+            if packed:
+                count(files_read=len(image_names), bytes_read=bytes_read, files_written=1, bytes_written=bytes_written)
+            yield view_dir, packed, None
@@ -0,0 +1,281 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Metrics of the running script, set by collect_metrics; stage/count/run_subprocess do nothing else than
+# their plain work while it is None, so library code can call them unconditionally
+_current = None
+
+COUNTERS = ("files_read", "bytes_read", "files_written", "bytes_written")
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument("--metrics", type=str, metavar="OUT_JSON",
+                        help="Write per-stage wall/CPU time, files and bytes read and written, subprocess time "
+                             "and peak memory to this JSON file")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile the main process with cProfile and dump the stats to <script>.prof "
+                             "(or --profile_out), readable with python -m pstats or snakeviz")
+    parser.add_argument("--profile_out", type=str, metavar="OUT_PROF",
+                        help="File the --profile stats are written to, implies --profile")
+
+
+def _io_counters():
+    """
+    (bytes read, bytes written) by this process and its reaped children (worker pools, magick, colmap)
+    through read/write system calls, from /proc/self/io. None where it isn't available.
+    """
+    try:
+        with open("/proc/self/io", "r") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _snapshot():
+    times = os.times()
+    return time.perf_counter(), times.user + times.system, times.children_user + times.children_system, _io_counters()
+
+
+def peak_memory():
+    """
+    (peak RSS of this process, peak RSS of the largest reaped child) in bytes. Without the resource module (Windows)
+    the first is the peak of the Python allocations traced by tracemalloc, the second None.
+    """
+    if resource is None:
+        import tracemalloc
+        return (tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None), None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit)
+
+
+class Metrics:
+    """
+    Per-stage measurements of one script run. Stages may nest (the outer one includes the inner ones) and may run
+    in several threads; CPU time and bytes are process-wide, so stages running at the same time share them.
+    """
+
+    def __init__(self, script):
+        self.script = script
+        self.stages = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._start = _snapshot()
+
+    def _open_stages(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _record(self, name):
+        return self.stages.setdefault(name, {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0,
+                                             "children_cpu_seconds": 0.0, "subprocess_seconds": 0.0,
+                                             "subprocesses": 0, **{counter: 0 for counter in COUNTERS}})
+
+    @contextmanager
+    def stage(self, name):
+        stack = self._open_stages()
+        stack.append(name)
+        start = _snapshot()
+        try:
+            yield
+        finally:
+            end = _snapshot()
+            stack.pop()
+            with self._lock:
+                record = self._record(name)
+                record["calls"] += 1
+                record["wall_seconds"] += end[0] - start[0]
+                record["cpu_seconds"] += end[1] - start[1]
+                record["children_cpu_seconds"] += end[2] - start[2]
+                if start[3] is not None and end[3] is not None:
+                    # Without explicit counts, the bytes are those of all read/write calls during the stage
+                    record["io_read_bytes"] = record.get("io_read_bytes", 0) + end[3][0] - start[3][0]
+                    record["io_written_bytes"] = record.get("io_written_bytes", 0) + end[3][1] - start[3][1]
+
+    def count(self, **counters):
+        with self._lock:
+            for name in self._open_stages() or ["total"]:
+                record = self._record(name)
+                for counter, value in counters.items():
+                    record[counter] = record.get(counter, 0) + value
+
+    def add_subprocess(self, seconds):
+        with self._lock:
+            for name in self._open_stages() or ["total"]:
+                record = self._record(name)
+                record["subprocess_seconds"] += seconds
+                record["subprocesses"] += 1
+
+    def report(self):
+        end = _snapshot()
+        peak_rss, peak_children_rss = peak_memory()
+        return {
+            "script": self.script,
+            "argv": sys.argv[1:],
+            "wall_seconds": end[0] - self._start[0],
+            "cpu_seconds": end[1] - self._start[1],
+            "children_cpu_seconds": end[2] - self._start[2],
+            "peak_rss_bytes": peak_rss,
+            "peak_children_rss_bytes": peak_children_rss,
+            "stages": self.stages,
+        }
+
+    def write(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.report(), f, indent=1)
+        os.replace(tmp_path, path)
+
+
+@contextmanager
+def collect_metrics(args, script):
+    """
+    Measure the enclosed run of script if args.metrics, args.profile or args.profile_out is set
+    (see add_metrics_arguments); everything runs inside the stage "total". The report is written even when the run fails.
+    """
+    global _current
+    metrics_path = getattr(args, "metrics", None)
+    profile_path = getattr(args, "profile_out", None)
+    if profile_path is None and getattr(args, "profile", False):
+        profile_path = f"{script}.prof"
+    if not metrics_path and profile_path is None:
+        yield None
+        return
+
+    if resource is None and metrics_path:
+        import tracemalloc
+        tracemalloc.start()
+    profiler = None
+    if profile_path is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    _current = Metrics(script)
+    try:
+        with _current.stage("total"):
+            yield _current
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+            print(f"Profile written to {profile_path}")
+        if metrics_path:
+            _current.write(metrics_path)
+            print(f"Metrics written to {metrics_path}")
+        _current = None
+
+
+@contextmanager
+def stage(name):
+    """
+    Record the enclosed block as stage name of the running script's metrics, if they are collected.
+    """
+    if _current is None:
+        yield
+        return
+    with _current.stage(name):
+        yield
+
+
+def count(**counters):
+    """
+    Add files_read, bytes_read, files_written, bytes_written (or any other counter, e.g. renamed) to the open stages.
+    """
+    if _current is not None:
+        _current.count(**counters)
+
+
+def add_subprocess_time(seconds):
+    """
+    Add one subprocess that ran for seconds to the open stages, for commands not started with run_subprocess.
+    """
+    if _current is not None:
+        _current.add_subprocess(seconds)
+
+
+def run_subprocess(command, **kwargs):
+    """
+    subprocess.run that adds the run time of the command (magick, colmap) to the open stages.
+    """
+    # Imported here, the scripts started thousands of times from shell loops (rename, copy) never run a command
+    import subprocess
+    start_time = time.perf_counter()
+    try:
+        return subprocess.run(command, **kwargs)
+    finally:
+        add_subprocess_time(time.perf_counter() - start_time)
+
+
+class Progress:
+    """
+    A single progress line ("label: done/total (rate/s)") instead of a print per file. On a terminal the line
+    is redrawn at most every interval seconds; in a log (not a terminal) a new line is printed every log_interval seconds.
+    """
+
+    def __init__(self, total=None, label="Processed", unit="files", interval=0.2, log_interval=10.0, stream=None):
+        self.total = total
+        self.label = label
+        self.unit = unit
+        self.stream = stream or sys.stdout
+        self.is_terminal = self.stream.isatty()
+        self.interval = interval if self.is_terminal else log_interval
+        self.done = 0
+        self._start_time = time.perf_counter()
+        self._last_time = self._start_time
+        self._line_length = 0
+        self._lock = threading.Lock()
+
+    def _line(self):
+        elapsed = time.perf_counter() - self._start_time
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        done = f"{self.done}/{self.total}" if self.total is not None else str(self.done)
+        return f"{self.label}: {done} {self.unit} ({rate:.1f}/s, {elapsed:.0f} s)"
+
+    def _draw(self, final=False):
+        line = self._line()
+        if self.is_terminal:
+            self.stream.write("\r" + line.ljust(self._line_length) + ("\n" if final else ""))
+            self._line_length = 0 if final else len(line)
+        else:
+            self.stream.write(line + "\n")
+        self.stream.flush()
+
+    def update(self, n=1):
+        with self._lock:
+            self.done += n
+            now = time.perf_counter()
+            if now - self._last_time >= self.interval:
+                self._last_time = now
+                self._draw()
+
+    def print(self, message):
+        # A message (e.g. an error) on its own line, the progress line is redrawn by the next update
+        with self._lock:
+            if self.is_terminal and self._line_length:
+                self.stream.write("\r" + " " * self._line_length + "\r")
+                self._line_length = 0
+            self.stream.write(f"{message}\n")
+            self.stream.flush()
+
+    def close(self):
+        with self._lock:
+            self._draw(final=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
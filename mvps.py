@@ -0,0 +1,126 @@
+import importlib
+import shlex
+import sys
+
+# Subcommand -> (module, summary). Only the module of the subcommand that runs is imported, so the rename and copy
+# commands start without loading numpy, OpenCV or pyexr.
+COMMANDS = {
+    "group_images": ("group_images", "Group the captured images into view_XX.data subfolders"),
+    "create_view_folders": ("create_view_folders", "Create empty view_XX.data folders"),
+    "rename_images_in_folders": ("rename_images_in_folders", "Rename the images of every view to L00, L01, ..."),
+    "rename_files_sequentially": ("rename_files_sequentially", "Rename the files of a folder sequentially"),
+    "rename_masks_sequentially": ("rename_masks_sequentially", "Rename the masks of a folder sequentially"),
+    "rename_view_subfolders_sequentially": ("rename_view_subfolders_sequentially",
+                                            "Renumber the view_XX.data subfolders"),
+    "resize_all_images": ("resize_all_images", "Crop and resize the images of every view"),
+    "resize_all_images_new": ("resize_all_images_new", "Recursively crop and/or resize images"),
+    "copy_masks_to_subfolders": ("copy_masks_to_subfolders", "Copy the mask of every view into its subfolder"),
+    "create_stacked": ("create_stacked", "Stack the light images of every view into one image"),
+    "pack_light_stacks": ("pack_light_stacks", "Decode the lights of every view once into a memory-mapped pack"),
+    "undistort_all_mvps_images": ("undistort_all_mvps_images", "Undistort all MVPS images"),
+    "flatten_colmap_model": ("flatten_colmap_model", "Flatten a COLMAP rig dataset and update images.txt"),
+    "flatten_colmap_model_2": ("flatten_colmap_model_2", "flatten_colmap_model with an optional rig dataset"),
+    "flatten_colmap_model_masks": ("flatten_colmap_model_masks", "flatten_colmap_model that also places the masks"),
+    "colmap2neus": ("colmap2neus", "Write cameras_sphere.npz from a COLMAP model"),
+    "colmap2neus_multicam": ("colmap2neus_multicam", "colmap2neus for multi-camera models"),
+    "gather_and_convert_normal_map_colmap": ("gather_and_convert_normal_map_colmap",
+                                             "Gather the SDM-UniPS normal maps and convert them to world space"),
+    "gather_and_convert_normal_map_colmap_multicam": ("gather_and_convert_normal_map_colmap_multicam",
+                                                      "gather_and_convert_normal_map_colmap for multi-camera models"),
+    "group_uni_ms_ps_results": ("group_uni_ms_ps_results", "Group Uni-MS-PS outputs into SDM-UniPS-style folders"),
+    "pipeline": ("pipeline", "Run the processing chain, skipping up-to-date stages"),
+    "synthetic_dataset": ("synthetic_dataset", "Generate a synthetic MVPS dataset"),
+    "benchmark_pipeline": ("benchmark_pipeline", "Time every stage on a synthetic dataset"),
+    "benchmark_exr_codecs": ("benchmark_exr_codecs", "Compare EXR pixel types and compressions for normal maps"),
+}
+
+
+def print_usage(stream=sys.stdout):
+    stream.write("usage: mvps <command> [arguments]   (mvps <command> --help for the arguments of a command)\n"
+                 "       mvps batch FILE              run the commands listed in FILE, one per line, in this process\n\n"
+                 "commands:\n")
+    width = max(len(name) for name in COMMANDS)
+    for name, (_, summary) in COMMANDS.items():
+        stream.write(f"  {name:<{width}}  {summary}\n")
+
+
+def run_command(name, argv):
+    """
+    Run subcommand name with the arguments argv. Returns its exit code.
+    """
+    module_name = COMMANDS[name][0]
+    # The scripts' argparse usage lines and metrics reports read sys.argv
+    saved_argv = sys.argv
+    sys.argv = [f"mvps {name}"] + list(argv)
+    try:
+        importlib.import_module(module_name).main(argv)
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    finally:
+        sys.argv = saved_argv
+    return 0
+
+
+def run_batch(path):
+    """
+    Run the commands in path (one "command arguments" line each, shell quoting, # comments) in this process,
+    so a loop over thousands of folders pays the interpreter and import startup once. Returns the exit code.
+    """
+    if path == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, "r") as f:
+            lines = f.read().splitlines()
+
+    failed = 0
+    for line_number, line in enumerate(lines, 1):
+        words = shlex.split(line, comments=True)
+        if not words:
+            continue
+        name = words[0].replace("-", "_")
+        if name not in COMMANDS:
+            print(f"{path}:{line_number}: unknown command '{words[0]}'", file=sys.stderr)
+            failed += 1
+            continue
+        try:
+            ok = run_command(name, words[1:]) == 0
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            ok = False
+        if not ok:
+            print(f"{path}:{line_number}: failed: {line}", file=sys.stderr)
+            failed += 1
+    if failed:
+        print(f"{failed} commands failed", file=sys.stderr)
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ("-h", "--help"):
+        print_usage()
+        return 0 if argv else 2
+
+    # Dashes and underscores are interchangeable: mvps rename-files-sequentially
+    name = argv[0].replace("-", "_")
+    if name == "batch":
+        if len(argv) != 2:
+            print("usage: mvps batch FILE (- for stdin)", file=sys.stderr)
+            return 2
+        return run_batch(argv[1])
+    if name not in COMMANDS:
+        import difflib
+        print(f"mvps: unknown command '{argv[0]}'", file=sys.stderr)
+        close = difflib.get_close_matches(name, COMMANDS, n=3)
+        if close:
+            print(f"Did you mean: {', '.join(close)}?", file=sys.stderr)
+        return 2
+    return run_command(name, argv[1:])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
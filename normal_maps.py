@@ -0,0 +1,165 @@
+import os
+import time
+
+import Imath
+import numpy as np
+import OpenEXR
+import pyexr
+
+from file_transfer import transfer_file
+
+# SDM-UniPS normals have Y up and Z towards the camera, OpenCV/COLMAP cameras have Y down and Z to the front
+FLIP_YZ = np.diag([1.0, -1.0, -1.0])
+
+EXR_PRECISIONS = {"half": pyexr.HALF, "float": pyexr.FLOAT}
+EXR_COMPRESSIONS = {
+    "none": Imath.Compression.NO_COMPRESSION,
+    "zip": Imath.Compression.ZIP_COMPRESSION,
+    "piz": Imath.Compression.PIZ_COMPRESSION,
+    "dwaa": Imath.Compression.DWAA_COMPRESSION,
+}
+
+
+def exr_precision(name):
+    return EXR_PRECISIONS[name]
+
+
+def exr_compression(name):
+    return Imath.Compression(EXR_COMPRESSIONS[name])
+
+
+def set_exr_threads(num_threads):
+    """
+    Size OpenEXR's global thread pool, which compresses and decompresses the line blocks of a file in parallel.
+    Older OpenEXR bindings don't expose it, there the call does nothing.
+    """
+    if hasattr(OpenEXR, "set_global_thread_count"):
+        OpenEXR.set_global_thread_count(max(0, int(num_threads)))
+
+
+def read_exr(path):
+    """
+    Read the RGB channels of an EXR file as float32.
+    Returns (data, precision, compression) so that the data can be written back with the source settings.
+    """
+    exr_file = pyexr.open(path)
+    data = exr_file.get(precision=pyexr.FLOAT)
+    precision = exr_file.channel_precision[exr_file.channel_map["default"][0]]
+    compression = exr_file.input_file.header()["compression"]
+    return data, precision, compression
+
+
+def rotate_normals_inplace(normals, rotation, block_size=1 << 16):
+    """
+    Rotate an (..., 3) float32 normal map in place, i.e. normals = rotation @ normals for every pixel.
+    Works in blocks of block_size pixels, so the float32 temporaries stay small regardless of the resolution.
+    """
+    flat = normals.reshape(-1, 3)
+    rotation_t = np.ascontiguousarray(rotation.T, dtype=normals.dtype)
+    for start in range(0, flat.shape[0], block_size):
+        block = flat[start:start + block_size]
+        block[...] = block @ rotation_t
+    return normals
+
+
+def read_mask(mask_file, shape):
+    """
+    Read a mask image as a boolean (H, W) array of the given shape (foreground = brighter than 127),
+    resized with nearest neighbour if needed. Returns None if the file doesn't exist.
+    """
+    if mask_file is None or not os.path.isfile(mask_file):
+        return None
+    # Imported here so that conversions without masks don't need OpenCV
+    import cv2
+    from image_io import read_image
+
+    mask = read_image(mask_file, cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        raise ValueError(f"Could not decode mask {mask_file}")
+    if mask.shape != tuple(shape):
+        mask = cv2.resize(mask, (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+    return mask > 127
+
+
+def rotate_foreground(normals, rotation, mask, fill=0.0):
+    """
+    Rotate only the foreground pixels of an (H, W, 3) float32 normal map in place and set the background
+    to fill (0 or NaN). Returns (normals, indices, values): the flat foreground indices and rotated values.
+    """
+    flat = normals.reshape(-1, 3)
+    indices = np.flatnonzero(mask)
+    values = flat[indices]
+    rotate_normals_inplace(values, rotation)
+    flat.fill(fill)
+    flat[indices] = values
+    return normals, indices, values
+
+
+def write_sparse_normals(path, shape, indices, values):
+    """
+    Store foreground normals as flat pixel indices (row-major into an (H, W) image) and their values.
+    """
+    tmp_path = f"{path}.tmp.npz"
+    np.savez(tmp_path, shape=np.asarray(shape[:2], dtype=np.int64), indices=indices.astype(np.uint32), values=values)
+    os.replace(tmp_path, path)
+
+
+def read_sparse_normals(path, fill=0.0):
+    """
+    Expand a sparse normal map written by write_sparse_normals to a dense (H, W, 3) float32 array.
+    """
+    with np.load(path) as sparse:
+        height, width = sparse["shape"]
+        normals = np.full((height * width, 3), fill, dtype=np.float32)
+        normals[sparse["indices"]] = sparse["values"]
+    return normals.reshape(height, width, 3)
+
+
+def convert_normal_map(normal_map_file, camera_file, world_file, R_c2w, precision="float", compression="piz",
+                       mask_file=None, pack_dir=None, pack_index=None, mask_mode="none", sparse_file=None):
+    """
+    Copy an SDM-UniPS camera-space normal map to camera_file, read it once and write its
+    world-space rotation to world_file with the given pixel type ("half"/"float") and compression
+    ("none"/"zip"/"piz"/"dwaa"). With pack_dir, the world-space normals and the mask in mask_file
+    are also stored as view pack_index of that training pack (see training_pack.py).
+    With mask_mode "zero" or "nan" only the foreground pixels of mask_file are rotated and the background
+    is written as 0 or NaN. sparse_file additionally (or, if world_file is None, instead) stores the foreground
+    normals as flat indices and values (without a mask, every pixel is foreground).
+    Returns (bytes_read, bytes_written, seconds).
+    """
+    start_time = time.perf_counter()
+    # The camera-space output is the source file copied byte for byte: no encode, and any channels or attributes
+    # beyond RGB are kept
+    transfer_file(normal_map_file, camera_file)
+    normal_map, _, _ = read_exr(normal_map_file)
+
+    # Revert y and z axis to match opencv conversion (X right, Y down, Z front) and rotate to world space in one step
+    rotation = np.asarray(R_c2w) @ FLIP_YZ
+    needs_mask = mask_mode != "none" or sparse_file is not None or pack_dir is not None
+    mask = read_mask(mask_file, normal_map.shape[:2]) if needs_mask else None
+    if mask_mode != "none" and mask is not None:
+        normal_map, indices, values = rotate_foreground(normal_map, rotation, mask,
+                                                        np.nan if mask_mode == "nan" else 0.0)
+    else:
+        rotate_normals_inplace(normal_map, rotation)
+        indices = values = None
+
+    bytes_written = os.path.getsize(camera_file)
+    if world_file is not None:
+        pyexr.write(world_file, normal_map, precision=exr_precision(precision),
+                    compression=exr_compression(compression))
+        bytes_written += os.path.getsize(world_file)
+    if sparse_file is not None:
+        if indices is None:
+            indices = np.flatnonzero(mask) if mask is not None else np.arange(normal_map.shape[0] * normal_map.shape[1])
+            values = normal_map.reshape(-1, 3)[indices]
+        write_sparse_normals(sparse_file, normal_map.shape, indices,
+                             values.astype(np.float16 if precision == "half" else np.float32))
+        bytes_written += os.path.getsize(sparse_file)
+
+    if pack_dir is not None:
+        from training_pack import write_pack_view
+        write_pack_view(pack_dir, pack_index, normal_map, mask)
+
+    bytes_read = os.path.getsize(normal_map_file)
+    return bytes_read, bytes_written, time.perf_counter() - start_time
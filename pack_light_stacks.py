@@ -0,0 +1,61 @@
+import argparse
+import os
+from pathlib import Path
+from dataset_index import DatasetIndex, JPEG_EXTENSIONS
+from light_pack import LIGHT_PACK_DIR_NAME, pack_views
+from metrics import Progress, add_metrics_arguments, collect_metrics, stage
+
+
+def list_views(parent_folder: Path, views=None):
+    """
+    (view folder, light image names, mask name or None) of every subfolder of parent_folder
+    (or only the ones named in views), from the cached dataset index.
+    """
+    with DatasetIndex(parent_folder) as index:
+        return [(view.path, [f.name for f in view.images if not f.name.startswith(".")],
+                 view.mask.name if view.mask else None)
+                for view in index.views(JPEG_EXTENSIONS) if views is None or view.name in views]
+
+
+def pack_light_stacks(parent_folder: Path, jobs: int, views=None, force=False):
+    with stage("list"):
+        view_list = [view for view in list_views(parent_folder, views) if view[1]]
+
+    num_packed = num_current = num_failed = 0
+    progress = Progress(len(view_list), "Packed", "views")
+    with stage("pack"):
+        for view_dir, packed, error in pack_views(view_list, jobs, force):
+            if error is not None:
+                progress.print(f"An error occurred in folder {view_dir}: {error}")
+                num_failed += 1
+            elif packed:
+                num_packed += 1
+            else:
+                num_current += 1
+            progress.update()
+    progress.close()
+
+    print(f"Packed {num_packed} views into {LIGHT_PACK_DIR_NAME} ({num_current} already up to date, "
+          f"{num_failed} failed)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=f"Decode the light images and the mask of every view folder once into a memory-mapped "
+                    f"{LIGHT_PACK_DIR_NAME} folder, which stacking and undistortion then read instead of decoding "
+                    f"the JPEGs again. A pack is only used while the images it was built from are unchanged.")
+    parser.add_argument("parent_folder", type=Path, help="Path to the parent folder containing the view subfolders.")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                        help="Number of view folders packed in parallel. Default: all cores")
+    parser.add_argument("--views", nargs="+", help="Only pack these subfolders (names). Default: all")
+    parser.add_argument("--force", action="store_true", help="Rewrite the packs that are already up to date.")
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    with collect_metrics(args, "pack_light_stacks"):
+        pack_light_stacks(args.parent_folder, args.jobs, args.views, args.force)
+
+
+if __name__ == "__main__":
+    main()
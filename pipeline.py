@@ -0,0 +1,380 @@
+import argparse
+import fnmatch
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from dataset_index import natural_key
+import metrics
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+STATE_DIR_NAME = ".pipeline"
+
+# Template of the full MVPS chain, written by --example. Every stage lists the stages it has to wait for in "after",
+# stages without a path between them (e.g. copy_masks and stack) run concurrently.
+# Cropping and resizing are not idempotent, so the resize stage writes to a separate {resized} tree: a rerun after a
+# partial failure or with --force starts again from the untouched captures in {dataset}.
+# "foreach" stages are tracked per view ({item} is the path, {name} the folder name, {stem} the name without extension):
+# only views whose inputs changed are passed to the script (--views {names}).
+EXAMPLE_CONFIG = {
+    "vars": {
+        "raw_images": "raw",
+        "dataset": "views",
+        "masks": "masks",
+        "group_size": "12",
+        "crop": "2560x2560+728+224",
+        "resize": "1024x1024",
+        "resized": "resized",
+        "stacked": "stacked",
+        "colmap_workspace": "colmap",
+        "model": "{colmap_workspace}/sparse/0",
+        "undistorted": "undistorted",
+        "flat": "flat",
+        "sdm_results": "sdm_unips_results",
+        "data_dir": "neus_data"
+    },
+    "stages": [
+        {"name": "group",
+         "command": ["{python}", "{scripts}/group_images.py", "{raw_images}", "{dataset}", "{group_size}"],
+         "inputs": ["{raw_images}"], "outputs": ["{dataset}"]},
+        {"name": "rename_lights", "after": ["group"],
+         "command": ["{python}", "{scripts}/rename_images_in_folders.py", "{dataset}"],
+         "inputs": ["{dataset}"], "outputs": ["{dataset}"]},
+        {"name": "resize", "after": ["rename_lights"], "foreach": "{dataset}/*/", "batch": True,
+         "command": ["{python}", "{scripts}/resize_all_images_new.py", "{dataset}", "--crop", "{crop}",
+                     "--resize", "{resize}", "--engine", "native", "--output_dir", "{resized}", "--views", "{names}"],
+         "inputs": ["{item}/*.jpg"], "outputs": ["{resized}/{name}"]},
+        {"name": "stack", "after": ["resize"], "foreach": "{resized}/*/", "batch": True,
+         "command": ["{python}", "{scripts}/create_stacked.py", "{resized}", "{stacked}", "--engine", "native",
+                     "--views", "{names}"],
+         "inputs": ["{item}/*.jpg"], "outputs": ["{stacked}/{stem}.jpg"]},
+        {"name": "copy_masks", "after": ["resize"],
+         "command": ["{python}", "{scripts}/copy_masks_to_subfolders.py", "{masks}", "{resized}"],
+         "inputs": ["{masks}"], "outputs": ["{resized}/*/mask.png"]},
+        {"name": "colmap", "after": ["stack"],
+         "command": ["colmap", "automatic_reconstructor", "--workspace_path", "{colmap_workspace}",
+                     "--image_path", "{stacked}", "--dense", "0"],
+         "inputs": ["{stacked}"], "outputs": ["{model}/cameras.bin", "{model}/images.bin"]},
+        {"name": "undistort", "after": ["colmap", "copy_masks"], "foreach": "{resized}/*/", "batch": True,
+         "command": ["{python}", "{scripts}/undistort_all_mvps_images.py", "--cameras_txt_path", "{model}/cameras.bin",
+                     "--all_mvps_images_path", "{resized}", "--undistorted_mvps_images_path", "{undistorted}",
+                     "--engine", "native", "--views", "{names}"],
+         "inputs": ["{item}/*.jpg", "{item}/mask.png", "{model}/cameras.bin"], "outputs": ["{undistorted}/{name}"]},
+        {"name": "flatten", "after": ["undistort"],
+         "command": ["{python}", "{scripts}/flatten_colmap_model.py", "{undistorted}", "{model}/images.bin", "{flat}",
+                     "--incremental", "--link-mode", "hardlink"],
+         "inputs": ["{undistorted}", "{model}/images.bin"], "outputs": ["{flat}"]},
+        {"name": "colmap2neus", "after": ["colmap"],
+         "command": ["{python}", "{scripts}/colmap2neus.py", "--colmap_path", "{model}"],
+         "inputs": ["{model}/cameras.bin", "{model}/images.bin"], "outputs": ["{model}/cameras_sphere.npz", "{model}/cameras_sphere_mmap/world_mats.npy"]},
+        {"name": "gather_normals", "after": ["colmap"],
+         "command": ["{python}", "{scripts}/gather_and_convert_normal_map_colmap.py", "--colmap_path", "{model}",
+                     "--sdm_unips_result_dir", "{sdm_results}", "--data_dir", "{data_dir}"],
+         "inputs": ["{sdm_results}", "{model}/images.bin"],
+         "outputs": ["{data_dir}/normal_camera_space_sdmunips", "{data_dir}/normal_world_space_sdmunips"]}
+    ]
+}
+
+_print_lock = threading.Lock()
+
+
+def log(message):
+    with _print_lock:
+        print(message, flush=True)
+
+
+def expand(value, variables):
+    """
+    Substitute {var} references, repeatedly so that variables can refer to other variables.
+    """
+    for _ in range(10):
+        expanded = value.format_map(variables)
+        if expanded == value:
+            break
+        value = expanded
+    return value
+
+
+def is_pattern(path):
+    return any(c in path for c in "*?[")
+
+
+def iter_input_files(patterns, exclude):
+    """
+    Yield every file matched by the given paths/glob patterns, walking directories recursively.
+    Names matching an exclude pattern (files or folders) are skipped.
+    """
+    stack = []
+    for pattern in patterns:
+        stack.extend(sorted(glob.glob(pattern, recursive=True)) if is_pattern(pattern) else [pattern])
+    while stack:
+        path = stack.pop()
+        if os.path.isdir(path):
+            with os.scandir(path) as it:
+                for entry in it:
+                    if not any(fnmatch.fnmatch(entry.name, p) for p in exclude):
+                        stack.append(entry.path)
+        elif os.path.exists(path):
+            yield path
+
+
+def signature(patterns, exclude):
+    """
+    Digest of the paths, sizes and mtimes of all files matched by patterns, and the number of files.
+    """
+    entries = []
+    for path in iter_input_files(patterns, exclude):
+        st = os.stat(path)
+        entries.append(f"{os.path.normpath(path)}\0{st.st_size}\0{st.st_mtime_ns}")
+    entries.sort()
+    return hashlib.sha1("\n".join(entries).encode("utf-8")).hexdigest(), len(entries)
+
+
+class Stage:
+    """
+    One step of the pipeline: a command with its inputs, outputs and the stages it has to wait for.
+    A stage is up to date when its stamp (written after the last successful run) records the same command and the
+    same input signature as now, and none of its plain (non-glob) outputs is missing. The input signature is taken
+    after the run, so stages that rewrite their inputs in place (rename, resize) don't trigger themselves again.
+    A stage without "foreach" also runs when one of its "after" stages ran in this invocation.
+    After a fully successful pipeline run all stamps are refreshed, so files that later stages rewrote in place
+    don't make the earlier stages run again.
+    """
+
+    def __init__(self, config, variables, state_dir):
+        self.name = config["name"]
+        self.after = config.get("after", [])
+        self.command = config["command"]
+        self.inputs = config.get("inputs", [])
+        self.outputs = config.get("outputs", [])
+        self.exclude = config.get("exclude", [".*"])
+        self.foreach = config.get("foreach")
+        self.batch = config.get("batch", False)
+        self.variables = variables
+        self.state_dir = Path(state_dir)
+
+    def items(self):
+        """
+        (item_variables, stamp_path) for every unit of work: the matched folders/files of a foreach stage or the stage itself.
+        """
+        if not self.foreach:
+            return [(self.variables, self.state_dir / f"{self.name}.json")]
+        pattern = expand(self.foreach, self.variables)
+        paths = sorted(glob.glob(pattern), key=lambda p: natural_key(os.path.basename(os.path.normpath(p))))
+        items = []
+        for path in paths:
+            path = os.path.normpath(path)
+            name = os.path.basename(path)
+            item_variables = {**self.variables, "item": path, "name": name, "stem": os.path.splitext(name)[0]}
+            items.append((item_variables, self.state_dir / self.name / f"{name}.json"))
+        return items
+
+    def expanded_command(self, variables, names=None):
+        command = []
+        for arg in self.command:
+            if arg == "{names}":
+                command.extend(names)
+            else:
+                command.append(expand(arg, variables))
+        return command
+
+    def _state(self, variables):
+        inputs = [expand(p, variables) for p in self.inputs]
+        return {"command": self.expanded_command(variables, ["{names}"]),
+                "inputs": signature(inputs, self.exclude)[0]}
+
+    def is_current(self, variables, stamp_path):
+        if not stamp_path.exists():
+            return False
+        with open(stamp_path, "r") as f:
+            stamp = json.load(f)
+        outputs = [expand(p, variables) for p in self.outputs]
+        if any(not is_pattern(p) and not os.path.exists(p) for p in outputs):
+            return False
+        return stamp == self._state(variables)
+
+    def record(self, variables, stamp_path):
+        stamp_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = stamp_path.with_name(stamp_path.name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self._state(variables), f)
+        os.replace(tmp_path, stamp_path)
+
+
+def run_command(name, command):
+    """
+    Run a command, prefixing its output lines with the stage name. Returns the exit code.
+    """
+    log(f"[{name}] $ {subprocess.list2cmdline(command)}")
+    start_time = time.perf_counter()
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                                   errors="replace", bufsize=1)
+    except OSError as e:
+        log(f"[{name}] {e}")
+        return 127
+    for line in process.stdout:
+        log(f"[{name}] {line.rstrip()}")
+    returncode = process.wait()
+    metrics.add_subprocess_time(time.perf_counter() - start_time)
+    return returncode
+
+
+def run_stage(stage, force, dependency_ran, dry_run):
+    """
+    Run the out-of-date parts of a stage. Returns (ran, ok).
+    """
+    items = stage.items()
+    if force or (dependency_ran and not stage.foreach):
+        stale = items
+    else:
+        stale = [(variables, stamp) for variables, stamp in items if not stage.is_current(variables, stamp)]
+
+    if not stale:
+        log(f"[{stage.name}] up to date")
+        return False, True
+    if stage.foreach:
+        log(f"[{stage.name}] {len(stale)} of {len(items)} items out of date")
+    if dry_run:
+        log(f"[{stage.name}] would run")
+        return True, True
+
+    start_time = time.perf_counter()
+    if stage.foreach and stage.batch:
+        runs = [(stage.expanded_command(stage.variables, [v["name"] for v, _ in stale]), stale)]
+    else:
+        runs = [(stage.expanded_command(variables), [(variables, stamp)]) for variables, stamp in stale]
+
+    ok = True
+    with metrics.stage(stage.name):
+        for command, covered in runs:
+            if run_command(stage.name, command) != 0:
+                ok = False
+                continue
+            for variables, stamp in covered:
+                stage.record(variables, stamp)
+
+    log(f"[{stage.name}] {'finished' if ok else 'FAILED'} in {time.perf_counter() - start_time:.1f} s")
+    return True, ok
+
+
+def load_stages(config, overrides, state_dir):
+    variables = {"python": sys.executable, "scripts": str(SCRIPTS_DIR)}
+    variables.update(config.get("vars", {}))
+    variables.update(overrides)
+    variables = {key: expand(str(value), variables) if key not in ("python", "scripts") else value
+                 for key, value in variables.items()}
+
+    stages = [Stage(stage, variables, state_dir) for stage in config["stages"]]
+    names = {stage.name for stage in stages}
+    for stage in stages:
+        for dependency in stage.after:
+            if dependency not in names:
+                raise ValueError(f"Stage '{stage.name}' waits for unknown stage '{dependency}'")
+    return stages
+
+
+def run_pipeline(stages, jobs=4, force=(), only=None, dry_run=False):
+    """
+    Run the stages in dependency order, up to jobs stages at the same time.
+    Stages depending on a failed stage are not started. Returns True if every stage succeeded.
+    """
+    selected = {stage.name for stage in stages if only is None or stage.name in only}
+    pending = {stage.name: stage for stage in stages if stage.name in selected}
+    done, ran, failed = set(), set(), set()
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        running = {}
+        while pending or running:
+            for name, stage in list(pending.items()):
+                dependencies = [d for d in stage.after if d in selected]
+                if any(d in failed for d in dependencies):
+                    log(f"[{name}] skipped, a stage it depends on failed")
+                    failed.add(name)
+                    del pending[name]
+                elif all(d in done for d in dependencies):
+                    dependency_ran = any(d in ran for d in dependencies)
+                    running[executor.submit(run_stage, stage, name in force, dependency_ran, dry_run)] = name
+                    del pending[name]
+
+            if not running:
+                if pending:
+                    raise ValueError(f"Dependency cycle between stages {', '.join(pending)}")
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    stage_ran, ok = future.result()
+                except Exception as e:
+                    log(f"[{name}] FAILED: {e}")
+                    stage_ran, ok = True, False
+                if stage_ran:
+                    ran.add(name)
+                (done if ok else failed).add(name)
+
+    if not failed and not dry_run:
+        refresh_stamps([stage for stage in stages if stage.name in selected])
+    return not failed
+
+
+def refresh_stamps(stages):
+    """
+    Take the current state as the new baseline of every stage that has been run before.
+    """
+    for stage in stages:
+        for variables, stamp in stage.items():
+            if stamp.exists():
+                stage.record(variables, stamp)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the MVPS processing chain like make: stages whose inputs didn't change since their last "
+                    "successful run are skipped and independent stages run concurrently.")
+    parser.add_argument("config", type=Path, nargs="?", help="Pipeline description (JSON), see --example")
+    parser.add_argument("--example", action="store_true", help="Print an example pipeline covering the full chain")
+    parser.add_argument("--set", action="append", default=[], metavar="VAR=VALUE",
+                        help="Override a variable of the config, e.g. --set dataset=D:/capture/views")
+    parser.add_argument("--jobs", type=int, default=4, help="Maximum number of stages running at the same time (default: 4)")
+    parser.add_argument("--only", nargs="+", help="Only consider these stages")
+    parser.add_argument("--force", nargs="+", default=[], help="Run these stages even if they are up to date")
+    parser.add_argument("--dry_run", action="store_true", help="Only report which stages are out of date")
+    parser.add_argument("--state_dir", type=Path,
+                        help=f"Folder for the stage stamps (default: {STATE_DIR_NAME} next to the config)")
+    metrics.add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.example:
+        print(json.dumps(EXAMPLE_CONFIG, indent=2))
+        return
+    if args.config is None:
+        parser.error("the config file is required (use --example to get one)")
+
+    with open(args.config, "r") as f:
+        config = json.load(f)
+    overrides = dict(item.split("=", 1) for item in args.set)
+
+    # Relative paths in the config are relative to the config file
+    state_dir = (args.state_dir or args.config.parent / STATE_DIR_NAME).resolve()
+    os.chdir(args.config.resolve().parent)
+
+    stages = load_stages(config, overrides, state_dir)
+    start_time = time.perf_counter()
+    with metrics.collect_metrics(args, "pipeline"):
+        ok = run_pipeline(stages, args.jobs, set(args.force), set(args.only) if args.only else None, args.dry_run)
+    print(f"Pipeline {'finished' if ok else 'FAILED'} in {time.perf_counter() - start_time:.1f} s")
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
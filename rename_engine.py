@@ -0,0 +1,172 @@
+import json
+import os
+
+from metrics import Progress, count, stage
+
+JOURNAL_NAME = ".rename_journal.json"
+JOURNAL_VERSION = 1
+
+
+class UnfinishedRenameError(RuntimeError):
+    pass
+
+
+def _key(name):
+    # Names that clash on this platform's filesystem (case-insensitive on Windows)
+    return os.path.normcase(name)
+
+
+def plan_renames(mapping, existing=()):
+    """
+    Order the renames of mapping {old_name: new_name} (names inside one directory) so that no entry is overwritten.
+    Entries keeping their name are dropped, chains are renamed from their free end, and only real cycles
+    (a -> b -> a) go through one temporary name each, so n renames cost n + (number of cycles) operations.
+    existing are the other names in the directory; a target taken by an entry that isn't renamed is an error.
+    Returns the list of (src, dst) operations.
+    """
+    moves = {src: dst for src, dst in mapping.items() if src != dst}
+    targets = {}
+    for src, dst in moves.items():
+        if _key(dst) in targets:
+            raise ValueError(f"Both '{targets[_key(dst)]}' and '{src}' would be renamed to '{dst}'")
+        targets[_key(dst)] = src
+
+    sources = {_key(src): src for src in moves}
+    existing_keys = {_key(name) for name in existing}
+    for key in existing_keys:
+        if key in targets and key not in sources:
+            raise ValueError(f"Cannot rename '{targets[key]}', its new name is taken by an entry that keeps its name")
+
+    # blocked_by[a] = b: b is renamed to a's current name, so it has to wait until a moved away.
+    # A case-only rename (IMG.JPG -> img.jpg on a case-insensitive filesystem) doesn't wait for itself.
+    blocked_by = {}
+    for src, dst in moves.items():
+        blocker = sources.get(_key(dst))
+        if blocker is not None and blocker != src:
+            blocked_by[blocker] = src
+
+    operations = []
+    pending = set(moves)
+    ready = [src for src in moves if sources.get(_key(moves[src])) in (None, src)]
+    temp_count = 0
+    while pending:
+        while ready:
+            src = ready.pop()
+            operations.append((src, moves[src]))
+            pending.discard(src)
+            if blocked_by.get(src) in pending:
+                ready.append(blocked_by[src])
+        if pending:
+            # Only cycles are left: park one entry under a temporary name, which unblocks the rest of its cycle,
+            # and move it to its target once the entry holding that name is gone
+            start = min(pending)
+            temp = f".__rename_tmp_{temp_count}__"
+            while _key(temp) in existing_keys or temp in moves:
+                temp_count += 1
+                temp = f".__rename_tmp_{temp_count}__"
+            temp_count += 1
+            operations.append((start, temp))
+            pending.discard(start)
+            moves[temp] = moves.pop(start)
+            pending.add(temp)
+            blocked_by[sources[_key(moves[temp])]] = temp
+            if blocked_by.get(start) in pending:
+                ready.append(blocked_by[start])
+    return operations
+
+
+def _scan_inodes(directory):
+    with os.scandir(directory) as it:
+        return {entry.name: entry.inode() for entry in it}
+
+
+def _write_journal(directory, journal):
+    path = os.path.join(directory, JOURNAL_NAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(journal, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def _execute(directory, operations, quiet):
+    progress = None if quiet else Progress(len(operations), f"Renaming in {directory}", "renames")
+    with stage("rename"):
+        for src, dst in operations:
+            os.rename(os.path.join(directory, src), os.path.join(directory, dst))
+            if progress is not None:
+                progress.update()
+        count(renamed=len(operations))
+    if progress is not None:
+        progress.close()
+
+
+def check_journal(directory):
+    if os.path.exists(os.path.join(directory, JOURNAL_NAME)):
+        raise UnfinishedRenameError(f"Found an unfinished rename in {directory} ({JOURNAL_NAME}), "
+                                    f"finish it with --recover forward or undo it with --recover back")
+
+
+def rename_entries(directory, mapping, dry_run=False, quiet=False):
+    """
+    Rename entries of directory according to mapping {old_name: new_name}, see plan_renames for the order.
+    Before the first rename a journal with the old and new name and the inode of every renamed entry is written to
+    the directory (and removed when done), so an interrupted run can be finished or undone with recover().
+    quiet hides the progress line. Returns the number of renamed entries.
+    """
+    directory = os.fspath(directory)
+    check_journal(directory)
+    with stage("plan"):
+        inodes = _scan_inodes(directory)
+        missing = [src for src in mapping if src not in inodes]
+        if missing:
+            raise FileNotFoundError(f"'{missing[0]}' not found in {directory}")
+        operations = plan_renames(mapping, inodes)
+    num_renamed = sum(1 for src, dst in mapping.items() if src != dst)
+    if dry_run:
+        for src, dst in operations:
+            print(f"Would rename: {src} -> {dst}")
+        print(f"{num_renamed} entries would be renamed in {len(operations)} operations in {directory}")
+        return num_renamed
+    if not operations:
+        return 0
+
+    _write_journal(directory, {
+        "version": JOURNAL_VERSION,
+        "entries": [{"src": src, "dst": dst, "inode": inodes[src]} for src, dst in mapping.items() if src != dst],
+    })
+    _execute(directory, operations, quiet)
+    os.remove(os.path.join(directory, JOURNAL_NAME))
+    return num_renamed
+
+
+def recover(directory, direction="forward", quiet=False):
+    """
+    Finish (direction "forward") or undo ("back") an interrupted rename_entries run from its journal.
+    The entries are found by their inode wherever the interrupted run left them, and the remaining renames
+    are planned again, so recovery can itself be interrupted and repeated.
+    Returns the number of renamed entries, or None if there is no journal.
+    """
+    directory = os.fspath(directory)
+    journal_path = os.path.join(directory, JOURNAL_NAME)
+    if not os.path.exists(journal_path):
+        return None
+    with open(journal_path, "r") as f:
+        journal = json.load(f)
+
+    inodes = _scan_inodes(directory)
+    name_of_inode = {inode: name for name, inode in inodes.items()}
+    mapping = {}
+    for entry in journal["entries"]:
+        current = name_of_inode.get(entry["inode"])
+        if current is None:
+            raise FileNotFoundError(f"'{entry['src']}' (inode {entry['inode']}) is no longer in {directory}")
+        mapping[current] = entry["dst"] if direction == "forward" else entry["src"]
+
+    operations = plan_renames(mapping, inodes)
+    _execute(directory, operations, quiet)
+    os.remove(journal_path)
+    num_renamed = sum(1 for src, dst in mapping.items() if src != dst)
+    print(f"Recovered {directory}: {num_renamed} entries renamed {direction}")
+    return num_renamed
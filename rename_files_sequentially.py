@@ -1,37 +1,36 @@
 from pathlib import Path
-from natsort import natsorted
+from dataset_index import list_files, natural_key
+from rename_engine import UnfinishedRenameError, recover, rename_entries
+from metrics import add_metrics_arguments, collect_metrics
 import argparse
 
-def rename_sequentially(base_path, start_id):
+def rename_sequentially(base_path, start_id, dry_run=False, quiet=False):
     if not base_path.is_dir():
         print(f"Error: {base_path} is not a directory.")
         return
 
     # Get all files in the directory (not folders)
-    files = [f for f in base_path.iterdir() if f.is_file()]
+    files = list_files(base_path)
 
     # Sort by natural sort on file *stem* (name without extension)
-    sorted_files = natsorted(files, key=lambda x: x.stem)
+    sorted_files = sorted(files, key=lambda x: natural_key(x.stem))
 
     # Determine number of digits (at least 2)
     total_files = len(sorted_files) + start_id
     digits = max(2, len(str(total_files - 1)))
 
-    # First pass: rename to temporary names to avoid conflicts
-    temp_files = []
-    for i, file in enumerate(sorted_files):
-        temp_path = file.with_name(f"__temp_{i}__{file.suffix}")
-        file.rename(temp_path)
-        temp_files.append(temp_path)
+    # Only the files whose name changes are renamed, cycles go through a temporary name
+    mapping = {file.name: f"{i:0{digits}d}{file.suffix.lower()}" for i, file in enumerate(sorted_files, start=start_id)}
+    try:
+        num_renamed = rename_entries(base_path, mapping, dry_run=dry_run, quiet=quiet)
+    except (UnfinishedRenameError, ValueError) as e:
+        print(f"Error: {e}")
+        return
+    if not dry_run:
+        print(f"Renamed {num_renamed} of {len(mapping)} files")
 
-    # Second pass: rename to final sequential names
-    for i, file in enumerate(temp_files, start=start_id):
-        new_name = f"{i:0{digits}d}{file.suffix.lower()}"
-        new_path = base_path / new_name
-        file.rename(new_path)
-        print(f"Renamed: {file.name} -> {new_name}")
 
-if __name__ == "__main__":
+def main(argv=None):
     parser = argparse.ArgumentParser(
         description="Rename files sequentially with natural sort order."
     )
@@ -46,6 +45,31 @@ if __name__ == "__main__":
         default=0,
         help="Starting number for sequential file naming."
     )
+    parser.add_argument(
+        "--dry-run", "--dry_run",
+        dest="dry_run",
+        action="store_true",
+        help="Only print the planned renames."
+    )
+    parser.add_argument(
+        "--quiet",
+        action="store_true",
+        help="Print only the summary, no progress line."
+    )
+    parser.add_argument(
+        "--recover",
+        choices=["forward", "back"],
+        help="Finish (forward) or undo (back) an interrupted run in base_dir."
+    )
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args(argv)
+    with collect_metrics(args, "rename_files_sequentially"):
+        if args.recover:
+            recover(args.base_dir, args.recover, args.quiet)
+        else:
+            rename_sequentially(args.base_dir, args.start, args.dry_run, args.quiet)
 
-    args = parser.parse_args()
-    rename_sequentially(args.base_dir, args.start)
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,66 @@
 import os
-import shutil
-from natsort import natsorted
+from dataset_index import JPEG_EXTENSIONS, DatasetIndex, has_extension
+from rename_engine import JOURNAL_NAME, UnfinishedRenameError, recover, rename_entries
+from metrics import Progress, add_metrics_arguments, collect_metrics, stage
 import argparse
 
-def rename_images_in_subfolders(parent_folder):
-	valid_extensions = ('.jpg', '.jpeg', '.JPG', '.JPEG', '.jfif', '.JFIF')
+def rename_images_in_subfolders(parent_folder, dry_run=False, quiet=False):
+	dataset_index = DatasetIndex(parent_folder)
+	with stage("list"):
+		folders = list(dataset_index.walk())
+	progress = None if quiet or dry_run else Progress(len(folders), "Renamed images in", "folders")
+	total_renamed = 0
 	# Iterate through each subfolder in the parent folder
-	for subdir, dirs, files in os.walk(parent_folder):
+	for rel, dirs, files in folders:
+		subdir = os.path.join(parent_folder, rel)
 		# Filter only image files
-
-		image_files = [f for f in files if f.endswith(valid_extensions)]
+		image_files = [f.name for f in files if has_extension(f.name, JPEG_EXTENSIONS)]
 
 		# Sort the files alphabetically
 		image_files.sort()
 
-		# Rename each image file sequentially
-		for index, filename in enumerate(image_files):
-			# Create the new filename with a sequential number (padded with leading zeros)
-			new_filename = f"L{index:02}.jpg"
+		# New name of each image file (sequential number padded with leading zeros),
+		# only the files whose name changes are renamed
+		mapping = {filename: f"L{index:02}.jpg" for index, filename in enumerate(image_files)}
+		try:
+			total_renamed += rename_entries(subdir, mapping, dry_run=dry_run, quiet=True)
+		except (UnfinishedRenameError, ValueError) as e:
+			if progress is not None:
+				progress.print(f"Error: {e}")
+			else:
+				print(f"Error: {e}")
+		if progress is not None:
+			progress.update()
+	if progress is not None:
+		progress.close()
+	dataset_index.save()
+	print(f"Renaming complete for all subfolders ({total_renamed} images renamed).")
 
-			# Define the full patchs for the old and new filenames
-			old_filepath = os.path.join(subdir, filename)
-			new_filename = os.path.join(subdir, new_filename)
+def recover_subfolders(parent_folder, direction, quiet=False):
+	# Finish or undo the renames interrupted in any subfolder
+	dataset_index = DatasetIndex(parent_folder, use_cache=False)
+	for rel, dirs, files in dataset_index.walk():
+		if any(f.name == JOURNAL_NAME for f in files):
+			recover(os.path.join(parent_folder, rel), direction, quiet)
 
-			# Rename the file
-			os.rename(old_filepath, new_filename)
-		print(f"Renamed all images in {subdir}")
-	print("Renaming complete for all subfolders.")
 
-if __name__ == "__main__":
+def main(argv=None):
 	# Set up argument parsing
 	parser = argparse.ArgumentParser(description="Rename all images in subfolders to L00, L01, ..., L99")
 	parser.add_argument("folder_path", type=str, help="The path to the folder containing the image subfolders")
+	parser.add_argument("--dry-run", "--dry_run", dest="dry_run", action="store_true", help="Only print the planned renames.")
+	parser.add_argument("--quiet", action="store_true", help="Print only the final summary, no progress line.")
+	parser.add_argument("--recover", choices=["forward", "back"], help="Finish (forward) or undo (back) interrupted runs in all subfolders.")
+	add_metrics_arguments(parser)
 	# Parse the arguments
-	args = parser.parse_args()
+	args = parser.parse_args(argv)
+
+	with collect_metrics(args, "rename_images_in_folders"):
+		if args.recover:
+			recover_subfolders(args.folder_path, args.recover, args.quiet)
+		else:
+			rename_images_in_subfolders(args.folder_path, args.dry_run, args.quiet)
 
-	rename_images_in_subfolders(args.folder_path)
\ No newline at end of file
+
+if __name__ == "__main__":
+	main()
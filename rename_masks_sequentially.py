@@ -1,42 +1,48 @@
 import os
 import argparse
-from natsort import natsorted
+from dataset_index import list_files
+from rename_engine import UnfinishedRenameError, recover, rename_entries
+from metrics import add_metrics_arguments, collect_metrics
 
-def rename_masks(folder_path):
+def rename_masks(folder_path, dry_run=False, quiet=False):
 	# Supported image extensions
-	valid_extensions = ('.jpg', '.jpeg', '.jfif', '.JPG', '.JPEG', '.JFIF', '.png', '.PNG', '.webp', '.WEBP')
-
-	# Get the list of the masks files
-	files = [f for f in os.listdir(folder_path) if os.path.isfile(os.path.join(folder_path, f)) and f.endswith(valid_extensions)]
-
-	# Sort the masks files
-	files = natsorted(files)
-
-	# Rename each mask sequentially
-	for index, filename in enumerate(files):
-		# Get the file extension
-		file_extension = os.path.splitext(filename)[1]
-
-		# Create the new filename with a sequential number
-		new_filename = f"{index:02}_mask{file_extension}"
-
-		# Define the full paths for the old and new filenames
-		old_filepath = os.path.join(folder_path, filename)
-		new_filepath = os.path.join(folder_path, new_filename)
-
-		# Rename the file
-		os.rename(old_filepath, new_filepath)
-		print(f"Ranamed: {old_filepath} to {new_filepath}")
+	valid_extensions = {'.jpg', '.jpeg', '.jfif', '.png', '.webp'}
+
+	# Get the naturally sorted list of the masks files
+	files = [f.name for f in list_files(folder_path, valid_extensions)]
+
+	# New name of each mask, only the masks whose name changes are renamed
+	mapping = {filename: f"{index:02}_mask{os.path.splitext(filename)[1]}" for index, filename in enumerate(files)}
+	try:
+		rename_entries(folder_path, mapping, dry_run=dry_run, quiet=quiet)
+	except (UnfinishedRenameError, ValueError) as e:
+		print(f"Error: {e}")
+		return
+	if dry_run:
+		return
 	print("Renamed all images")
 
- 
-if __name__ == "__main__":
+
+def main(argv=None):
 	# Set up argument parsing
 	parser = argparse.ArgumentParser(description="Rename the image files sequentially in a folder.")
 	parser.add_argument("folder_path", type=str, help="The path to the folder containing the image files.")
+	parser.add_argument("--dry-run", "--dry_run", dest="dry_run", action="store_true", help="Only print the planned renames.")
+	parser.add_argument("--quiet", action="store_true", help="Print only the summary, no progress line.")
+	parser.add_argument("--recover", choices=["forward", "back"], help="Finish (forward) or undo (back) an interrupted run.")
+
+	add_metrics_arguments(parser)
 
 	# Parse the arguments
-	args = parser.parse_args()
+	args = parser.parse_args(argv)
 
 	# Rename the images sequentially in a specified folder
-	rename_masks(args.folder_path)
\ No newline at end of file
+	with collect_metrics(args, "rename_masks_sequentially"):
+		if args.recover:
+			recover(args.folder_path, args.recover, args.quiet)
+		else:
+			rename_masks(args.folder_path, args.dry_run, args.quiet)
+
+
+if __name__ == "__main__":
+	main()
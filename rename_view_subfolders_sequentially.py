@@ -1,37 +1,34 @@
 from pathlib import Path
-from natsort import natsorted
+from dataset_index import list_subdirs
+from rename_engine import UnfinishedRenameError, recover, rename_entries
+from metrics import add_metrics_arguments, collect_metrics
 import argparse
 
-def rename_subfolders(base_path, start_id):
+def rename_subfolders(base_path, start_id, dry_run=False, quiet=False):
     if not base_path.is_dir():
         print(f"Error: {base_path} is not a directory.")
         return
 
     # Get subfolders only
-    folders = [f for f in base_path.iterdir() if f.is_dir()]
-
-    # Sort folders by natural sort
-    sorted_folders = natsorted(folders, key=lambda x: x.name)
+    # Get subfolders only, in natural sort order
+    sorted_folders = list_subdirs(base_path)
 
     # Determine digits (at least 2)
     total_folders = len(sorted_folders) + start_id
     digits = max(2, len(str(total_folders - 1)))
 
-    # First pass: rename to temporary folder names
-    temp_folders = []
-    for i, folder in enumerate(sorted_folders):
-        temp_path = folder.with_name(f"__temp_{i}__")
-        folder.rename(temp_path)
-        temp_folders.append(temp_path)
+    # Only the folders whose name changes are renamed, cycles go through a temporary name
+    mapping = {folder.name: f"view_{i:0{digits}d}.data" for i, folder in enumerate(sorted_folders, start=start_id)}
+    try:
+        num_renamed = rename_entries(base_path, mapping, dry_run=dry_run, quiet=quiet)
+    except (UnfinishedRenameError, ValueError) as e:
+        print(f"Error: {e}")
+        return
+    if not dry_run:
+        print(f"Renamed {num_renamed} of {len(mapping)} subfolders")
 
-    # Second pass: rename to final format
-    for i, folder in enumerate(temp_folders, start=start_id):
-        new_name = f"view_{i:0{digits}d}.data"
-        new_path = base_path / new_name
-        folder.rename(new_path)
-        print(f"Renamed: {folder.name} -> {new_name}")
 
-if __name__ == "__main__":
+def main(argv=None):
     parser = argparse.ArgumentParser(
         description="Rename subfolders in sequential order using natural sort."
     )
@@ -46,6 +43,31 @@ if __name__ == "__main__":
         type=int,
         help="Starting number for sequential subfolder naming."
     )
+    parser.add_argument(
+        "--dry-run", "--dry_run",
+        dest="dry_run",
+        action="store_true",
+        help="Only print the planned renames."
+    )
+    parser.add_argument(
+        "--quiet",
+        action="store_true",
+        help="Print only the summary, no progress line."
+    )
+    parser.add_argument(
+        "--recover",
+        choices=["forward", "back"],
+        help="Finish (forward) or undo (back) an interrupted run in base_dir."
+    )
+    add_metrics_arguments(parser)
 
-    args = parser.parse_args()
-    rename_subfolders(args.base_dir, args.start)
+    args = parser.parse_args(argv)
+    with collect_metrics(args, "rename_view_subfolders_sequentially"):
+        if args.recover:
+            recover(args.base_dir, args.recover, args.quiet)
+        else:
+            rename_subfolders(args.base_dir, args.start, args.dry_run, args.quiet)
+
+
+if __name__ == "__main__":
+    main()
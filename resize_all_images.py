@@ -1,42 +1,88 @@
 import os
-import subprocess
 import argparse
+import sys
+import time
+from dataset_index import DatasetIndex
+from metrics import Progress, add_metrics_arguments, collect_metrics, run_subprocess, stage
 
 
 def crop_and_resize(folder_path, crop_ROI, resized_size):
 	# Get the list of subfolders in the parent folder
-	subfolders = [f for f in os.listdir(folder_path) if os.path.isdir(os.path.join(folder_path, f))]
-
-	for subfolder in subfolders:
-		subfolder_path = os.path.join(folder_path, subfolder)
-
-		try:
-			# Construct the ImageMagick commands
-			# crop_command = ['mogrify', '-crop', '3008x3008+504+0', '*.jpg']
-			# resize_command = ['mogrify', '-crop', '2560x2560+728+224', '-resize', '1024x1024', '-quality', '100', '*.jpg']
-			command = ['mogrify', '-crop', crop_ROI, '-resize', resized_size, '-quality', '100', '*.jpg']
-			# # Run the crop command in the current subfolder
-			# subprocess.run(crop_command, shell=True, cwd=subfolder_path, check=True)
-			# print(f"Cropped the images in the directory: {subfolder_path}")
-
-			# Run the resize command in the current subfolder
-			subprocess.run(command, shell=True, cwd=subfolder_path, check=True)
-			print(f"Resized the images in the directory: {subfolder_path}")
-
-		except Exception as e:
-			print(f"An error occured in folder {subfolder_path}: {e}")
+	with DatasetIndex(folder_path) as index:
+		subfolders = index.subdirs()
+
+	progress = Progress(len(subfolders), "Resized the images in", "folders")
+	with stage("resize"):
+		for subfolder in subfolders:
+			subfolder_path = os.path.join(folder_path, subfolder)
+
+			try:
+				# Construct the ImageMagick commands
+				# crop_command = ['mogrify', '-crop', '3008x3008+504+0', '*.jpg']
+				# resize_command = ['mogrify', '-crop', '2560x2560+728+224', '-resize', '1024x1024', '-quality', '100', '*.jpg']
+				command = ['mogrify', '-crop', crop_ROI, '-resize', resized_size, '-quality', '100', '*.jpg']
+				# # Run the crop command in the current subfolder
+				# subprocess.run(crop_command, shell=True, cwd=subfolder_path, check=True)
+				# print(f"Cropped the images in the directory: {subfolder_path}")
+
+				# Run the resize command in the current subfolder
+				run_subprocess(command, shell=True, cwd=subfolder_path, check=True)
+
+			except Exception as e:
+				progress.print(f"An error occured in folder {subfolder_path}: {e}")
+			progress.update()
+	progress.close()
 			
 	print("Cropped and resized all images.")
 
 
-if __name__ == "__main__":
+def crop_and_resize_native(folder_path, crop_ROI, resized_size, jobs=None, reduced_decode=True):
+	# Imported here so the mogrify path keeps working without OpenCV installed
+	from resizing import process_images_parallel, report_throughput
+
+	# Same selection as the mogrify path (*.jpg in every subfolder), but every image becomes its own task
+	images = []
+	with DatasetIndex(folder_path) as index:
+		for subfolder in index.subdirs():
+			subfolder_path = os.path.join(folder_path, subfolder)
+			images.extend(os.path.join(subfolder_path, f.name) for f in index.files(subfolder) if f.name.endswith('.jpg'))
+
+	start_time = time.perf_counter()
+	num_errors = 0
+	progress = Progress(len(images), "Processed", "images")
+	with stage("resize"):
+		for image_path, error in process_images_parallel(images, crop_ROI, resized_size, 100, jobs, reduced_decode):
+			if error is not None:
+				num_errors += 1
+				progress.print(f"An error occured for image {image_path}: {error}")
+			progress.update()
+	progress.close()
+	report_throughput(len(images), start_time, num_errors)
+	if num_errors:
+		# A partial run must not count as done (e.g. by pipeline.py, which would skip the stage next time)
+		sys.exit(1)
+
+
+def main(argv=None):
 	# Set up argument parsing
 	parser = argparse.ArgumentParser(description="Crop and resize the jpg images in the subfolders of a given folder")
 	parser.add_argument("folder_path", type=str, help="The path to the folder containing the image subfolders")
 	parser.add_argument("crop_ROI", type=str)
 	parser.add_argument("resized_size", type=str)
+	parser.add_argument("--engine", choices=["magick", "native"], default="magick", help="Run mogrify per subfolder or process the images in-process with a worker pool")
+	parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Number of images processed in parallel by the native engine")
+	parser.add_argument("--full_decode", action="store_true", help="Native engine: always decode the JPEGs at full resolution instead of at 1/2, 1/4 or 1/8 of their size when the resize allows it")
+	add_metrics_arguments(parser)
 	# Parse the arguments
-	args = vars(parser.parse_args())
+	args = parser.parse_args(argv)
 
 	# Crop and resize the images in each subfolder
-	crop_and_resize(**args)
\ No newline at end of file
+	with collect_metrics(args, "resize_all_images"):
+		if args.engine == "native":
+			crop_and_resize_native(args.folder_path, args.crop_ROI, args.resized_size, jobs=args.jobs, reduced_decode=not args.full_decode)
+		else:
+			crop_and_resize(args.folder_path, args.crop_ROI, args.resized_size)
+
+
+if __name__ == "__main__":
+	main()
@@ -1,16 +1,24 @@
 from pathlib import Path
 import argparse
-import subprocess
+import os
 import sys
+import time
+from dataset_index import IMAGE_EXTENSIONS, DatasetIndex, has_extension
+from image_cache import add_cache_arguments, open_cache
+from metrics import Progress, add_metrics_arguments, collect_metrics, count, run_subprocess, stage
 
-# Supported image extensions (case-insensitive)
-IMAGE_EXTENSIONS = {
-    ".jpg", ".jpeg", ".png", ".gif", ".tiff", ".tif", ".bmp",
-    ".webp", ".heic", ".heif", ".avif", ".jp2", ".j2k", ".jpf",
-    ".jpx", ".jpm", ".svg", ".jxl"
-}
 
-def process_images(base_dir: Path, crop: str = None, resize: str = None):
+def list_folder_images(base_dir: Path, views=None):
+    """
+    The images of every folder below base_dir (what rglob("*") visits, so not base_dir itself), from the cached dataset index.
+    views optionally restricts the walk to the given subfolders (names) of base_dir.
+    """
+    with DatasetIndex(base_dir) as index:
+        return [(base_dir / rel, [base_dir / rel / f.name for f in files if has_extension(f.name, IMAGE_EXTENSIONS)])
+                for rel, _, files in index.walk() if rel and (views is None or rel.split("/")[0] in views)]
+
+
+def process_images(base_dir: Path, crop: str = None, resize: str = None, views=None):
     if not base_dir.is_dir():
         print(f"Error: {base_dir} is not a directory.")
         sys.exit(1)
@@ -24,17 +32,103 @@ def process_images(base_dir: Path, crop: str = None, resize: str = None):
     
     cmd_base.extend(["-quality", "100"])
 
+    with stage("list"):
+        folders = list_folder_images(base_dir, views)
+
     # Process each folder separately (mogrify works in-place per folder)
-    for folder in base_dir.rglob("*"):
-        if folder.is_dir():
-            images = [str(f) for f in folder.iterdir()
-                      if f.is_file() and f.suffix.lower() in IMAGE_EXTENSIONS]
+    progress = Progress(sum(len(images) for _, images in folders), "Processed", "images")
+    with stage("resize"):
+        for folder, images in folders:
             if images:
-                cmd = cmd_base + images
-                print(f"Processing {len(images)} images in {folder}...")
-                subprocess.run(cmd, check=True)
+                cmd = cmd_base + [str(f) for f in images]
+                run_subprocess(cmd, check=True)
+                count(files_read=len(images), files_written=len(images))
+                progress.update(len(images))
+    progress.close()
 
-if __name__ == "__main__":
+def process_images_native(base_dir: Path, crop: str = None, resize: str = None, quality: int = 100, jobs: int = None,
+                          views=None, reduced_decode: bool = True, output_dir: Path = None, cache=None):
+    # Imported here so the mogrify path keeps working without OpenCV installed
+    from resizing import process_images_parallel, report_throughput
+
+    if not base_dir.is_dir():
+        print(f"Error: {base_dir} is not a directory.")
+        sys.exit(1)
+
+    # Same selection as the mogrify path, but every image becomes its own task
+    with stage("list"):
+        images = [f for _, folder_images in list_folder_images(base_dir, views) for f in folder_images]
+    output_paths = [output_dir / image_path.relative_to(base_dir) for image_path in images] if output_dir else None
+    print(f"Processing {len(images)} images in {base_dir} with {jobs or os.cpu_count()} workers...")
+
+    start_time = time.perf_counter()
+    num_errors = 0
+    progress = Progress(len(images), "Processed", "images")
+    with stage("resize"):
+        for image_path, error in process_images_parallel(images, crop, resize, quality, jobs, reduced_decode,
+                                                         output_paths, cache):
+            if error is not None:
+                num_errors += 1
+                progress.print(f"An error occurred for image {image_path}: {error}")
+            progress.update()
+    progress.close()
+    report_throughput(len(images), start_time, num_errors)
+    if num_errors:
+        # A partial run must not count as done (e.g. by pipeline.py, which would skip the stage next time)
+        sys.exit(1)
+
+
+def process_images_fused(base_dir: Path, stack_dir: Path, crop: str = None, resize: str = None, quality: int = 100,
+                         jobs: int = None, views=None, mode: str = "max", percentile: float = None,
+                         memory_budget: int = None, reduced_decode: bool = True, output_dir: Path = None,
+                         cache=None):
+    # Imported here so the mogrify path keeps working without OpenCV installed
+    from resizing import resize_and_stack_parallel, report_throughput
+    from stacking import DEFAULT_MEMORY_BUDGET, PERCENTILE_MODES, STACK_MODES
+
+    if not base_dir.is_dir():
+        print(f"Error: {base_dir} is not a directory.")
+        sys.exit(1)
+    if mode not in STACK_MODES + PERCENTILE_MODES:
+        print(f"Error: stack mode '{mode}' is not supported ({', '.join(STACK_MODES + PERCENTILE_MODES)}).")
+        sys.exit(1)
+    if mode == "percentile" and (percentile is None or not 0 <= percentile <= 100):
+        print("Error: --stack_mode percentile requires --percentile between 0 and 100.")
+        sys.exit(1)
+
+    # Same selection as process_images_native; the direct subfolders of base_dir (the views) are also stacked,
+    # like create_stacked.py base_dir stack_dir does on the resized images
+    with stage("list"):
+        folders = [(folder, images, folder.parent == base_dir) for folder, images in list_folder_images(base_dir, views)]
+    num_images = sum(len(images) for _, images, _ in folders)
+    output_folders = None
+    if output_dir:
+        output_folders = {folder: output_dir / folder.relative_to(base_dir) for folder, _, _ in folders}
+    stack_dir.mkdir(parents=True, exist_ok=True)
+    print(f"Processing {num_images} images in {base_dir} and stacking them into {stack_dir} "
+          f"with {jobs or os.cpu_count()} workers...")
+
+    start_time = time.perf_counter()
+    num_errors = 0
+    progress = Progress(num_images, "Processed", "images")
+    with stage("resize_stack"):
+        for folder, images, errors, stack_error in resize_and_stack_parallel(
+                folders, stack_dir, crop, resize, quality, mode, percentile, memory_budget or DEFAULT_MEMORY_BUDGET,
+                jobs=jobs, reduced_decode=reduced_decode, output_folders=output_folders, cache=cache):
+            for image_path, error in errors:
+                progress.print(f"An error occurred for image {image_path}: {error}")
+            if stack_error is not None:
+                progress.print(f"An error occurred while stacking {folder}: {stack_error}")
+            num_errors += len(errors) + (stack_error is not None)
+            progress.update(len(images))
+    progress.close()
+    report_throughput(num_images, start_time, num_errors)
+    if num_errors:
+        # A partial run must not count as done (e.g. by pipeline.py, which would skip the stage next time)
+        sys.exit(1)
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser(
         description="Recursively crop and/or resize images using ImageMagick's mogrify."
     )
@@ -53,10 +147,95 @@ if __name__ == "__main__":
         type=str,
         help='Resize size, e.g., "384x384".'
     )
+    parser.add_argument(
+        "--engine",
+        choices=["magick", "native"],
+        default="magick",
+        help="Run one mogrify process per folder or process the images in-process with a worker pool. Default: magick"
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of images processed in parallel by the native engine. Default: all cores"
+    )
+    parser.add_argument(
+        "--quality",
+        type=int,
+        default=100,
+        help="JPEG/WebP quality of the images written by the native engine. Default: 100"
+    )
+    parser.add_argument(
+        "--views",
+        nargs="+",
+        help="Only process these subfolders (names) of base_dir, e.g. the views that changed. Default: all"
+    )
+    parser.add_argument(
+        "--stack_dir",
+        type=Path,
+        help="Native engine: also stack the resized .jpg images of every subfolder into STACK_DIR/<subfolder>.jpg "
+             "in the same pass, like running create_stacked.py afterwards but without decoding the images again "
+             "and from the pixels before they are re-encoded"
+    )
+    parser.add_argument(
+        "--stack_mode",
+        type=str,
+        default="max",
+        help="Stack mode with --stack_dir: max, min, mean, add, median or percentile. Default: max"
+    )
+    parser.add_argument(
+        "--percentile",
+        type=float,
+        help="Percentile (0-100) computed per pixel by --stack_mode percentile, e.g. 90."
+    )
+    parser.add_argument(
+        "--memory_budget",
+        type=str,
+        default="1G",
+        help="Memory per view for --stack_mode median/percentile, larger stacks are spilled to disk. Default: 1G"
+    )
+    parser.add_argument(
+        "--full_decode",
+        action="store_true",
+        help="Native engine: always decode JPEGs at full resolution. By default a JPEG shrunk by 2x or more is "
+             "decoded at 1/2, 1/4 or 1/8 of its size by the JPEG decoder and resized from there"
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=Path,
+        help="Native engine: write the processed images to the same subfolders of OUTPUT_DIR instead of "
+             "overwriting them, so the originals can be processed again with other settings"
+    )
+    add_cache_arguments(parser)
+    add_metrics_arguments(parser)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if not args.crop and not args.resize:
         parser.error("You must provide at least one of --crop or --resize.")
+    if args.stack_dir and args.engine != "native":
+        parser.error("--stack_dir requires --engine native.")
+    if (args.output_dir or args.cache) and args.engine != "native":
+        parser.error("--output_dir and --cache require --engine native.")
+
+    with collect_metrics(args, "resize_all_images_new"):
+        cache = open_cache(args)
+        try:
+            if args.stack_dir:
+                from stacking import parse_size
 
-    process_images(args.base_dir, args.crop, args.resize)
+                process_images_fused(args.base_dir, args.stack_dir, args.crop, args.resize, args.quality, args.jobs,
+                                     args.views, args.stack_mode.lower(), args.percentile,
+                                     parse_size(args.memory_budget), not args.full_decode, args.output_dir, cache)
+            elif args.engine == "native":
+                process_images_native(args.base_dir, args.crop, args.resize, args.quality, args.jobs, args.views,
+                                      not args.full_decode, args.output_dir, cache)
+            else:
+                process_images(args.base_dir, args.crop, args.resize, args.views)
+        finally:
+            if cache is not None:
+                cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,399 @@
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import cv2
+
+from image_cache import operation_key
+from image_io import read_image_reduced, write_image
+from light_pack import close_light_packs, read_light_image
+from metrics import count
+from stacking import DEFAULT_MEMORY_BUDGET, new_accumulator, stack_key
+
+_CROP_GEOMETRY = re.compile(r"^\s*(\d+)x(\d+)([+-]\d+)([+-]\d+)\s*$")
+_RESIZE_GEOMETRY = re.compile(r"^\s*(\d*)(?:x(\d*))?\s*([!<>^]?)\s*$")
+_PERCENT_GEOMETRY = re.compile(r"^\s*(\d+(?:\.\d+)?)%\s*$")
+
+
+def parse_crop_geometry(geometry):
+    """
+    Parse an ImageMagick crop geometry "WxH+X+Y" into (width, height, x, y).
+    """
+    match = _CROP_GEOMETRY.match(geometry)
+    if not match:
+        raise ValueError(f"Invalid crop geometry '{geometry}', expected WxH+X+Y, e.g. 512x512+256+256")
+    return tuple(int(value) for value in match.groups())
+
+
+def parse_resize_geometry(geometry):
+    """
+    Validate an ImageMagick resize geometry. Supported forms are "WxH" (fit inside, keep the aspect
+    ratio), "W", "xH", "WxH!" (exact size), "WxH>" (only shrink), "WxH<" (only enlarge),
+    "WxH^" (fill) and "N%".
+    """
+    if _PERCENT_GEOMETRY.match(geometry):
+        return geometry
+    match = _RESIZE_GEOMETRY.match(geometry)
+    if not match or not (match.group(1) or match.group(2)):
+        raise ValueError(f"Invalid resize geometry '{geometry}', expected e.g. 384x384 or 50%")
+    return geometry
+
+
+def crop_box(image_width, image_height, crop):
+    """
+    Clip a (width, height, x, y) crop to the image, like ImageMagick does.
+    Returns (x0, y0, x1, y1) or None if the crop lies outside the image.
+    """
+    width, height, x, y = crop
+    x0, y0 = max(0, x), max(0, y)
+    x1, y1 = min(image_width, x + width), min(image_height, y + height)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1, y1
+
+
+def resize_target(image_width, image_height, geometry):
+    """
+    Compute the output size of an ImageMagick resize geometry for the given image size.
+    """
+    percent = _PERCENT_GEOMETRY.match(geometry)
+    if percent:
+        scale = float(percent.group(1)) / 100.0
+        return max(1, int(image_width * scale + 0.5)), max(1, int(image_height * scale + 0.5))
+
+    match = _RESIZE_GEOMETRY.match(geometry)
+    width = int(match.group(1)) if match.group(1) else None
+    height = int(match.group(2)) if match.group(2) else None
+    flag = match.group(3)
+
+    if flag == "!" and width and height:
+        return width, height
+
+    scale_x = width / image_width if width else None
+    scale_y = height / image_height if height else None
+    if scale_x is None:
+        scale = scale_y
+    elif scale_y is None:
+        scale = scale_x
+    elif flag == "^":
+        scale = max(scale_x, scale_y)
+    else:
+        scale = min(scale_x, scale_y)
+
+    if (flag == ">" and scale >= 1.0) or (flag == "<" and scale <= 1.0):
+        return image_width, image_height
+    return max(1, int(image_width * scale + 0.5)), max(1, int(image_height * scale + 0.5))
+
+
+def crop_image(image, crop=None):
+    """
+    Apply an optional crop (parsed geometry tuple).
+    """
+    if crop is not None:
+        box = crop_box(image.shape[1], image.shape[0], crop)
+        if box is None:
+            raise ValueError(f"Crop {crop} lies outside the image of size {image.shape[1]}x{image.shape[0]}")
+        x0, y0, x1, y1 = box
+        image = image[y0:y1, x0:x1]
+    return image
+
+
+def resize_image(image, resize=None, size=None):
+    """
+    Apply an optional resize (geometry string). size is the (width, height) the geometry refers to, the image
+    size unless the image was decoded at a reduced size.
+    """
+    if resize is not None:
+        height, width = image.shape[:2]
+        new_width, new_height = resize_target(*(size or (width, height)), resize)
+        if (new_width, new_height) != (width, height):
+            # Area averaging for downscaling avoids aliasing, cubic for the (rare) upscaling
+            downscale = new_width * new_height < width * height
+            interpolation = cv2.INTER_AREA if downscale else cv2.INTER_CUBIC
+            image = cv2.resize(image, (new_width, new_height), interpolation=interpolation)
+    return image
+
+
+def crop_and_resize(image, crop=None, resize=None):
+    """
+    Apply an optional crop (parsed geometry tuple) followed by an optional resize (geometry string).
+    """
+    return resize_image(crop_image(image, crop), resize)
+
+
+def reduction_factor(image_width, image_height, crop=None, resize=None):
+    """
+    The largest JPEG decode reduction (1, 2, 4 or 8) that gives the same crop and still leaves a downscale to the
+    resize: the crop box has to lie on the reduced pixel grid and the reduced crop has to stay at least as large
+    as the resize target, so the final interpolation keeps the quality of a full decode.
+    """
+    if resize is None:
+        return 1
+    box = crop_box(image_width, image_height, crop) if crop is not None else (0, 0, image_width, image_height)
+    if box is None:
+        return 1
+    x0, y0, x1, y1 = box
+    new_width, new_height = resize_target(x1 - x0, y1 - y0, resize)
+    for factor in (8, 4, 2):
+        if (x1 - x0) // factor < new_width or (y1 - y0) // factor < new_height:
+            continue
+        # All four edges have to be on the grid: at a right or bottom image edge that isn't, the decoder's last
+        # reduced pixel covers a partial block, and stretching it over the full-resolution extent would shift and
+        # scale the output (which matters for the camera intrinsics derived from these images)
+        if x0 % factor or y0 % factor or x1 % factor or y1 % factor:
+            continue
+        return factor
+    return 1
+
+
+def decode_cropped(image_path, crop=None, resize=None, reduced_decode=True):
+    """
+    Decode an image and apply the optional crop. With reduced_decode, a JPEG that the resize shrinks by 2x or more
+    is decoded at 1/2, 1/4 or 1/8 of its size (see reduction_factor) and cropped on the reduced grid.
+    Otherwise the full-resolution pixels come from the view's light pack when it is current.
+    Returns (image, size) where size is the full-resolution (width, height) of the crop, for resize_image.
+    """
+    full_size = None
+
+    def choose_reduction(width, height):
+        nonlocal full_size
+        full_size = (width, height)
+        return reduction_factor(width, height, crop, resize)
+
+    if reduced_decode and resize is not None:
+        image, reduction = read_image_reduced(image_path, choose_reduction)
+    else:
+        image, reduction = read_light_image(image_path), 1
+    if image is None:
+        raise IOError(f"Could not decode image {image_path}")
+
+    if reduction == 1:
+        image = crop_image(image, crop)
+        return image, (image.shape[1], image.shape[0])
+
+    x0, y0, x1, y1 = crop_box(*full_size, crop) if crop is not None else (0, 0) + full_size
+    image = image[y0 // reduction:y1 // reduction, x0 // reduction:x1 // reduction]
+    return image, (x1 - x0, y1 - y0)
+
+
+def process_image(image_path, crop=None, resize=None, quality=100, output_path=None, reduced_decode=True):
+    """
+    Crop and/or resize a single image, in place unless output_path is given.
+    Returns the number of bytes read and written.
+    """
+    image, size = decode_cropped(image_path, crop, resize, reduced_decode)
+    bytes_read = os.path.getsize(image_path)
+
+    image = resize_image(image, resize, size)
+    bytes_written = write_image(output_path or image_path, image, quality)
+    return bytes_read, bytes_written
+
+
+def _init_worker(threads=1):
+    # Parallelism comes from the process pool, keep OpenCV from oversubscribing the cores
+    cv2.setNumThreads(threads)
+
+
+def resize_key(digest, crop=None, resize=None, quality=100, reduced_decode=True, output_path=""):
+    """
+    ImageCache key of process_image applied to the source with the given content digest.
+    """
+    return operation_key("resize", [digest], crop=crop, resize=resize.strip() if resize else None,
+                         quality=int(quality), reduced_decode=bool(reduced_decode and resize),
+                         format=Path(output_path).suffix.lower())
+
+
+def _process_image_task(task):
+    image_path, output_path, crop, resize, quality, reduced_decode, cache, key = task
+    try:
+        if output_path is not None:
+            Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+        if cache is not None:
+            size = cache.get(key, output_path or image_path)
+            if size is not None:
+                return image_path, None, (0, size), True
+        result = process_image(image_path, crop, resize, quality, output_path, reduced_decode)
+        if cache is not None:
+            cache.put(key, output_path or image_path)
+        return image_path, None, result, False
+    except Exception as e:
+        return image_path, e, (0, 0), False
+
+
+def process_images_parallel(image_paths, crop=None, resize=None, quality=100, jobs=None, reduced_decode=True,
+                            output_paths=None, cache=None):
+    """
+    Crop and/or resize images, spreading individual images over a process pool.
+    crop is a "WxH+X+Y" geometry, resize an ImageMagick resize geometry; reduced_decode lets JPEGs that are shrunk
+    by 2x or more be decoded at a reduced size (see decode_cropped). The images are processed in place unless
+    output_paths gives the output of every image. With an ImageCache, outputs already computed from the same source
+    content with the same settings are copied from the cache instead.
+    Yields (image_path, error) as the images finish.
+    """
+    crop = parse_crop_geometry(crop) if crop else None
+    resize = parse_resize_geometry(resize) if resize else None
+    jobs = jobs or os.cpu_count() or 1
+    image_paths = list(image_paths)
+    output_paths = list(output_paths) if output_paths is not None else [None] * len(image_paths)
+    digests = cache.digests(image_paths) if cache is not None else {}
+
+    tasks = [(image_path, output_path, crop, resize, quality, reduced_decode, cache,
+              resize_key(digests[image_path], crop, resize, quality, reduced_decode, output_path or image_path)
+              if cache is not None else None)
+             for image_path, output_path in zip(image_paths, output_paths)]
+    chunksize = max(1, min(64, len(tasks) // (jobs * 4)))
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker) as executor:
+        for image_path, error, (bytes_read, bytes_written), hit in executor.map(_process_image_task, tasks,
+                                                                                chunksize=chunksize):
+            count(files_read=int(not hit), bytes_read=bytes_read, files_written=int(error is None),
+                  bytes_written=bytes_written)
+            if cache is not None:
+                count(cache_hits=int(hit), cache_misses=int(not hit))
+                if not hit and error is None:
+                    # The stored entry is a copy of the output
+                    cache.added(bytes_written)
+            yield image_path, error
+
+
+def is_stack_input(image_path):
+    # The images create_stacked.py stacks: the .jpg files of a view folder
+    name = Path(image_path).name
+    return name.endswith(".jpg") and not name.startswith(".")
+
+
+def resize_and_stack_folder(image_paths, stack_path=None, crop=None, resize=None, quality=100, mode="max",
+                            percentile=None, memory_budget=DEFAULT_MEMORY_BUDGET, tmp_dir=None, reduced_decode=True,
+                            output_paths=None, cache=None, digests=None):
+    """
+    Crop and/or resize the images of one view folder (in place unless output_paths is given) and, when stack_path
+    is given, stack its resized .jpg images into stack_path in the same pass. Every image is decoded once and the
+    stack is built from the resized pixels before they are JPEG-encoded. An image that fails is reported and
+    skipped; the stack is then not written, like create_stacked.py fails the whole folder.
+    With an ImageCache (and the content digests of image_paths), cached outputs are copied instead; the images are
+    only decoded when their own output or the stack is missing from the cache.
+    Returns (errors, stack_error, bytes_read, bytes_written, files_read, cache_hits, bytes_cached) where errors is
+    a list of (image_path, error), files_read the number of decoded images, cache_hits the number of outputs copied
+    from the cache and bytes_cached the size of the entries stored in it.
+    """
+    output_paths = list(output_paths) if output_paths is not None else list(image_paths)
+    stack_inputs = {image_path for image_path in image_paths if is_stack_input(image_path)} if stack_path else set()
+    errors = []
+    stack_error = None
+    bytes_read = bytes_written = files_read = cache_hits = bytes_cached = 0
+
+    keys = {}
+    stack_cached = not stack_inputs
+    if cache is not None:
+        options = {"crop": crop, "resize": resize.strip() if resize else None,
+                   "reduced_decode": bool(reduced_decode and resize)}
+        keys = {image_path: resize_key(digests[image_path], crop, resize, quality, reduced_decode, output_path)
+                for image_path, output_path in zip(image_paths, output_paths)}
+        if stack_inputs:
+            stack_cache_key = stack_key("resize_stack", [digests[p] for p in image_paths if p in stack_inputs],
+                                        mode, percentile, quality, **options)
+            size = cache.get(stack_cache_key, stack_path)
+            stack_cached = size is not None
+            if stack_cached:
+                bytes_written += size
+                cache_hits += 1
+
+    accumulator = None
+    if not stack_cached:
+        accumulator = new_accumulator(mode, len(stack_inputs), percentile, memory_budget, tmp_dir)
+    try:
+        for image_path, output_path in zip(image_paths, output_paths):
+            # A stack input is decoded whenever the stack is computed, even if its own output is cached
+            if image_path in keys and (stack_cached or image_path not in stack_inputs):
+                size = cache.get(keys[image_path], output_path)
+                if size is not None:
+                    bytes_written += size
+                    cache_hits += 1
+                    continue
+            try:
+                image, size = decode_cropped(image_path, crop, resize, reduced_decode)
+                bytes_read += os.path.getsize(image_path)
+                files_read += 1
+                image = resize_image(image, resize, size)
+                bytes_written += write_image(output_path, image, quality)
+                if cache is not None:
+                    bytes_cached += cache.put(keys[image_path], output_path)
+            except Exception as e:
+                errors.append((image_path, e))
+                if image_path in stack_inputs and stack_error is None:
+                    stack_error = IOError(f"Not stacked, {Path(image_path).name} failed: {e}")
+                continue
+
+            if accumulator is not None and image_path in stack_inputs and stack_error is None:
+                try:
+                    accumulator.add(image)
+                except ValueError as e:
+                    stack_error = e
+
+        if accumulator is not None and stack_error is None:
+            bytes_written += write_image(stack_path, accumulator.result(), quality)
+            if cache is not None:
+                bytes_cached += cache.put(stack_cache_key, stack_path)
+    finally:
+        if accumulator is not None:
+            accumulator.close()
+        close_light_packs()
+    return errors, stack_error, bytes_read, bytes_written, files_read, cache_hits, bytes_cached
+
+
+def _resize_and_stack_task(folder, image_paths, stack_path, *options):
+    try:
+        return resize_and_stack_folder(image_paths, stack_path, *options)
+    except Exception as e:
+        return [], e, 0, 0, 0, 0, 0
+
+
+def resize_and_stack_parallel(folders, stack_dir, crop=None, resize=None, quality=100, mode="max", percentile=None,
+                              memory_budget=DEFAULT_MEMORY_BUDGET, tmp_dir=None, jobs=None, reduced_decode=True,
+                              output_folders=None, cache=None):
+    """
+    Fused process_images_parallel and create_stacked.py: folders is a list of (folder, image_paths, stack), the .jpg
+    images of the folders with stack set are stacked into {stack_dir}/{folder name}.jpg while they are resized.
+    output_folders optionally maps every folder to the folder its outputs are written to (default: in place),
+    cache is an optional ImageCache (see resize_and_stack_folder).
+    The folders are spread over a process pool (a view is resized and stacked by one worker).
+    Yields (folder, image_paths, errors, stack_error) as the folders finish.
+    """
+    crop = parse_crop_geometry(crop) if crop else None
+    resize = parse_resize_geometry(resize) if resize else None
+    jobs = max(1, min(jobs or os.cpu_count() or 1, len(folders)))
+    # With fewer views than cores, the OpenCV threads of every worker use the remaining cores for resizing
+    threads = max(1, (os.cpu_count() or 1) // jobs)
+    digests = cache.digests([p for _, image_paths, _ in folders for p in image_paths]) if cache is not None else {}
+
+    def outputs(folder, image_paths):
+        if output_folders is None:
+            return None
+        output_folder = Path(output_folders[folder])
+        output_folder.mkdir(parents=True, exist_ok=True)
+        return [output_folder / Path(p).name for p in image_paths]
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(threads,)) as executor:
+        futures = {executor.submit(_resize_and_stack_task, folder, image_paths,
+                                   Path(stack_dir) / f"{Path(folder).stem}.jpg" if stack else None,
+                                   crop, resize, quality, mode, percentile, memory_budget, tmp_dir,
+                                   reduced_decode, outputs(folder, image_paths), cache,
+                                   {p: digests[p] for p in image_paths} if cache is not None else None):
+                   (folder, image_paths, stack) for folder, image_paths, stack in folders}
+        for future in as_completed(futures):
+            folder, image_paths, stack = futures[future]
+            errors, stack_error, bytes_read, bytes_written, files_read, cache_hits, bytes_cached = future.result()
+            stacked = int(stack and stack_error is None and any(is_stack_input(p) for p in image_paths))
+            count(files_read=files_read, bytes_read=bytes_read, files_written=len(image_paths) - len(errors) + stacked,
+                  bytes_written=bytes_written)
+            if cache is not None:
+                count(cache_hits=cache_hits)
+                cache.added(bytes_cached)
+            yield folder, image_paths, errors, stack_error
+
+
+def report_throughput(num_images, start_time, num_errors=0):
+    elapsed = time.perf_counter() - start_time
+    rate = num_images / elapsed if elapsed > 0 else float("inf")
+    print(f"Processed {num_images} images in {elapsed:.1f} s ({rate:.1f} images/sec), {num_errors} errors.")
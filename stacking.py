@@ -0,0 +1,328 @@
+import math
+import os
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from image_cache import operation_key
+from image_io import write_image
+from light_pack import close_light_packs, read_light_image
+from metrics import count
+
+# Modes supported by the in-process engine (same names as ImageMagick's -evaluate-sequence)
+STACK_MODES = ("max", "min", "mean", "add")
+# Order statistics need all lights of a pixel at once and are computed strip by strip
+PERCENTILE_MODES = ("median", "percentile")
+
+DEFAULT_MEMORY_BUDGET = 1 << 30
+
+_SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(text):
+    """
+    Parse a human readable byte size such as "512M", "4G" or "1.5GB" into bytes.
+    """
+    match = re.fullmatch(r"\s*([0-9]*\.?[0-9]+)\s*([KMGT]?)(I?B)?\s*", str(text), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size '{text}', expected e.g. 512M or 4G")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+
+class StackAccumulator:
+    """
+    Running reduction over a sequence of equally sized images.
+    Only the accumulator is kept in memory, so a view with 100 lights needs about as
+    much RAM as two frames instead of 100.
+    """
+
+    def __init__(self, mode):
+        mode = mode.lower()
+        if mode not in STACK_MODES:
+            raise ValueError(f"Unsupported stack mode '{mode}', expected one of {', '.join(STACK_MODES)}")
+        self.mode = mode
+        self.count = 0
+        self.dtype = None
+        self._acc = None
+
+    def add(self, image):
+        if self._acc is None:
+            self.dtype = image.dtype
+            if self.mode in ("max", "min"):
+                self._acc = image.copy()
+            elif np.issubdtype(image.dtype, np.integer) and image.dtype.itemsize <= 2:
+                # Sums of 8/16-bit frames fit into uint32 for any realistic number of lights
+                self._acc = image.astype(np.uint32)
+            else:
+                self._acc = image.astype(np.float64)
+            self.count = 1
+            return
+
+        if image.shape != self._acc.shape:
+            raise ValueError(f"Image shape {image.shape} does not match the stack shape {self._acc.shape}")
+
+        if self.mode == "max":
+            np.maximum(self._acc, image, out=self._acc)
+        elif self.mode == "min":
+            np.minimum(self._acc, image, out=self._acc)
+        else:
+            np.add(self._acc, image, out=self._acc, casting="unsafe")
+        self.count += 1
+
+    def result(self):
+        if self._acc is None:
+            raise ValueError("No images were added to the stack")
+
+        if self.mode in ("max", "min"):
+            return self._acc
+
+        if self.mode == "mean":
+            if np.issubdtype(self._acc.dtype, np.integer):
+                # Integer division rounding half up, like ImageMagick's quantum rounding
+                reduced = (self._acc + self.count // 2) // self.count
+            else:
+                reduced = self._acc / self.count
+        else:
+            reduced = self._acc
+
+        if np.issubdtype(self.dtype, np.integer):
+            info = np.iinfo(self.dtype)
+            reduced = np.clip(reduced, info.min, info.max)
+        return reduced.astype(self.dtype)
+
+    def close(self):
+        # Nothing to release, close() exists for symmetry with PercentileAccumulator
+        pass
+
+
+def stack_images(image_paths, mode):
+    """
+    Decode the images one at a time and reduce them with the given mode.
+    """
+    accumulator = StackAccumulator(mode)
+    for image_path in image_paths:
+        image = read_light_image(image_path)
+        if image is None:
+            raise IOError(f"Could not decode image {image_path}")
+        accumulator.add(image)
+    return accumulator.result()
+
+
+def _reduce_percentile(chunk, percentile, method):
+    """
+    Reduce axis 0 of the chunk to the given percentile, partitioning the chunk in place.
+    method "higher" picks the upper of the two neighbouring samples (ImageMagick's median),
+    "linear" interpolates between them like numpy.percentile.
+    """
+    position = (chunk.shape[0] - 1) * percentile / 100.0
+    lower = int(math.floor(position))
+    upper = min(lower + 1, chunk.shape[0] - 1)
+    fraction = position - lower
+
+    if method == "higher" and fraction > 0:
+        lower, fraction = upper, 0.0
+    if fraction == 0 or lower == upper:
+        chunk.partition(lower, axis=0)
+        return chunk[lower].copy()
+
+    chunk.partition([lower, upper], axis=0)
+    low = chunk[lower].astype(np.float32)
+    result = low + (chunk[upper].astype(np.float32) - low) * np.float32(fraction)
+    if np.issubdtype(chunk.dtype, np.integer):
+        np.rint(result, out=result)
+    return result.astype(chunk.dtype)
+
+
+class PercentileAccumulator:
+    """
+    Collects up to num_images equally sized frames for a per-pixel percentile, the counterpart of StackAccumulator
+    for the order statistics. The frames are kept in memory when they fit into memory_budget bytes; otherwise they
+    are spilled to a temporary file and result() reduces them in horizontal strips, each strip holding the same rows
+    of every light. close() removes the spill file.
+    """
+
+    def __init__(self, num_images, percentile, memory_budget=DEFAULT_MEMORY_BUDGET, tmp_dir=None, method="linear"):
+        self.num_images = num_images
+        self.percentile = percentile
+        self.memory_budget = memory_budget
+        self.tmp_dir = tmp_dir
+        self.method = method
+        self.count = 0
+        self._stack = None
+        self._spill_path = None
+        self._frame_bytes = 0
+
+    def add(self, image):
+        if self._stack is None:
+            self._frame_bytes = image.nbytes
+            shape = (self.num_images,) + image.shape
+            # Partitioning happens in place on the stack, interpolation needs two float32 frames
+            if self.num_images * self._frame_bytes + 2 * self._frame_bytes * 4 <= self.memory_budget:
+                self._stack = np.empty(shape, dtype=image.dtype)
+            else:
+                fd, self._spill_path = tempfile.mkstemp(prefix="stack_", suffix=".raw", dir=self.tmp_dir)
+                os.close(fd)
+                self._stack = np.memmap(self._spill_path, dtype=image.dtype, mode="w+", shape=shape)
+        elif image.shape != self._stack.shape[1:]:
+            raise ValueError(f"Image shape {image.shape} does not match the stack shape {self._stack.shape[1:]}")
+        if self.count == self.num_images:
+            raise ValueError(f"More than {self.num_images} images were added to the stack")
+        self._stack[self.count] = image
+        self.count += 1
+
+    def result(self):
+        if self.count == 0:
+            raise ValueError("No images were added to the stack")
+        stack = self._stack[:self.count]
+        if self._spill_path is None:
+            return _reduce_percentile(stack, self.percentile, self.method)
+
+        self._stack.flush()
+        height = stack.shape[1]
+        row_bytes = self._frame_bytes // height
+        strip_row_bytes = self.count * row_bytes + 2 * row_bytes * 4
+        rows_per_strip = max(1, min(height, (self.memory_budget - self._frame_bytes) // strip_row_bytes))
+        result = np.empty(stack.shape[1:], dtype=stack.dtype)
+        for row in range(0, height, rows_per_strip):
+            strip = np.array(stack[:, row:row + rows_per_strip])
+            result[row:row + rows_per_strip] = _reduce_percentile(strip, self.percentile, self.method)
+            del strip
+        return result
+
+    def close(self):
+        # The memory map has to be released before its file can be removed on Windows
+        self._stack = None
+        if self._spill_path is not None:
+            os.remove(self._spill_path)
+            self._spill_path = None
+
+
+def new_accumulator(mode, num_images, percentile=None, memory_budget=DEFAULT_MEMORY_BUDGET, tmp_dir=None):
+    """
+    The accumulator of a stack mode: a StackAccumulator for the running modes, a PercentileAccumulator for
+    median (the upper of the two middle samples, like ImageMagick) and percentile.
+    """
+    if mode == "median":
+        return PercentileAccumulator(num_images, 50, memory_budget, tmp_dir, method="higher")
+    if mode == "percentile":
+        return PercentileAccumulator(num_images, percentile, memory_budget, tmp_dir)
+    return StackAccumulator(mode)
+
+
+def stack_percentile(image_paths, percentile, memory_budget=DEFAULT_MEMORY_BUDGET, tmp_dir=None, method="linear"):
+    """
+    Compute a per-pixel percentile over all images while keeping memory under memory_budget bytes.
+    The images are decoded once into a stack of shape (L, H, W, C), see PercentileAccumulator.
+    """
+    image_paths = list(image_paths)
+    accumulator = PercentileAccumulator(len(image_paths), percentile, memory_budget, tmp_dir, method)
+    try:
+        for image_path in image_paths:
+            image = read_light_image(image_path)
+            if image is None:
+                raise IOError(f"Could not decode image {image_path}")
+            accumulator.add(image)
+            del image
+        return accumulator.result()
+    finally:
+        accumulator.close()
+
+
+def stack_key(operation, digests, mode="max", percentile=None, quality=100, **params):
+    """
+    ImageCache key of a stack of the sources with the given content digests (in stacking order).
+    """
+    return operation_key(operation, digests, mode=mode, percentile=percentile if mode == "percentile" else None,
+                         quality=int(quality), **params)
+
+
+def stack_folder(subfolder, target_folder, mode, quality=100, percentile=None,
+                 memory_budget=DEFAULT_MEMORY_BUDGET, tmp_dir=None, jpg_files=None, cache=None, digests=None):
+    """
+    Stack all .jpg files of a view folder into {target_folder}/{subfolder_name}.jpg.
+    jpg_files is the already listed images of the folder, it is globbed when not given.
+    With an ImageCache and the content digests of jpg_files, a stack of the same images with the same settings
+    is copied from the cache instead of being computed.
+    Returns (number of stacked images (0 if the folder has no .jpg files), whether the stack came from the cache).
+    """
+    subfolder = Path(subfolder)
+    if jpg_files is None:
+        jpg_files = sorted(subfolder.glob("*.jpg"))
+    if not jpg_files:
+        return 0, False
+
+    target_path = Path(target_folder) / f"{subfolder.stem}.jpg"
+    if cache is not None:
+        key = stack_key("stack", [digests[p] for p in jpg_files], mode, percentile, quality)
+        if cache.get(key, target_path) is not None:
+            return len(jpg_files), True
+
+    try:
+        if mode == "median":
+            stacked = stack_percentile(jpg_files, 50, memory_budget, tmp_dir, method="higher")
+        elif mode == "percentile":
+            stacked = stack_percentile(jpg_files, percentile, memory_budget, tmp_dir)
+        else:
+            stacked = stack_images(jpg_files, mode)
+    finally:
+        # The view's light pack is not needed anymore, don't keep it mapped while the worker stacks other views
+        close_light_packs()
+    write_image(target_path, stacked, quality)
+    if cache is not None:
+        cache.put(key, target_path)
+    return len(jpg_files), False
+
+
+def _init_worker():
+    # Parallelism comes from the process pool, keep OpenCV from oversubscribing the cores
+    cv2.setNumThreads(1)
+
+
+def stack_subfolders(subfolders, target_folder, mode, jobs=None, quality=100, percentile=None,
+                     memory_budget=DEFAULT_MEMORY_BUDGET, max_memory=None, tmp_dir=None, image_lists=None, cache=None):
+    """
+    Stack many view folders in parallel with a process pool.
+    image_lists optionally maps every subfolder to its .jpg files, so the workers don't list the folders again.
+    For the median/percentile modes each view stays under memory_budget bytes, and when max_memory
+    is given the number of concurrent views is limited so that all of them together stay under it.
+    cache is an optional ImageCache serving the stacks computed before from the same images (see stack_folder).
+    Yields (subfolder, number_of_images, error) as the folders finish.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    if mode in PERCENTILE_MODES and max_memory:
+        memory_budget = min(memory_budget, max_memory)
+        jobs = max(1, min(jobs, max_memory // memory_budget))
+
+    digests = {}
+    if cache is not None:
+        if image_lists is None:
+            image_lists = {subfolder: sorted(Path(subfolder).glob("*.jpg")) for subfolder in subfolders}
+        digests = cache.digests([p for subfolder in subfolders for p in image_lists[subfolder]])
+
+    # The workers close the packs they read, this only matters for a pack the calling process still maps
+    close_light_packs()
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker) as executor:
+        futures = {executor.submit(stack_folder, subfolder, target_folder, mode, quality, percentile,
+                                   memory_budget, tmp_dir, image_lists.get(subfolder) if image_lists else None,
+                                   cache, {p: digests[p] for p in image_lists[subfolder]} if digests else None):
+                   subfolder for subfolder in subfolders}
+        for future in as_completed(futures):
+            subfolder = futures[future]
+            try:
+                num_images, cache_hit = future.result()
+            except Exception as e:
+                yield subfolder, 0, e
+                continue
+            if cache_hit:
+                count(files_written=1, cache_hits=1)
+            else:
+                count(files_read=num_images, files_written=int(num_images > 0))
+                if cache is not None and num_images:
+                    count(cache_misses=1)
+                    # The stored entry is a copy of the stack
+                    cache.added(os.path.getsize(Path(target_folder) / f"{Path(subfolder).stem}.jpg"))
+            yield subfolder, num_images, None
@@ -0,0 +1,222 @@
+import argparse
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from colmap_io import CAMERA_DTYPE, image_dtype, write_model
+
+# Layout of a generated dataset (the inputs of the scripts, as they come from the capture and from COLMAP/SDM-UniPS):
+#   raw/IMG_00000.jpg ...              views x lights captured images, in capture order (input of group_images.py)
+#   masks/00.png ...                   one mask per view (input of copy_masks_to_subfolders.py)
+#   model/cameras, images, points3D    one image per view named 00.jpg, 01.jpg, ... (colmap2neus, normal gathering)
+#   rig_model/images                   one image per view and light, view_00.data/L00.jpg, ... (flatten_colmap_model.py)
+#   sdm_unips_results/view_00.data/    normal.exr and mask.png per view
+#   dataset.json                       the generation settings
+DATASET_INFO_NAME = "dataset.json"
+
+
+def shape_exponent(coverage):
+    """
+    Exponent p of the superellipse |x|^p + |y|^p <= 1 filling the fraction coverage of its bounding box
+    (p = 2 is the inscribed ellipse, pi / 4 of the box). Found by bisection on the area formula.
+    """
+    def area(p):
+        return math.gamma(1 + 1 / p) ** 2 / math.gamma(1 + 2 / p)
+
+    low, high = 2.0, 2.0
+    while area(high) < coverage:
+        high *= 2
+    for _ in range(60):
+        middle = (low + high) / 2
+        low, high = (middle, high) if area(middle) < coverage else (low, middle)
+    return high
+
+
+def object_geometry(height, width, coverage):
+    """
+    Mask and camera-space normals of the synthetic object: a dome over a superellipse (an ellipse up to a coverage
+    of pi / 4) centered in the image and covering the fraction coverage of it.
+    """
+    y, x = np.mgrid[-1:1:height * 1j, -1:1:width * 1j]
+    if coverage <= math.pi / 4:
+        scale = math.sqrt(4 * coverage / math.pi)
+        exponent = 2.0
+    else:
+        scale = 1.0
+        exponent = shape_exponent(min(coverage, 0.999))
+    x, y = x / max(scale, 1e-6), y / max(scale, 1e-6)
+    radius = (np.abs(x) ** exponent + np.abs(y) ** exponent) ** (1 / exponent)
+    mask = radius <= 1
+
+    z = np.sqrt(np.clip(1 - radius ** 2, 0, None))
+    normals = np.stack([x, -y, z + 0.1], axis=-1)
+    normals /= np.linalg.norm(normals, axis=-1, keepdims=True)
+    normals[~mask] = 0
+    return mask, normals.astype(np.float32)
+
+
+def light_directions(num_lights):
+    """
+    Directions of num_lights lights spread over a cone around the viewing direction, like a ring light rig.
+    """
+    angles = np.arange(num_lights) * 2 * np.pi / max(num_lights, 1)
+    elevation = np.deg2rad(50)
+    return np.stack([np.cos(angles) * np.cos(elevation), np.sin(angles) * np.cos(elevation),
+                     np.full(num_lights, np.sin(elevation))], axis=-1)
+
+
+def look_at(camera_center):
+    """
+    World-to-camera rotation and translation (COLMAP convention, +Z forward, +Y down) of a camera looking at the origin.
+    """
+    forward = -camera_center / np.linalg.norm(camera_center)
+    right = np.cross(forward, [0.0, 0.0, 1.0])
+    right /= np.linalg.norm(right)
+    down = np.cross(forward, right)
+    R = np.stack([right, down, forward])
+    return R, -R @ camera_center
+
+
+def rotation_matrix_to_quaternion(R):
+    """
+    (qw, qx, qy, qz) of a rotation matrix, the inverse of quaternion_to_rotation_matrix in colmap_io.py.
+    """
+    qw = math.sqrt(max(0.0, 1 + R[0, 0] + R[1, 1] + R[2, 2])) / 2
+    qx = math.copysign(math.sqrt(max(0.0, 1 + R[0, 0] - R[1, 1] - R[2, 2])) / 2, R[2, 1] - R[1, 2])
+    qy = math.copysign(math.sqrt(max(0.0, 1 - R[0, 0] + R[1, 1] - R[2, 2])) / 2, R[0, 2] - R[2, 0])
+    qz = math.copysign(math.sqrt(max(0.0, 1 - R[0, 0] - R[1, 1] + R[2, 2])) / 2, R[1, 0] - R[0, 1])
+    return qw, qx, qy, qz
+
+
+def camera_poses(num_views, radius=3.0):
+    """
+    (qvec, tvec) of num_views cameras on a ring around the object, slightly above it.
+    """
+    poses = []
+    for i in range(num_views):
+        angle = 2 * np.pi * i / num_views
+        center = radius * np.array([np.cos(angle), np.sin(angle), 0.3])
+        R, t = look_at(center)
+        poses.append((rotation_matrix_to_quaternion(R), t))
+    return poses
+
+
+def write_models(root, num_views, num_lights, height, width, model_format):
+    """
+    Write the per-view model (model/) and the per-image rig model (rig_model/) with one shared SIMPLE_RADIAL camera.
+    """
+    ext = ".bin" if model_format == "bin" else ".txt"
+    cameras = np.zeros(1, dtype=CAMERA_DTYPE)
+    cameras[0]["camera_id"] = 1
+    cameras[0]["model"] = "SIMPLE_RADIAL"
+    cameras[0]["width"] = width
+    cameras[0]["height"] = height
+    cameras[0]["num_params"] = 4
+    cameras[0]["params"][:4] = [1.2 * max(width, height), width / 2, height / 2, -0.05]
+
+    poses = camera_poses(num_views)
+    views = [(i + 1, qvec, tvec, 1, f"{i:02}.jpg") for i, (qvec, tvec) in enumerate(poses)]
+    write_model(os.path.join(root, "model"), cameras, np.array(views, dtype=image_dtype(16)), ext)
+
+    rig_images = []
+    for i, (qvec, tvec) in enumerate(poses):
+        for j in range(num_lights):
+            rig_images.append((len(rig_images) + 1, qvec, tvec, 1, f"view_{i:02}.data/L{j:02}.jpg"))
+    write_model(os.path.join(root, "rig_model"), cameras, np.array(rig_images, dtype=image_dtype(32)), ext)
+
+
+def generate_view(root, view, num_lights, raw_size, size, coverage, seed):
+    """
+    Write the raw light images of one view (at raw_size), its mask and its SDM-UniPS result (at size).
+    """
+    # Imported here so that only the processes writing images load OpenCV and pyexr
+    import cv2
+    import pyexr
+    from image_io import write_image
+
+    rng = np.random.default_rng(seed + view)
+    raw_height, raw_width = raw_size
+    height, width = size
+
+    # Smooth random albedo, so the JPEGs compress like real photos rather than flat shading
+    albedo = cv2.resize(rng.uniform(0.4, 1.0, (raw_height // 32 + 1, raw_width // 32 + 1, 3)).astype(np.float32),
+                        (raw_width, raw_height), interpolation=cv2.INTER_CUBIC)
+    raw_mask, raw_normals = object_geometry(raw_height, raw_width, coverage)
+    for j, light in enumerate(light_directions(num_lights)):
+        shading = np.clip(raw_normals @ light.astype(np.float32), 0, None)[..., None]
+        image = albedo * shading * 230 + rng.normal(12, 4, (raw_height, raw_width, 1)).astype(np.float32)
+        image[~raw_mask] = rng.normal(10, 3, (int((~raw_mask).sum()), 1))
+        write_image(os.path.join(root, "raw", f"IMG_{view * num_lights + j:05}.jpg"),
+                    np.clip(image, 0, 255).astype(np.uint8), quality=95)
+
+    mask, normals = object_geometry(height, width, coverage)
+    mask_image = mask.astype(np.uint8) * 255
+    write_image(os.path.join(root, "masks", f"{view:02}.png"), mask_image)
+    view_dir = os.path.join(root, "sdm_unips_results", f"view_{view:02}.data")
+    os.makedirs(view_dir, exist_ok=True)
+    write_image(os.path.join(view_dir, "mask.png"), mask_image)
+    pyexr.write(os.path.join(view_dir, "normal.exr"), normals)
+
+
+def generate_dataset(root, num_views=8, num_lights=12, raw_size=(1024, 1024), size=None, coverage=0.5,
+                     model_format="txt", seed=0, jobs=None):
+    """
+    Generate a synthetic MVPS dataset in root (see the layout at the top of this file).
+    raw_size is the (height, width) of the captured images; masks, normal maps and the cameras use size,
+    the resolution after resizing (default: raw_size).
+    """
+    size = tuple(size or raw_size)
+    for folder in ("raw", "masks", "sdm_unips_results"):
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+
+    write_models(root, num_views, num_lights, size[0], size[1], model_format)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(generate_view, root, view, num_lights, tuple(raw_size), size, coverage, seed)
+                   for view in range(num_views)]
+        for future in futures:
+            future.result()
+
+    info = {"views": num_views, "lights": num_lights, "raw_size": list(raw_size), "size": list(size),
+            "coverage": coverage, "model_format": model_format, "seed": seed}
+    with open(os.path.join(root, DATASET_INFO_NAME), "w") as f:
+        json.dump(info, f, indent=1)
+    return info
+
+
+def load_dataset_info(root):
+    with open(os.path.join(root, DATASET_INFO_NAME), "r") as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic MVPS dataset: raw light images, masks, "
+                                                 "COLMAP models and SDM-UniPS normal maps.")
+    parser.add_argument("output_dir", type=str, help="Folder of the generated dataset")
+    parser.add_argument("--views", type=int, default=8, help="Number of views (default: 8)")
+    parser.add_argument("--lights", type=int, default=12, help="Number of light images per view (default: 12)")
+    parser.add_argument("--raw_size", type=int, nargs=2, default=[1024, 1024], metavar=("HEIGHT", "WIDTH"),
+                        help="Size of the captured images (default: 1024 1024)")
+    parser.add_argument("--size", type=int, nargs=2, metavar=("HEIGHT", "WIDTH"),
+                        help="Size after resizing, used by the masks, normal maps and cameras (default: raw_size)")
+    parser.add_argument("--coverage", type=float, default=0.5,
+                        help="Fraction of the image covered by the object mask (default: 0.5)")
+    parser.add_argument("--model_format", choices=["txt", "bin"], default="txt",
+                        help="Format of the COLMAP models (default: txt)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Views generated in parallel")
+    args = parser.parse_args(argv)
+
+    if not 0 < args.coverage < 1:
+        parser.error("--coverage must be between 0 and 1")
+    info = generate_dataset(args.output_dir, args.views, args.lights, args.raw_size, args.size, args.coverage,
+                            args.model_format, args.seed, args.jobs)
+    print(f"Generated {info['views']} views x {info['lights']} lights "
+          f"({info['raw_size'][1]}x{info['raw_size'][0]} raw, {info['size'][1]}x{info['size'][0]} resized) "
+          f"in {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
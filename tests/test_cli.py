@@ -0,0 +1,99 @@
+import json
+
+import cv2
+import numpy as np
+import pytest
+
+import mvps
+
+
+@pytest.fixture
+def views(tmp_path, monkeypatch):
+    monkeypatch.setenv("MVPS_INDEX_CACHE_DIR", str(tmp_path / "index_cache"))
+    root = tmp_path / "views"
+    rng = np.random.default_rng(0)
+    for view in ("view_01.data", "view_02.data"):
+        (root / view).mkdir(parents=True)
+        for light in ("L00.jpg", "L01.jpg", "L02.jpg"):
+            cv2.imwrite(str(root / view / light), rng.integers(0, 256, (32, 40, 3), dtype=np.uint8))
+        cv2.imwrite(str(root / view / "mask.png"), np.full((32, 40), 255, dtype=np.uint8))
+    return root
+
+
+def run(name, *argv):
+    return mvps.run_command(name, [str(arg) for arg in argv])
+
+
+@pytest.mark.parametrize("name", list(mvps.COMMANDS))
+def test_help(name):
+    assert run(name, "--help") == 0
+
+
+def with_metrics(tmp_path, name):
+    """
+    The metrics and profiling options of add_metrics_arguments, which every script passes to collect_metrics.
+    """
+    return ["--metrics", tmp_path / f"{name}.json", "--profile_out", tmp_path / f"{name}.prof"]
+
+
+def check_metrics(tmp_path, name):
+    with open(tmp_path / f"{name}.json", "r") as f:
+        assert json.load(f)["stages"]
+    assert (tmp_path / f"{name}.prof").stat().st_size > 0
+
+
+def test_resize_all_images(tmp_path, views):
+    assert run("resize_all_images", views, "40x32+0+0", "20x16", "--engine", "native", "--jobs", 2,
+               *with_metrics(tmp_path, "resize")) == 0
+    assert cv2.imread(str(views / "view_01.data" / "L00.jpg")).shape == (16, 20, 3)
+    check_metrics(tmp_path, "resize")
+
+
+def test_resize_all_images_new(tmp_path, views):
+    assert run("resize_all_images_new", views, "--resize", "20x16", "--engine", "native", "--jobs", 2,
+               "--output_dir", tmp_path / "resized", "--stack_dir", tmp_path / "stacked",
+               *with_metrics(tmp_path, "resize_new")) == 0
+    assert cv2.imread(str(tmp_path / "resized" / "view_02.data" / "L02.jpg")).shape == (16, 20, 3)
+    assert (tmp_path / "stacked" / "view_01.jpg").exists()
+    check_metrics(tmp_path, "resize_new")
+
+
+def test_pack_and_stack(tmp_path, views):
+    assert run("pack_light_stacks", views, "--jobs", 2, *with_metrics(tmp_path, "pack")) == 0
+    check_metrics(tmp_path, "pack")
+    assert run("create_stacked", views, tmp_path / "stacked", "--engine", "native", "--jobs", 2,
+               *with_metrics(tmp_path, "stack")) == 0
+    assert cv2.imread(str(tmp_path / "stacked" / "view_02.jpg")).shape == (32, 40, 3)
+    check_metrics(tmp_path, "stack")
+
+
+def test_undistort(tmp_path, views):
+    cameras_txt = tmp_path / "cameras.txt"
+    cameras_txt.write_text("# Camera list\n1 SIMPLE_RADIAL 40 32 40 20 16 0.01\n")
+    assert run("undistort_all_mvps_images", "--cameras_txt_path", cameras_txt, "--all_mvps_images_path", views,
+               "--undistorted_mvps_images_path", tmp_path / "undistorted", "--engine", "native", "--jobs", 2,
+               "--remap_cache_dir", tmp_path / "remap", *with_metrics(tmp_path, "undistort")) == 0
+    assert (tmp_path / "undistorted" / "view_01.data" / "mask.png").exists()
+    check_metrics(tmp_path, "undistort")
+
+
+@pytest.fixture
+def broken_views(views):
+    (views / "view_02.data" / "L01.jpg").write_bytes(b"not a jpeg")
+    return views
+
+
+def test_failed_images_give_an_error_exit_code(tmp_path, broken_views):
+    # pipeline.py records a stage as up to date only when its command exits with 0
+    views = broken_views
+    assert run("resize_all_images_new", views, "--resize", "20x16", "--engine", "native",
+               "--output_dir", tmp_path / "resized") == 1
+    assert run("resize_all_images_new", views, "--resize", "20x16", "--engine", "native",
+               "--output_dir", tmp_path / "resized", "--stack_dir", tmp_path / "fused") == 1
+    assert run("create_stacked", views, tmp_path / "stacked", "--engine", "native") == 1
+    cameras_txt = tmp_path / "cameras.txt"
+    cameras_txt.write_text("1 SIMPLE_RADIAL 40 32 40 20 16 0.01\n")
+    assert run("undistort_all_mvps_images", "--cameras_txt_path", cameras_txt, "--all_mvps_images_path", views,
+               "--undistorted_mvps_images_path", tmp_path / "undistorted", "--engine", "native",
+               "--remap_cache_dir", tmp_path / "remap") == 1
+    assert run("resize_all_images", views, "40x32+0+0", "20x16", "--engine", "native") == 1
@@ -0,0 +1,92 @@
+import os
+import time
+
+import pytest
+
+from dataset_index import DatasetIndex, JPEG_EXTENSIONS, natural_key
+
+OLD = time.time() - 3600
+
+
+@pytest.fixture
+def root(tmp_path, monkeypatch):
+    monkeypatch.setenv("MVPS_INDEX_CACHE_DIR", str(tmp_path / "cache"))
+    root = tmp_path / "views"
+    for view in ("view_10", "view_2"):
+        (root / view).mkdir(parents=True)
+        for name in ("L10.jpg", "L2.jpg", "L1.jpg", "mask.png"):
+            (root / view / name).write_bytes(b"x")
+    age(root, root / "view_10", root / "view_2")
+    return root
+
+
+def age(*folders):
+    # Listings of folders changed within the last seconds are never reused, see _RACY_SECONDS
+    for folder in folders:
+        os.utime(folder, (OLD, OLD))
+
+
+def names(index, rel=""):
+    return [f.name for f in index.files(rel)]
+
+
+def test_natural_order(root):
+    with DatasetIndex(root) as index:
+        assert index.subdirs() == ["view_2", "view_10"]
+        assert names(index, "view_2") == ["L1.jpg", "L2.jpg", "L10.jpg", "mask.png"]
+    assert sorted(["a10", "a2", "A1"], key=natural_key) == ["A1", "a2", "a10"]
+
+
+def test_views(root):
+    with DatasetIndex(root) as index:
+        views = index.views(JPEG_EXTENSIONS)
+    assert [view.name for view in views] == ["view_2", "view_10"]
+    assert [f.name for f in views[0].images] == ["L1.jpg", "L2.jpg", "L10.jpg"]
+    assert views[0].mask.name == "mask.png"
+    assert views[0].path == root / "view_2"
+
+
+def test_cached_listing_is_reused(root):
+    with DatasetIndex(root) as index:
+        names(index, "view_2")
+    # A change that leaves the folder mtime alone is not seen, which shows the listing came from the cache
+    (root / "view_2" / "L3.jpg").write_bytes(b"x")
+    age(root / "view_2")
+    with DatasetIndex(root) as index:
+        assert "L3.jpg" not in names(index, "view_2")
+    with DatasetIndex(root, use_cache=False) as index:
+        assert "L3.jpg" in names(index, "view_2")
+
+
+@pytest.mark.parametrize("change", ["add", "remove", "rename", "subdir"])
+def test_changed_folder_is_listed_again(root, change):
+    with DatasetIndex(root) as index:
+        names(index, "view_2")
+        index.subdirs()
+
+    folder = root / "view_2"
+    if change == "add":
+        (folder / "L3.jpg").write_bytes(b"x")
+    elif change == "remove":
+        os.remove(folder / "L2.jpg")
+    elif change == "rename":
+        os.rename(folder / "L2.jpg", folder / "L20.jpg")
+    else:
+        (root / "view_3").mkdir()
+
+    with DatasetIndex(root) as index:
+        assert names(index, "view_2") == sorted(os.listdir(folder), key=natural_key)
+        assert index.subdirs() == sorted(os.listdir(root), key=natural_key)
+
+
+def test_recently_changed_folder_is_not_trusted(root):
+    (root / "view_2" / "L3.jpg").write_bytes(b"x")
+    with DatasetIndex(root) as index:
+        names(index, "view_2")
+    # A file added within the same mtime tick leaves the folder mtime unchanged, only the racy check catches it
+    mtime_ns = os.stat(root / "view_2").st_mtime_ns
+    (root / "view_2" / "L4.jpg").write_bytes(b"x")
+    os.utime(root / "view_2", ns=(mtime_ns, mtime_ns))
+    with DatasetIndex(root) as index:
+        assert "L4.jpg" in names(index, "view_2")
+
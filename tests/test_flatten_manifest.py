@@ -0,0 +1,117 @@
+import os
+
+import pytest
+
+from flatten_manifest import (FlattenManifest, MANIFEST_NAME, images_txt_is_current, record_images_txt,
+                              sync_flat_outputs)
+
+
+@pytest.fixture
+def sources(tmp_path):
+    folder = tmp_path / "src"
+    for view in ("view_1", "view_2"):
+        (folder / view).mkdir(parents=True)
+        for light in ("L1.jpg", "L2.jpg"):
+            (folder / view / light).write_text(f"{view}/{light}")
+    return folder
+
+
+def flat_transfers(sources, output, order=("view_1", "view_2")):
+    """
+    The (src, dst) pairs of the views in order, numbered like the flatten scripts do.
+    """
+    sources_list = [sources / view / light for view in order for light in ("L1.jpg", "L2.jpg")]
+    return [(src, output / f"{i:02d}.jpg") for i, src in enumerate(sources_list)]
+
+
+def outputs(output):
+    return {name: (output / name).read_text() for name in os.listdir(output) if name != MANIFEST_NAME}
+
+
+def expected(transfers):
+    return {dst.name: src.read_text() for src, dst in transfers}
+
+
+def sync(transfers, output, link_mode="copy"):
+    result = sync_flat_outputs(transfers, output, link_mode, jobs=2)
+    assert outputs(output) == expected(transfers)
+    return result
+
+
+def test_first_sync_transfers_everything(sources, tmp_path):
+    output = tmp_path / "flat"
+    transfers = flat_transfers(sources, output)
+    assert sync(transfers, output) == {"kept": 0, "moved": 0, "deleted": 0, "transferred": 4}
+    assert set(FlattenManifest(output).entries) == {"00.jpg", "01.jpg", "02.jpg", "03.jpg"}
+
+
+def test_second_sync_keeps_everything(sources, tmp_path):
+    output = tmp_path / "flat"
+    transfers = flat_transfers(sources, output)
+    sync(transfers, output)
+    assert sync(transfers, output) == {"kept": 4, "moved": 0, "deleted": 0, "transferred": 0}
+
+
+def test_renumbered_outputs_are_moved(sources, tmp_path):
+    output = tmp_path / "flat"
+    sync(flat_transfers(sources, output), output)
+    # Swapping the views swaps the flat names 00/01 and 02/03
+    transfers = flat_transfers(sources, output, order=("view_2", "view_1"))
+    assert sync(transfers, output) == {"kept": 0, "moved": 4, "deleted": 0, "transferred": 0}
+
+
+def test_outputs_without_source_are_deleted(sources, tmp_path):
+    output = tmp_path / "flat"
+    sync(flat_transfers(sources, output), output)
+    transfers = flat_transfers(sources, output, order=("view_1",))
+    assert sync(transfers, output) == {"kept": 2, "moved": 0, "deleted": 2, "transferred": 0}
+    assert set(FlattenManifest(output).entries) == {"00.jpg", "01.jpg"}
+
+
+def test_changed_source_is_transferred_again(sources, tmp_path):
+    output = tmp_path / "flat"
+    transfers = flat_transfers(sources, output)
+    sync(transfers, output)
+    (sources / "view_2" / "L1.jpg").write_text("changed and longer")
+    assert sync(transfers, output) == {"kept": 3, "moved": 0, "deleted": 0, "transferred": 1}
+
+
+def test_touched_source_is_transferred_again(sources, tmp_path):
+    output = tmp_path / "flat"
+    transfers = flat_transfers(sources, output)
+    sync(transfers, output)
+    os.utime(sources / "view_1" / "L2.jpg", ns=(0, 0))
+    assert sync(transfers, output)["transferred"] == 1
+
+
+def test_missing_output_is_transferred_again(sources, tmp_path):
+    output = tmp_path / "flat"
+    transfers = flat_transfers(sources, output)
+    sync(transfers, output)
+    os.remove(output / "01.jpg")
+    assert sync(transfers, output) == {"kept": 3, "moved": 0, "deleted": 0, "transferred": 1}
+
+
+def test_link_mode_change_transfers_again(sources, tmp_path):
+    output = tmp_path / "flat"
+    transfers = flat_transfers(sources, output)
+    sync(transfers, output)
+    assert sync(transfers, output, "symlink")["transferred"] == 4
+    assert all(os.path.islink(dst) for _, dst in transfers)
+
+
+def test_images_txt_state(tmp_path):
+    output = tmp_path / "flat"
+    images_txt = tmp_path / "images.txt"
+    images_txt.write_text("1 0 0 0 1 0 0 0 1 L1.jpg\n\n")
+    flat_txt = output / "images.txt"
+    output.mkdir()
+    flat_txt.write_text("1 0 0 0 1 0 0 0 1 00.jpg\n\n")
+    mapping = {"L1.jpg": "00.jpg"}
+
+    assert not images_txt_is_current(output, images_txt, flat_txt, mapping)
+    record_images_txt(output, images_txt, flat_txt, mapping)
+    assert images_txt_is_current(output, images_txt, flat_txt, mapping)
+    assert not images_txt_is_current(output, images_txt, flat_txt, {"L1.jpg": "01.jpg"})
+    images_txt.write_text("1 0 0 0 1 0 0 0 1 L1.jpg\n\n# edited\n")
+    assert not images_txt_is_current(output, images_txt, flat_txt, mapping)
@@ -0,0 +1,76 @@
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+import light_pack
+from light_pack import close_light_packs, load_light_pack, read_light_image, read_packed_image, write_light_pack
+from stacking import stack_folder
+
+LIGHTS = ["L00.png", "L01.png", "L02.png"]
+
+
+def make_view(folder, seed):
+    # Lossless images, so the packed pixels equal a fresh decode
+    rng = np.random.default_rng(seed)
+    folder.mkdir(parents=True)
+    for light in LIGHTS:
+        cv2.imwrite(str(folder / light), rng.integers(0, 256, (16, 24, 3), dtype=np.uint8))
+    cv2.imwrite(str(folder / "mask.png"), np.full((16, 24), 255, dtype=np.uint8))
+    return folder
+
+
+@pytest.fixture
+def packed_views(tmp_path):
+    views = [make_view(tmp_path / f"view_{i}", i) for i in range(2)]
+    for view in views:
+        write_light_pack(view, LIGHTS, "mask.png")
+    yield views
+    close_light_packs()
+
+
+def test_pack_matches_the_decoded_images(packed_views):
+    view = packed_views[0]
+    for name in LIGHTS + ["mask.png"]:
+        image = read_packed_image(view / name)
+        assert np.array_equal(image, cv2.imread(str(view / name), cv2.IMREAD_UNCHANGED))
+        # A copy, so an image kept by the caller doesn't keep the pack mapped
+        assert image.flags.owndata
+
+
+def test_changed_image_is_not_served_from_the_pack(packed_views):
+    view = packed_views[0]
+    cv2.imwrite(str(view / "L01.png"), np.zeros((16, 24, 3), dtype=np.uint8))
+    assert read_packed_image(view / "L01.png") is None
+    assert not read_light_image(view / "L01.png").any()
+    assert not load_light_pack(view).is_current(LIGHTS, "mask.png")
+
+
+def test_only_the_last_pack_stays_open(packed_views):
+    read_packed_image(packed_views[0] / "L00.png")
+    first = light_pack._open_pack[2]
+    read_packed_image(packed_views[1] / "L00.png")
+    assert light_pack._open_pack[0] == str(packed_views[1])
+    assert first.lights is None
+
+    close_light_packs()
+    assert light_pack._open_pack is None
+
+
+def test_rewritten_pack_is_reopened(packed_views):
+    view = packed_views[0]
+    read_packed_image(view / "L00.png")
+    cv2.imwrite(str(view / "L00.png"), np.zeros((16, 24, 3), dtype=np.uint8))
+    write_light_pack(view, LIGHTS, "mask.png")
+    # Even within the same mtime tick as the old index: writing the pack closed the open one
+    assert not read_packed_image(view / "L00.png").any()
+
+
+def test_stack_folder_closes_the_pack(tmp_path, packed_views):
+    view = packed_views[0]
+    (tmp_path / "stacked").mkdir()
+    num_images, cache_hit = stack_folder(view, tmp_path / "stacked", "max", jpg_files=[view / name for name in LIGHTS])
+    assert (num_images, cache_hit) == (3, False)
+    assert light_pack._open_pack is None
+    assert os.path.exists(tmp_path / "stacked" / "view_0.jpg")
@@ -0,0 +1,184 @@
+import os
+import random
+
+import pytest
+
+import rename_engine
+from rename_engine import JOURNAL_NAME, UnfinishedRenameError, plan_renames, recover, rename_entries
+
+
+def apply_operations(names, operations):
+    """
+    Run the planned renames on a simulated directory {name: content}, failing on any overwrite.
+    """
+    names = dict(names)
+    for src, dst in operations:
+        assert src in names, f"{src} renamed before it exists"
+        assert dst not in names, f"{src} -> {dst} overwrites {dst}"
+        names[dst] = names.pop(src)
+    return names
+
+
+def expected(names, mapping):
+    return {mapping.get(name, name): content for name, content in names.items()}
+
+
+def check_plan(mapping, others=()):
+    names = {name: name for name in list(mapping) + list(others)}
+    operations = plan_renames(mapping, names)
+    assert apply_operations(names, operations) == expected(names, mapping)
+    return operations
+
+
+def test_identity_entries_are_dropped():
+    assert check_plan({"a": "a", "b": "b"}) == []
+
+
+def test_chain_is_renamed_from_its_free_end():
+    operations = check_plan({"a": "b", "b": "c", "c": "d"})
+    assert operations == [("c", "d"), ("b", "c"), ("a", "b")]
+
+
+def test_cycle_uses_one_temporary_name():
+    operations = check_plan({"a": "b", "b": "c", "c": "a"})
+    assert len(operations) == 4
+    assert sum(1 for _, dst in operations if dst.startswith(".__rename_tmp_")) == 1
+
+
+def test_swaps_and_chains_together():
+    operations = check_plan({"a": "b", "b": "a", "c": "d", "d": "e", "x": "y", "y": "z", "z": "x"})
+    assert len(operations) == 7 + 2
+
+
+def test_temporary_name_avoids_existing_entries():
+    check_plan({"a": "b", "b": "a"}, others=[".__rename_tmp_0__"])
+
+
+def test_target_held_by_entry_that_is_not_renamed():
+    with pytest.raises(ValueError, match="taken by an entry that keeps its name"):
+        plan_renames({"a": "b"}, ["a", "b"])
+
+
+def test_two_entries_with_the_same_target():
+    with pytest.raises(ValueError, match="would be renamed to"):
+        plan_renames({"a": "c", "b": "c"}, ["a", "b"])
+
+
+@pytest.fixture
+def case_insensitive(monkeypatch):
+    # Names clash like on Windows or a default macOS volume
+    monkeypatch.setattr(rename_engine, "_key", lambda name: name.lower())
+
+
+def test_case_only_rename_is_a_single_operation(case_insensitive):
+    assert plan_renames({"IMG.JPG": "img.jpg"}, ["IMG.JPG"]) == [("IMG.JPG", "img.jpg")]
+
+
+def test_case_only_collision_between_two_targets(case_insensitive):
+    with pytest.raises(ValueError, match="would be renamed to"):
+        plan_renames({"a.jpg": "X.jpg", "b.jpg": "x.jpg"}, ["a.jpg", "b.jpg"])
+
+
+def test_case_only_collision_with_entry_that_is_not_renamed(case_insensitive):
+    with pytest.raises(ValueError, match="taken by an entry that keeps its name"):
+        plan_renames({"b.jpg": "A.jpg"}, ["a.jpg", "b.jpg"])
+
+
+def test_case_insensitive_chain_waits_for_the_entry_holding_the_name(case_insensitive):
+    mapping = {"L1.jpg": "l2.jpg", "L2.jpg": "l3.jpg"}
+    operations = plan_renames(mapping, list(mapping))
+    assert operations == [("L2.jpg", "l3.jpg"), ("L1.jpg", "l2.jpg")]
+
+
+def test_random_permutations():
+    rng = random.Random(0)
+    for _ in range(500):
+        names = [f"f{i}" for i in range(rng.randint(1, 30))]
+        extra = [f"f{i}" for i in range(len(names), len(names) + rng.randint(0, 10))]
+        targets = names + extra
+        rng.shuffle(targets)
+        check_plan(dict(zip(names, targets)))
+
+
+def make_files(directory, names):
+    for name in names:
+        (directory / name).write_text(name)
+
+
+def contents(directory):
+    return {name: (directory / name).read_text() for name in os.listdir(directory)}
+
+
+def test_rename_entries(tmp_path):
+    make_files(tmp_path, ["a", "b", "c"])
+    assert rename_entries(tmp_path, {"a": "b", "b": "c", "c": "a"}, quiet=True) == 3
+    assert contents(tmp_path) == {"b": "a", "c": "b", "a": "c"}
+
+
+def test_dry_run_renames_nothing(tmp_path):
+    make_files(tmp_path, ["a", "b"])
+    rename_entries(tmp_path, {"a": "b", "b": "a"}, dry_run=True)
+    assert contents(tmp_path) == {"a": "a", "b": "b"}
+
+
+def test_missing_source(tmp_path):
+    make_files(tmp_path, ["a"])
+    with pytest.raises(FileNotFoundError):
+        rename_entries(tmp_path, {"b": "c"}, quiet=True)
+
+
+def interrupted_rename(tmp_path, monkeypatch, mapping, after):
+    """
+    Run rename_entries and fail the rename system call after the given number of renames.
+    """
+    real_rename = os.rename
+    calls = []
+
+    def failing_rename(src, dst):
+        if len(calls) == after:
+            raise KeyboardInterrupt
+        calls.append((src, dst))
+        real_rename(src, dst)
+
+    monkeypatch.setattr(os, "rename", failing_rename)
+    with pytest.raises(KeyboardInterrupt):
+        rename_entries(tmp_path, mapping, quiet=True)
+    monkeypatch.setattr(os, "rename", real_rename)
+    assert (tmp_path / JOURNAL_NAME).exists()
+
+
+MAPPING = {"a": "b", "b": "c", "c": "a", "d": "e", "e": "f"}
+
+
+@pytest.mark.parametrize("after", [0, 1, 2, 3, 4, 5])
+def test_recover_forward(tmp_path, monkeypatch, after):
+    make_files(tmp_path, list(MAPPING) + ["other"])
+    original = contents(tmp_path)
+    interrupted_rename(tmp_path, monkeypatch, MAPPING, after)
+
+    with pytest.raises(UnfinishedRenameError):
+        rename_entries(tmp_path, {"other": "x"}, quiet=True)
+    recover(tmp_path, "forward", quiet=True)
+    assert contents(tmp_path) == expected(original, MAPPING)
+
+
+@pytest.mark.parametrize("after", [0, 1, 2, 3, 4, 5])
+def test_recover_back(tmp_path, monkeypatch, after):
+    make_files(tmp_path, list(MAPPING) + ["other"])
+    original = contents(tmp_path)
+    interrupted_rename(tmp_path, monkeypatch, MAPPING, after)
+
+    recover(tmp_path, "back", quiet=True)
+    assert contents(tmp_path) == original
+
+
+def test_recover_without_journal(tmp_path):
+    assert recover(tmp_path) is None
+
+
+def test_recover_counts_the_remaining_renames(tmp_path, monkeypatch):
+    make_files(tmp_path, ["a", "b"])
+    interrupted_rename(tmp_path, monkeypatch, {"a": "b", "b": "c"}, 1)
+    # b -> c went through before the interruption
+    assert recover(tmp_path, "forward", quiet=True) == 1
+    assert not (tmp_path / JOURNAL_NAME).exists()
@@ -0,0 +1,69 @@
+import cv2
+import numpy as np
+import pytest
+
+from image_io import write_image
+from resizing import parse_crop_geometry, process_image, reduction_factor
+
+
+@pytest.mark.parametrize("width, height, crop, resize, factor", [
+    (1800, 1200, None, "400x", 4),
+    (1800, 1200, None, "200x", 8),
+    (1800, 1200, None, "900x", 2),
+    (1800, 1200, None, "1000x", 1),
+    (1800, 1200, None, None, 1),
+    (1800, 1200, None, "50%", 2),
+    (1800, 1200, None, "1800x1200!", 1),
+    # Right or bottom image edge off the reduced grid
+    (1801, 1200, None, "200x", 1),
+    (1800, 1203, None, "200x", 1),
+    (1804, 1204, None, "200x", 4),
+    # Crop box on and off the grid
+    ("crop", "1600x800+16+8", None, "200x", 8),
+    ("crop", "1600x800+12+8", None, "200x", 4),
+    ("crop", "1600x800+3+8", None, "200x", 1),
+    ("crop", "1602x800+16+8", None, "200x", 2),
+])
+def test_reduction_factor(width, height, crop, resize, factor):
+    if width == "crop":
+        width, height, crop = 1800, 1200, parse_crop_geometry(height)
+    assert reduction_factor(width, height, crop, resize) == factor
+
+
+def test_crop_clipped_at_the_image_edge():
+    # 1600x800+208+8 ends at x = 1808, the clipped box ends on the 1800 edge
+    assert reduction_factor(1800, 1200, parse_crop_geometry("1600x800+208+8"), "100x") == 8
+    assert reduction_factor(1801, 1200, parse_crop_geometry("1600x800+208+8"), "100x") == 1
+
+
+def test_crop_outside_the_image():
+    assert reduction_factor(1800, 1200, parse_crop_geometry("100x100+2000+0"), "50x") == 1
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    if mse == 0:
+        return np.inf
+    return 10 * np.log10(255 ** 2 / mse)
+
+
+@pytest.mark.parametrize("width, height, crop", [
+    (1600, 1200, None),
+    (1601, 1203, None),
+    (1600, 1200, "1200x800+200+120"),
+    (1600, 1200, "1203x801+203+121"),
+])
+def test_reduced_decode_matches_full_decode(tmp_path, width, height, crop):
+    rng = np.random.default_rng(0)
+    image = cv2.GaussianBlur(rng.integers(0, 256, (height, width, 3), dtype=np.uint8), (0, 0), 6)
+    image = cv2.normalize(image, None, 0, 255, cv2.NORM_MINMAX)
+    source = tmp_path / "source.jpg"
+    write_image(source, image, quality=95)
+
+    crop = parse_crop_geometry(crop) if crop else None
+    process_image(source, crop, "200x", output_path=tmp_path / "reduced.png", reduced_decode=True)
+    process_image(source, crop, "200x", output_path=tmp_path / "full.png", reduced_decode=False)
+    reduced = cv2.imread(str(tmp_path / "reduced.png"))
+    full = cv2.imread(str(tmp_path / "full.png"))
+    assert reduced.shape == full.shape
+    assert psnr(reduced, full) > 40
@@ -0,0 +1,114 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from camera_pack import load_cameras_sphere, write_camera_pack
+from colmap_io import read_cameras, read_images
+
+PACK_DIR_NAME = "training_pack"
+INDEX_NAME = "index.json"
+PACK_VERSION = 1
+
+
+def create_training_pack(folder, view_ids, height, width, dtype="float32"):
+    """
+    Allocate the arrays of a training pack in folder:
+    normals.npy [V, H, W, 3] and masks.npy [V, H, ceil(W / 8)] (np.packbits along W, 1 = foreground).
+    The views are filled by write_pack_view, possibly from several processes, and the pack only
+    becomes loadable once finish_training_pack wrote index.json.
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    if (folder / INDEX_NAME).exists():
+        os.remove(folder / INDEX_NAME)
+
+    num_views = len(view_ids)
+    normals = np.lib.format.open_memmap(folder / "normals.npy", mode="w+", dtype=np.dtype(dtype),
+                                        shape=(num_views, height, width, 3))
+    masks = np.lib.format.open_memmap(folder / "masks.npy", mode="w+", dtype=np.uint8,
+                                      shape=(num_views, height, (width + 7) // 8))
+    del normals, masks
+
+
+def write_pack_view(folder, index, normals, mask=None):
+    """
+    Store the world-space normals of view number index (and its boolean mask, all foreground if None).
+    Only this view's slice of the memory-mapped files is touched.
+    """
+    folder = Path(folder)
+    pack_normals = np.load(folder / "normals.npy", mmap_mode="r+")
+    if normals.shape != pack_normals.shape[1:]:
+        raise ValueError(f"Normal map of shape {normals.shape} doesn't fit the pack of shape {pack_normals.shape[1:]}")
+    pack_normals[index] = normals
+    pack_normals.flush()
+    del pack_normals
+
+    pack_masks = np.load(folder / "masks.npy", mmap_mode="r+")
+    if mask is None:
+        mask = np.ones(normals.shape[:2], dtype=bool)
+    pack_masks[index] = np.packbits(mask.astype(bool), axis=-1)
+    pack_masks.flush()
+    del pack_masks
+
+
+def finish_training_pack(folder, colmap_path, view_ids, has_mask):
+    """
+    Add the cameras of the packed views (from the cameras_sphere pack or npz written by colmap2neus, in pack order)
+    and write index.json, which marks the pack as complete.
+    """
+    folder = Path(folder)
+    camera_sphere = load_cameras_sphere(colmap_path)
+    view_numbers = [int(view_id) for view_id in view_ids]
+    world_mats = np.stack([camera_sphere[f"world_mat_{n}"] for n in view_numbers])
+    scale_mat = camera_sphere["scale_mat_0"]
+
+    images = read_images(colmap_path)
+    camera_id_of = {int(os.path.splitext(name)[0]): camera_id for name, camera_id in zip(images["name"], images["camera_id"])}
+    camera_ids = [camera_id_of[n] for n in view_numbers]
+    write_camera_pack(folder, view_numbers, world_mats, scale_mat, camera_ids, read_cameras(colmap_path))
+
+    normals = np.load(folder / "normals.npy", mmap_mode="r")
+    index = {
+        "version": PACK_VERSION,
+        "views": list(view_ids),
+        "has_mask": [bool(m) for m in has_mask],
+        "height": normals.shape[1],
+        "width": normals.shape[2],
+        "normals": {"file": "normals.npy", "dtype": str(normals.dtype), "shape": list(normals.shape),
+                    "space": "world"},
+        "masks": {"file": "masks.npy", "packing": "np.packbits(axis=-1, bitorder='big')"},
+        "cameras": {"world_mats": "world_mats.npy", "scale_mat": "scale_mat.npy", "intrinsics": "intrinsics.npy",
+                    "camera_ids": "camera_ids.npy"},
+    }
+    tmp_path = folder / (INDEX_NAME + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_path, folder / INDEX_NAME)
+    return index
+
+
+class TrainingPack:
+    """
+    Memory-mapped view of a training pack. normals[v] is a [H, W, 3] view of the file, nothing is decoded;
+    mask(v) unpacks the bit mask of view v, world_mats/scale_mat/intrinsics/camera_ids hold the cameras in pack order.
+    """
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        if not (self.folder / INDEX_NAME).exists():
+            raise FileNotFoundError(f"{self.folder / INDEX_NAME} not found, the pack is missing or incomplete")
+        with open(self.folder / INDEX_NAME, "r") as f:
+            self.index = json.load(f)
+        self.views = self.index["views"]
+        self.normals = np.load(self.folder / "normals.npy", mmap_mode="r")
+        self.masks = np.load(self.folder / "masks.npy", mmap_mode="r")
+        for name in ("world_mats", "scale_mat", "intrinsics", "camera_ids"):
+            setattr(self, name, np.load(self.folder / f"{name}.npy", mmap_mode="r"))
+
+    def __len__(self):
+        return len(self.views)
+
+    def mask(self, index):
+        return np.unpackbits(self.masks[index], axis=-1, count=self.index["width"]).astype(bool)
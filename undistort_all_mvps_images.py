@@ -1,16 +1,40 @@
 import os
 import argparse
-import subprocess
+import sys
+import time
+from dataset_index import DatasetIndex
+from metrics import Progress, add_metrics_arguments, collect_metrics, count, run_subprocess, stage
+
+def list_view_images(all_mvps_images_path, only_views=None):
+    """
+    List (subfolder, JPEG image names, has mask.png) for every view folder (or the ones named in only_views),
+    from the cached dataset index.
+    """
+    views = []
+    with DatasetIndex(all_mvps_images_path) as index:
+        for subfolder in index.subdirs():
+            if only_views is not None and subfolder not in only_views:
+                continue
+            files = index.files(subfolder)
+            image_files = [f.name for f in files if f.name.lower().endswith(('.jpg', '.jpeg'))]
+            views.append((subfolder, image_files, any(f.name == "mask.png" for f in files)))
+    return views
+
 
 def load_camera_params(cameras_txt_path):
     """
-    Load camera intrinsics from a COLMAP cameras.txt file.
+    Load camera intrinsics from a COLMAP cameras.txt (or cameras.bin) file.
     It skips comments and the "Number of cameras:" line and returns the camera parameters string.
     For example, from
     1 PINHOLE 835 1121 871.97443405134527 871.97443405134527 417.5 560.5
     It returns:
       "PINHOLE 835 1121 871.97443405134527 871.97443405134527 417.5 560.5"
     """
+    if cameras_txt_path.endswith(".bin"):
+        from colmap_io import camera_params_string, read_cameras_binary
+        cameras = read_cameras_binary(cameras_txt_path)
+        return camera_params_string(cameras[0]) if len(cameras) else None
+
     with open(cameras_txt_path, 'r') as f:
         for line in f:
             line = line.strip()
@@ -24,61 +48,132 @@ def load_camera_params(cameras_txt_path):
     return None
 
 
-def process_subfolders(all_mvps_images_path, undistorted_mvps_images_path, camera_params):
+def process_subfolders(all_mvps_images_path, undistorted_mvps_images_path, camera_params, views=None):
     """
     For each subfolder in the given MVPS views directory:
     1. Create an undistortion.txt file with a line per JPEG image in the folder.
     2. Run the COLMAP image undistorted standalone command.
     """
 
+    with stage("list"):
+        view_images = list_view_images(all_mvps_images_path, views)
+
     # Iterate over each subfolder
-    for subfolder in os.listdir(all_mvps_images_path):
+    progress = Progress(len(view_images), "Undistorted", "views")
+    for subfolder, image_files, _ in view_images:
+        subfolder_path = os.path.join(all_mvps_images_path, subfolder)
+
+        # Write the undistortion.txt file.
+        undistortion_file_path = os.path.join(subfolder_path, "undistortion.txt")
+        with open(undistortion_file_path, 'w') as out_file:
+            for image in image_files:
+                out_file.write(f"{image} {camera_params}\n")
+            out_file.write(f"mask.png {camera_params}")
+        
+        # Ensure the output directory for undistorted images exists.
+        undistorted_subfolder_path = os.path.join(undistorted_mvps_images_path, subfolder)
+        os.makedirs(undistorted_subfolder_path, exist_ok=True)
+
+        # Build the COLMAP command.
+        cmd = [
+            "colmap", "image_undistorter_standalone",
+            "--image_path", subfolder_path,
+            "--input_file", undistortion_file_path,
+            "--output_path", undistorted_subfolder_path
+        ]
+
+        # Run the command.
+        with stage("undistort"):
+            run_subprocess(cmd, check=True)
+            count(files_read=len(image_files) + 1, files_written=len(image_files) + 1)
+        progress.update()
+    progress.close()
+
+
+def process_subfolders_native(all_mvps_images_path, undistorted_mvps_images_path, camera_params,
+                              remap_cache_dir=None, jobs=None, views=None):
+    """
+    Undistort the images of all subfolders in-process.
+    The remap table is computed once for the camera (and cached on disk in remap_cache_dir),
+    then every JPEG image and mask.png of every view is remapped by a pool of workers.
+    """
+    # Imported here so the COLMAP path keeps working without OpenCV installed
+    from undistortion import default_remap_cache_dir, load_remap_tables, undistort_images_parallel, Camera
+
+    if remap_cache_dir is None:
+        remap_cache_dir = default_remap_cache_dir()
+
+    with stage("remap_tables"):
+        _, _, undistorted_camera = load_remap_tables(Camera.from_string(camera_params), remap_cache_dir)
+    print(f"Undistorted camera: {undistorted_camera.to_string()}")
+
+    with stage("list"):
+        view_images = list_view_images(all_mvps_images_path, views)
+    tasks = []
+    for subfolder, image_files, has_mask in view_images:
         subfolder_path = os.path.join(all_mvps_images_path, subfolder)
-        if os.path.isdir(subfolder_path):
-            # List all .jpg files (case insensitive) in the subfolder
-            image_files = [f for f in os.listdir(subfolder_path) if f.lower().endswith(('.jpg', '.jpeg'))]
-
-            # Write the undistortion.txt file.
-            undistortion_file_path = os.path.join(subfolder_path, "undistortion.txt")
-            with open(undistortion_file_path, 'w') as out_file:
-                for image in image_files:
-                    out_file.write(f"{image} {camera_params}\n")
-                out_file.write(f"mask.png {camera_params}")
-            
-            # Ensure the output directory for undistorted images exists.
-            undistorted_subfolder_path = os.path.join(undistorted_mvps_images_path, subfolder)
-            os.makedirs(undistorted_subfolder_path, exist_ok=True)
-
-            # Build the COLMAP command.
-            cmd = [
-                "colmap", "image_undistorter_standalone",
-                "--image_path", subfolder_path,
-                "--input_file", undistortion_file_path,
-                "--output_path", undistorted_subfolder_path
-            ]
-
-            # Run the command.
-            subprocess.run(cmd, check=True)
-
-
-def main():
+        undistorted_subfolder_path = os.path.join(undistorted_mvps_images_path, subfolder)
+        os.makedirs(undistorted_subfolder_path, exist_ok=True)
+
+        for f in image_files:
+            tasks.append((os.path.join(subfolder_path, f), os.path.join(undistorted_subfolder_path, f), False))
+        if has_mask:
+            mask_path = os.path.join(subfolder_path, "mask.png")
+            tasks.append((mask_path, os.path.join(undistorted_subfolder_path, "mask.png"), True))
+
+    start_time = time.perf_counter()
+    num_errors = 0
+    progress = Progress(len(tasks), "Undistorted", "images")
+    with stage("undistort"):
+        for image_path, error in undistort_images_parallel(tasks, camera_params, remap_cache_dir, jobs):
+            if error is not None:
+                num_errors += 1
+                progress.print(f"An error occurred for image {image_path}: {error}")
+            progress.update()
+    progress.close()
+    elapsed = time.perf_counter() - start_time
+    print(f"Undistorted {len(tasks)} images in {elapsed:.1f} s "
+          f"({len(tasks) / max(elapsed, 1e-9):.1f} images/sec), {num_errors} errors.")
+    if num_errors:
+        # A partial run must not count as done (e.g. by pipeline.py, which would skip the stage next time)
+        sys.exit(1)
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser(
         description="Undistort all MVPS images."
     )
     parser.add_argument("--cameras_txt_path", required=True,
-                        help="Path to the cameras.txt file")
+                        help="Path to the cameras.txt (or cameras.bin) file")
     parser.add_argument("--all_mvps_images_path", required=True,
                         help="Path to the folder containing MVPS views")
     parser.add_argument("--undistorted_mvps_images_path", required=True,
                         help="Path to save the undistorted MVPS images")
-    args = parser.parse_args()
+    parser.add_argument("--engine", choices=["colmap", "native"], default="colmap",
+                        help="Run COLMAP's image_undistorter_standalone per view or undistort in-process "
+                             "with a cached remap table and a worker pool (default: colmap)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(),
+                        help="Number of images undistorted in parallel by the native engine (default: all cores)")
+    parser.add_argument("--remap_cache_dir",
+                        help="Folder for the cached remap tables of the native engine "
+                             "(default: $MVPS_REMAP_CACHE_DIR or ~/.cache/mvps_scripts/remap)")
+    parser.add_argument("--views", nargs="+",
+                        help="Only undistort these view folders (names), e.g. the views that changed (default: all)")
+    add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
 
     camera_params = load_camera_params(args.cameras_txt_path)
     if camera_params is None:
-        print("Error: No camera parameters found in", args.camera_txt_path)
-        return
+        print("Error: No camera parameters found in", args.cameras_txt_path)
+        sys.exit(1)
     
-    process_subfolders(args.all_mvps_images_path, args.undistorted_mvps_images_path, camera_params)
+    with collect_metrics(args, "undistort_all_mvps_images"):
+        if args.engine == "native":
+            process_subfolders_native(args.all_mvps_images_path, args.undistorted_mvps_images_path, camera_params,
+                                      args.remap_cache_dir, args.jobs, args.views)
+        else:
+            process_subfolders(args.all_mvps_images_path, args.undistorted_mvps_images_path, camera_params,
+                               args.views)
 
 
 if __name__ == "__main__":
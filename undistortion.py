@@ -0,0 +1,280 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from image_io import write_image
+from light_pack import close_light_packs, read_light_image
+from metrics import count
+
+# Parameter layout of the COLMAP camera models (see colmap/src/colmap/sensor/models.h)
+CAMERA_MODEL_PARAMS = {
+    "SIMPLE_PINHOLE": ("f", "cx", "cy"),
+    "PINHOLE": ("fx", "fy", "cx", "cy"),
+    "SIMPLE_RADIAL": ("f", "cx", "cy", "k"),
+    "RADIAL": ("f", "cx", "cy", "k1", "k2"),
+    "OPENCV": ("fx", "fy", "cx", "cy", "k1", "k2", "p1", "p2"),
+    "FULL_OPENCV": ("fx", "fy", "cx", "cy", "k1", "k2", "p1", "p2", "k3", "k4", "k5", "k6"),
+    "OPENCV_FISHEYE": ("fx", "fy", "cx", "cy", "k1", "k2", "k3", "k4"),
+    "SIMPLE_RADIAL_FISHEYE": ("f", "cx", "cy", "k"),
+    "RADIAL_FISHEYE": ("f", "cx", "cy", "k1", "k2"),
+}
+
+_FISHEYE_MODELS = ("OPENCV_FISHEYE", "SIMPLE_RADIAL_FISHEYE", "RADIAL_FISHEYE")
+
+
+class Camera:
+    """
+    A COLMAP camera parsed from the "MODEL WIDTH HEIGHT PARAMS..." string of cameras.txt.
+    """
+
+    def __init__(self, model, width, height, params):
+        if model not in CAMERA_MODEL_PARAMS:
+            raise ValueError(f"Unsupported camera model '{model}'")
+        if len(params) != len(CAMERA_MODEL_PARAMS[model]):
+            raise ValueError(f"Camera model {model} expects {len(CAMERA_MODEL_PARAMS[model])} parameters, got {len(params)}")
+        self.model = model
+        self.width = int(width)
+        self.height = int(height)
+        self.params = dict(zip(CAMERA_MODEL_PARAMS[model], map(float, params)))
+
+    @classmethod
+    def from_string(cls, camera_params):
+        parts = camera_params.split()
+        return cls(parts[0], parts[1], parts[2], parts[3:])
+
+    def to_string(self):
+        return " ".join([self.model, str(self.width), str(self.height)] + [repr(v) for v in self.params.values()])
+
+    @property
+    def focal(self):
+        p = self.params
+        return (p["fx"], p["fy"]) if "fx" in p else (p["f"], p["f"])
+
+    @property
+    def principal_point(self):
+        return self.params["cx"], self.params["cy"]
+
+    def distort(self, u, v):
+        """
+        Apply the lens distortion to normalized image coordinates (vectorized).
+        """
+        p = self.params
+        model = self.model
+        if model in ("SIMPLE_PINHOLE", "PINHOLE"):
+            return u, v
+
+        if model in _FISHEYE_MODELS:
+            radius = np.sqrt(u * u + v * v)
+            theta = np.arctan(radius)
+            theta2 = theta * theta
+            if model == "OPENCV_FISHEYE":
+                thetad = theta * (1 + theta2 * (p["k1"] + theta2 * (p["k2"] + theta2 * (p["k3"] + theta2 * p["k4"]))))
+            elif model == "SIMPLE_RADIAL_FISHEYE":
+                thetad = theta * (1 + p["k"] * theta2)
+            else:
+                thetad = theta * (1 + theta2 * (p["k1"] + p["k2"] * theta2))
+            with np.errstate(divide="ignore", invalid="ignore"):
+                factor = np.where(radius > np.finfo(np.float64).eps, thetad / radius, 1.0)
+            return u * factor, v * factor
+
+        u2, v2, uv = u * u, v * v, u * v
+        r2 = u2 + v2
+        if model == "SIMPLE_RADIAL":
+            radial = p["k"] * r2
+            return u + u * radial, v + v * radial
+        if model == "RADIAL":
+            radial = p["k1"] * r2 + p["k2"] * r2 * r2
+            return u + u * radial, v + v * radial
+
+        k1, k2, p1, p2 = p["k1"], p["k2"], p["p1"], p["p2"]
+        if model == "OPENCV":
+            radial = k1 * r2 + k2 * r2 * r2
+        else:
+            r4, r6 = r2 * r2, r2 * r2 * r2
+            radial = (1 + k1 * r2 + k2 * r4 + p["k3"] * r6) / (1 + p["k4"] * r2 + p["k5"] * r4 + p["k6"] * r6) - 1
+        du = u * radial + 2 * p1 * uv + p2 * (r2 + 2 * u2)
+        dv = v * radial + 2 * p2 * uv + p1 * (r2 + 2 * v2)
+        return u + du, v + dv
+
+    def undistort(self, u, v, iterations=100):
+        """
+        Invert the lens distortion of normalized image coordinates with Newton iterations,
+        using a numerical Jacobian like COLMAP's IterativeUndistortion.
+        """
+        u0, v0 = np.asarray(u, dtype=np.float64), np.asarray(v, dtype=np.float64)
+        x, y = u0.copy(), v0.copy()
+        step = 1e-6
+        for _ in range(iterations):
+            du, dv = self.distort(x, y)
+            res_u, res_v = du - u0, dv - v0
+            dux, dvx = self.distort(x + step, y)
+            duy, dvy = self.distort(x, y + step)
+            j11, j21 = (dux - du) / step, (dvx - dv) / step
+            j12, j22 = (duy - du) / step, (dvy - dv) / step
+            det = j11 * j22 - j12 * j21
+            det = np.where(np.abs(det) < 1e-12, 1e-12, det)
+            dx = (j22 * res_u - j12 * res_v) / det
+            dy = (j11 * res_v - j21 * res_u) / det
+            x -= dx
+            y -= dy
+            if max(np.abs(dx).max(initial=0), np.abs(dy).max(initial=0)) < 1e-10:
+                break
+        return x, y
+
+    def image_to_world(self, x, y):
+        fx, fy = self.focal
+        cx, cy = self.principal_point
+        return self.undistort((x - cx) / fx, (y - cy) / fy)
+
+    def world_to_image(self, u, v):
+        fx, fy = self.focal
+        cx, cy = self.principal_point
+        du, dv = self.distort(u, v)
+        return du * fx + cx, dv * fy + cy
+
+
+def undistorted_camera(camera, blank_pixels=0.0, min_scale=0.2, max_scale=2.0):
+    """
+    Compute the PINHOLE camera of the undistorted images the same way as COLMAP's UndistortCamera,
+    so that the output size and principal point match image_undistorter_standalone.
+    """
+    fx, fy = camera.focal
+    cx, cy = camera.principal_point
+    pinhole = Camera("PINHOLE", camera.width, camera.height, [fx, fy, cx, cy])
+    if camera.model in ("SIMPLE_PINHOLE", "PINHOLE"):
+        return pinhole
+
+    width, height = camera.width, camera.height
+    ys = np.arange(height) + 0.5
+    xs = np.arange(width) + 0.5
+
+    # Left and right image borders
+    left_x, _ = pinhole.world_to_image(*camera.image_to_world(np.full_like(ys, 0.5), ys))
+    right_x, _ = pinhole.world_to_image(*camera.image_to_world(np.full_like(ys, width - 0.5), ys))
+    # Top and bottom image borders
+    _, top_y = pinhole.world_to_image(*camera.image_to_world(xs, np.full_like(xs, 0.5)))
+    _, bottom_y = pinhole.world_to_image(*camera.image_to_world(xs, np.full_like(xs, height - 0.5)))
+
+    # Scale such that the undistorted image contains all pixels of the distorted image
+    min_scale_x = min(cx / (cx - left_x.min()), (width - 0.5 - cx) / (right_x.max() - cx))
+    min_scale_y = min(cy / (cy - top_y.min()), (height - 0.5 - cy) / (bottom_y.max() - cy))
+    # Scale such that there are no blank pixels in the undistorted image
+    max_scale_x = max(cx / (cx - left_x.max()), (width - 0.5 - cx) / (right_x.min() - cx))
+    max_scale_y = max(cy / (cy - top_y.max()), (height - 0.5 - cy) / (bottom_y.min() - cy))
+
+    scale_x = 1.0 / (min_scale_x * blank_pixels + max_scale_x * (1.0 - blank_pixels))
+    scale_y = 1.0 / (min_scale_y * blank_pixels + max_scale_y * (1.0 - blank_pixels))
+    scale_x = float(np.clip(scale_x, min_scale, max_scale))
+    scale_y = float(np.clip(scale_y, min_scale, max_scale))
+
+    new_width = int(max(1.0, scale_x * width))
+    new_height = int(max(1.0, scale_y * height))
+    return Camera("PINHOLE", new_width, new_height,
+                  [fx, fy, cx * new_width / width, cy * new_height / height])
+
+
+def compute_remap_tables(camera):
+    """
+    Compute the cv2.remap tables mapping every pixel of the undistorted image to the distorted one.
+    Returns (map_x, map_y, undistorted_camera).
+    """
+    target = undistorted_camera(camera)
+    fx, fy = target.focal
+    cx, cy = target.principal_point
+    xs = (np.arange(target.width, dtype=np.float64) + 0.5 - cx) / fx
+    ys = (np.arange(target.height, dtype=np.float64) + 0.5 - cy) / fy
+    u, v = np.meshgrid(xs, ys)
+    map_x, map_y = camera.world_to_image(u, v)
+    # COLMAP samples at pixel centers, cv2.remap at integer coordinates
+    return (map_x - 0.5).astype(np.float32), (map_y - 0.5).astype(np.float32), target
+
+
+def default_remap_cache_dir():
+    # Outside the dataset like the index cache: a folder in the output views tree would be listed as a view
+    if os.environ.get("MVPS_REMAP_CACHE_DIR"):
+        return Path(os.environ["MVPS_REMAP_CACHE_DIR"])
+    base = os.environ.get("XDG_CACHE_HOME") or os.environ.get("LOCALAPPDATA") or os.path.expanduser("~/.cache")
+    return Path(base) / "mvps_scripts" / "remap"
+
+
+def remap_cache_path(cache_dir, camera):
+    key = hashlib.sha1(camera.to_string().encode()).hexdigest()[:16]
+    return Path(cache_dir) / f"remap_{camera.model.lower()}_{camera.width}x{camera.height}_{key}.npz"
+
+
+def load_remap_tables(camera, cache_dir):
+    """
+    Load the remap tables of the camera from the on-disk cache, computing and storing them on a miss.
+    """
+    cache_path = remap_cache_path(cache_dir, camera)
+    if cache_path.exists():
+        with np.load(cache_path) as data:
+            return data["map_x"], data["map_y"], Camera.from_string(str(data["camera"]))
+
+    map_x, map_y, target = compute_remap_tables(camera)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(f".{cache_path.stem}.{os.getpid()}.npz")
+    np.savez(tmp_path, map_x=map_x, map_y=map_y, camera=target.to_string())
+    os.replace(tmp_path, cache_path)
+    return map_x, map_y, target
+
+
+@lru_cache(maxsize=4)
+def _worker_maps(camera_params, cache_dir):
+    # Every worker loads the tables once and converts them to OpenCV's faster fixed-point format
+    map_x, map_y, _ = load_remap_tables(Camera.from_string(camera_params), cache_dir)
+    fixed_map, interpolation_map = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+    return map_x, map_y, fixed_map, interpolation_map
+
+
+def _undistort_task(task):
+    image_path, output_path, camera_params, cache_dir, is_mask = task
+    try:
+        image = read_light_image(image_path)
+        if image is None:
+            raise IOError(f"Could not decode image {image_path}")
+        camera = Camera.from_string(camera_params)
+        if (image.shape[1], image.shape[0]) != (camera.width, camera.height):
+            raise ValueError(f"Image size {image.shape[1]}x{image.shape[0]} does not match the camera "
+                             f"({camera.width}x{camera.height})")
+        map_x, map_y, fixed_map, interpolation_map = _worker_maps(camera_params, cache_dir)
+        if is_mask:
+            # Masks must stay binary, so no interpolation between foreground and background
+            undistorted = cv2.remap(image, map_x, map_y, cv2.INTER_NEAREST,
+                                    borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        else:
+            undistorted = cv2.remap(image, fixed_map, interpolation_map, cv2.INTER_LINEAR,
+                                    borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        bytes_written = write_image(output_path, undistorted)
+        return image_path, None, os.path.getsize(image_path), bytes_written
+    except Exception as e:
+        return image_path, e, 0, 0
+
+
+def _init_worker():
+    # Parallelism comes from the process pool, keep OpenCV from oversubscribing the cores
+    cv2.setNumThreads(1)
+
+
+def undistort_images_parallel(tasks, camera_params, cache_dir, jobs=None):
+    """
+    Undistort (image_path, output_path, is_mask) tasks with a process pool.
+    The remap tables are computed once (or loaded from cache_dir) before the workers start.
+    Yields (image_path, error) as the images finish.
+    """
+    load_remap_tables(Camera.from_string(camera_params), cache_dir)
+    jobs = jobs or os.cpu_count() or 1
+    tasks = [(str(image_path), str(output_path), camera_params, str(cache_dir), is_mask)
+             for image_path, output_path, is_mask in tasks]
+    chunksize = max(1, min(64, len(tasks) // (jobs * 4)))
+    # The workers map one light pack at a time and exit with the pool; the calling process may still map one
+    close_light_packs()
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker) as executor:
+        for image_path, error, bytes_read, bytes_written in executor.map(_undistort_task, tasks, chunksize=chunksize):
+            count(files_read=1, bytes_read=bytes_read, files_written=int(error is None), bytes_written=bytes_written)
+            yield image_path, error